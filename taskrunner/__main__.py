@@ -25,6 +25,22 @@ def main(argv=None):
     value can be prepended with a colon to force it to be considered
     a value and not a task name.
 
+    Tasks declared as dependencies of the specified tasks (e.g., with
+    ``@task(depends=['build'])``) are run before them, once each. With
+    ``-j N``, dependencies that don't depend on each other are run
+    concurrently (up to ``N`` at a time); their output is still shown
+    in order. The specified tasks themselves are always run in
+    succession.
+
+    Several envs can be specified with ``--env a,b,c``. The tasks are
+    then run in each env, with the envs run concurrently when ``-j N``
+    is also specified; output for each env is shown together, followed
+    by a summary.
+
+    Each task completed in a run is recorded in a journal. If the run
+    fails, it can be rerun with ``--resume`` to skip the tasks that were
+    already completed (as long as their args and config are the same).
+
     """
     argv = sys.argv[1:] if argv is None else argv
     command_args, remaining_args = split_args(argv)
@@ -42,6 +58,8 @@ def main(argv=None):
     parser.add_argument('-E', '--echo', action='store_true', default=False)
     parser.add_argument('--no-echo', action='store_false', dest='echo', default=False)
     parser.add_argument('--hide', choices=('none', 'stdout', 'stderr', 'all'), default=None)
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--resume', action='store_true', default=False)
     parser.add_argument('-d', '--debug', action='store_true', default=False)
     args = parser.parse_args(command_args)
 
@@ -57,6 +75,8 @@ def main(argv=None):
         tasks_module=args.tasks_module,
         default_echo=args.echo,
         default_hide=args.hide,
+        jobs=args.jobs,
+        resume=args.resume,
         debug=args.debug,
     )
 
@@ -80,7 +100,8 @@ def main(argv=None):
 def split_args(argv):
     command_args = []
 
-    options_with_values = {'-c', '--config-file', '-e', '--env', '-t', '--tasks-module', '--hide'}
+    options_with_values = {
+        '-c', '--config-file', '-e', '--env', '-t', '--tasks-module', '--hide', '-j', '--jobs'}
     option_value_expected = False
 
     for i, s in enumerate(argv):
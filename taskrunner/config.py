@@ -5,7 +5,7 @@ from collections import Mapping, OrderedDict, Sequence
 from configparser import RawConfigParser
 
 from .task import task
-from .util import abs_path, print_error
+from .util import abs_path, print_error, render_template
 
 
 __all__ = ['show_config']
@@ -24,8 +24,11 @@ class RawConfig(OrderedDict):
 
     def __getattr__(self, name):
         if name.startswith('_'):
-            return super().__getattr__(name)
-        return self[name]
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise ConfigAttributeError(name) from None
 
     def __setattr__(self, name, value):
         if name.startswith('_'):
@@ -37,6 +40,12 @@ class RawConfig(OrderedDict):
             value = RawConfig(value)
         super().__setitem__(name, value)
 
+    def __reduce__(self):
+        # Configs are pickled (e.g., to send them to worker processes) as
+        # their items without rerunning __init__, which would read config
+        # files again and, for a Config, redo interpolation.
+        return _restore_config, (self.__class__, list(self.items())), vars(self) or None
+
     def _get_dotted(self, name, default=NO_DEFAULT):
         obj = self
         segments = name.split('.')
@@ -113,7 +122,7 @@ class Config(RawConfig):
 
     def _do_interpolation(self, obj, interpolated):
         if isinstance(obj, str):
-            new_value = obj.format(**self)
+            new_value = render_template(obj, self)
             if new_value != obj:
                 obj = new_value
                 interpolated.append(obj)
@@ -125,11 +134,30 @@ class Config(RawConfig):
         return obj
 
 
+def _restore_config(cls, items):
+    config = OrderedDict.__new__(cls)
+    OrderedDict.__init__(config)
+    for name, value in items:
+        OrderedDict.__setitem__(config, name, value)
+    return config
+
+
 class ConfigError(Exception):
 
     pass
 
 
+class ConfigAttributeError(KeyError, AttributeError):
+
+    """Raised when a config item that doesn't exist is accessed as an attribute.
+
+    This is an :class:`AttributeError` so that ``hasattr()``, ``getattr()``
+    with a default, :mod:`copy`, and :mod:`pickle` work as expected, and
+    a :class:`KeyError` for compatibility.
+
+    """
+
+
 class ConfigParser(RawConfigParser):
 
     optionxform = lambda self, name: name
@@ -0,0 +1,236 @@
+import os
+import re
+import select
+import threading
+from contextlib import contextmanager
+
+
+__all__ = ['JobServer', 'JobSlots', 'get_jobserver', 'set_jobserver']
+
+
+AUTH_RE = re.compile(
+    r'--jobserver-(?:auth|fds)=(?:fifo:(?P<fifo>\S+)|(?P<read>\d+),(?P<write>\d+))')
+
+TOKEN = b'+'
+
+
+class JobServer:
+
+    """GNU make jobserver support.
+
+    A jobserver is a pipe (or named pipe) holding one token (a byte) per
+    job slot beyond the first. A process that wants to run an extra job
+    reads a token and writes it back when the job is done. The jobserver
+    is advertised to child processes via ``$MAKEFLAGS``, so ``make`` and
+    other tools that understand the protocol (e.g., ``cargo``, ``ninja``)
+    share the same budget.
+
+    When ``runtasks -j N`` is used, a jobserver with ``N`` slots is created
+    and passed to every local command. When ``runtasks`` is itself run from
+    a make recipe, the jobserver from ``$MAKEFLAGS`` is used instead.
+
+    """
+
+    def __init__(self, read_fd, write_fd, jobs=None, owner=False, fifo=None):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.jobs = jobs
+        self.owner = owner
+        self.fifo = fifo
+        self.poll_fd = self._open_poll_fd()
+
+    def _open_poll_fd(self):
+        # The jobserver's fds are shared with other processes, so they
+        # can't be made non-blocking. Instead, a separate non-blocking
+        # open file description is used to take tokens without waiting.
+        # If that's not possible, the shared fd is used as is.
+        path = self.fifo or '/proc/self/fd/{fd}'.format(fd=self.read_fd)
+        try:
+            return os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return self.read_fd
+
+    @classmethod
+    def create(cls, jobs):
+        """Create a jobserver with ``jobs`` slots."""
+        if jobs < 1:
+            raise ValueError('A jobserver needs at least one slot')
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, TOKEN * (jobs - 1))
+        return cls(read_fd, write_fd, jobs=jobs, owner=True)
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        """Connect to the jobserver advertised in ``$MAKEFLAGS``.
+
+        Returns ``None`` if there's no jobserver or if its pipe wasn't
+        passed down to this process.
+
+        """
+        makeflags = environ.get('MAKEFLAGS', '')
+        match = AUTH_RE.search(makeflags)
+        if not match:
+            return None
+        fifo = match.group('fifo')
+        try:
+            if fifo:
+                read_fd = write_fd = os.open(fifo, os.O_RDWR)
+            else:
+                read_fd = int(match.group('read'))
+                write_fd = int(match.group('write'))
+                os.fstat(read_fd)
+                os.fstat(write_fd)
+        except OSError:
+            return None
+        jobs = re.search(r'(?:^|\s)-j(\d+)', makeflags)
+        jobs = int(jobs.group(1)) if jobs else None
+        return cls(read_fd, write_fd, jobs=jobs, owner=bool(fifo), fifo=fifo)
+
+    def get_env(self, env=None):
+        """Get the env vars to pass to a child process.
+
+        The jobserver args are appended to ``$MAKEFLAGS`` from ``env``,
+        or from ``os.environ`` if it isn't set there, so that any other
+        make flags are passed along too.
+
+        Args:
+            env (dict): The env vars for the child process
+
+        Returns:
+            dict: A copy of ``env`` with ``$MAKEFLAGS`` updated
+
+        """
+        env = dict(env or {})
+        if not self.owner or self.fifo:
+            return env
+        makeflags = env.get('MAKEFLAGS', os.environ.get('MAKEFLAGS', ''))
+        # Args for a jobserver that wasn't passed down are stale.
+        makeflags = AUTH_RE.sub('', makeflags).rstrip()
+        auth = '{self.read_fd},{self.write_fd}'.format(self=self)
+        flags = '-j{jobs} --jobserver-auth={auth} --jobserver-fds={auth}'.format(
+            jobs=self.jobs, auth=auth)
+        env['MAKEFLAGS'] = '{makeflags} {flags}'.format(makeflags=makeflags, flags=flags)
+        return env
+
+    @property
+    def pass_fds(self):
+        """File descriptors child processes need to inherit."""
+        if self.fifo:
+            return ()
+        return (self.read_fd, self.write_fd)
+
+    def acquire(self):
+        """Wait for a token and return it."""
+        while True:
+            try:
+                token = os.read(self.read_fd, 1)
+            except BlockingIOError:
+                select.select([self.read_fd], [], [])
+            except InterruptedError:
+                pass
+            else:
+                return token or TOKEN
+
+    def release(self, token):
+        os.write(self.write_fd, token)
+
+    def close(self):
+        if self.poll_fd != self.read_fd:
+            os.close(self.poll_fd)
+        if self.owner:
+            os.close(self.read_fd)
+            if self.write_fd != self.read_fd:
+                os.close(self.write_fd)
+
+
+class JobSlots:
+
+    """Job slots for running things concurrently in this process.
+
+    This process always has one implicit slot (the one it was started
+    in), so the first concurrent job doesn't need a token. Additional
+    jobs take tokens from the jobserver, if there is one; otherwise, the
+    number of slots isn't limited here.
+
+    The implicit slot is kept as a token in a private pipe so that
+    waiting for a slot can wait on it and the jobserver at the same
+    time.
+
+    Usage::
+
+        slots = JobSlots(get_jobserver())
+        with slots.slot():
+            ...
+
+    """
+
+    def __init__(self, jobserver=None):
+        self.jobserver = jobserver
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.write(self._write_fd, TOKEN)
+
+    def acquire(self):
+        """Wait for a slot; returns ``None`` for the implicit slot."""
+        if self.jobserver is None:
+            return None
+        fds = [self._read_fd, self.jobserver.poll_fd]
+        while True:
+            readable = select.select(fds, [], [])[0]
+            if self._read_fd in readable:
+                try:
+                    os.read(self._read_fd, 1)
+                except BlockingIOError:
+                    continue
+                return None
+            # Another process may have taken the token in the meantime,
+            # in which case this goes back to waiting for either slot.
+            try:
+                token = os.read(self.jobserver.poll_fd, 1)
+            except (BlockingIOError, InterruptedError):
+                continue
+            return token or TOKEN
+
+    def release(self, token):
+        if token is None:
+            if self.jobserver is not None:
+                os.write(self._write_fd, TOKEN)
+        else:
+            self.jobserver.release(token)
+
+    @contextmanager
+    def slot(self):
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+_jobserver_lock = threading.Lock()
+_jobserver = None
+_jobserver_loaded = False
+
+
+def get_jobserver():
+    """Get the active jobserver, if there is one."""
+    global _jobserver, _jobserver_loaded
+    with _jobserver_lock:
+        if not _jobserver_loaded:
+            _jobserver = JobServer.from_environ()
+            _jobserver_loaded = True
+        return _jobserver
+
+
+def set_jobserver(jobserver):
+    """Set the active jobserver; returns the previous one."""
+    global _jobserver, _jobserver_loaded
+    previous = get_jobserver()
+    with _jobserver_lock:
+        _jobserver = jobserver
+        _jobserver_loaded = True
+    return previous
@@ -0,0 +1,233 @@
+import io
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from importlib import import_module
+from importlib.machinery import SourceFileLoader
+
+from .jobserver import JobSlots, get_jobserver
+
+
+__all__ = ['ProcessTraceback', 'TaskRef', 'map_in_processes', 'run_in_processes']
+
+
+# The config for the current worker process (see init_worker).
+_worker_config = None
+
+
+class ProcessTraceback(Exception):
+
+    """Traceback of an exception raised in a worker process.
+
+    Set as the ``__cause__`` of the exception when it's re-raised in
+    the parent process so the original traceback isn't lost.
+
+    """
+
+    def __init__(self, traceback_str):
+        super().__init__(traceback_str)
+        self.traceback_str = traceback_str
+
+    def __str__(self):
+        return '\n\n{traceback_str}'.format(traceback_str=self.traceback_str.rstrip())
+
+
+class RecordingStream(io.TextIOBase):
+
+    """Stand-in for ``sys.stdout`` or ``sys.stderr`` in a worker process.
+
+    Text written to it is recorded so that it can be shown in order by
+    the parent process. Since it has no file descriptor, output from
+    commands run in the worker passes through it too.
+
+    """
+
+    def __init__(self, name, chunks):
+        self.name = name
+        self.chunks = chunks
+
+    @property
+    def encoding(self):
+        return 'utf-8'
+
+    def write(self, text):
+        self.chunks.append((self.name, text))
+        return len(text)
+
+    def isatty(self):
+        return False
+
+
+@contextmanager
+def record_output(chunks):
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = RecordingStream('stdout', chunks)
+    sys.stderr = RecordingStream('stderr', chunks)
+    try:
+        yield chunks
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def replay_output(chunks):
+    """Show output recorded in a worker process."""
+    streams = {'stdout': sys.stdout, 'stderr': sys.stderr}
+    for name, text in chunks:
+        streams[name].write(text)
+    for stream in streams.values():
+        stream.flush()
+
+
+class TaskRef:
+
+    """Picklable reference to a task.
+
+    A :class:`Task` can't be pickled by reference like a function since
+    the name of its implementation in its module refers to the task.
+    Instead, the task is looked up by name in its module in the worker
+    process. Tasks modules loaded from a file (e.g., ``tasks.py``) are
+    loaded again from the same file if the worker doesn't already have
+    them (i.e., when workers aren't forked).
+
+    """
+
+    def __init__(self, task):
+        module_name = task.implementation.__module__
+        module = sys.modules.get(module_name)
+        self.module_name = module_name
+        self.module_file = getattr(module, '__file__', None)
+        self.name = task.name
+
+    def resolve(self):
+        from .task import Task
+        module = sys.modules.get(self.module_name)
+        if module is None:
+            try:
+                module = import_module(self.module_name)
+            except ImportError:
+                if not self.module_file:
+                    raise
+                module = SourceFileLoader(self.module_name, self.module_file).load_module()
+        for obj in vars(module).values():
+            if isinstance(obj, Task) and obj.name == self.name:
+                return obj
+        raise LookupError('Task not found in {self.module_name}: {self.name}'.format(self=self))
+
+    def __call__(self, config, *args, **kwargs):
+        return self.resolve().implementation(config, *args, **kwargs)
+
+
+def init_worker(config):
+    """Set the config for a worker process (passed as its initializer)."""
+    global _worker_config
+    _worker_config = config
+
+
+def call_in_worker(func, calls):
+    """Call ``func(config, *args, **kwargs)`` for each of ``calls``.
+
+    Runs in a worker process. ``calls`` is a list of ``(args, kwargs)``.
+    Output is recorded separately for each call.
+
+    Returns a list of ``(result, exc, traceback_str, output)`` for the
+    calls that were made; the calls after one that fails aren't made.
+
+    """
+    outcomes = []
+    for args, kwargs in calls:
+        chunks = []
+        try:
+            with record_output(chunks):
+                result = func(_worker_config, *args, **kwargs)
+        except BaseException as exc:
+            outcomes.append((None, exc, traceback.format_exc(), chunks))
+            break
+        outcomes.append((result, None, None, chunks))
+    return outcomes
+
+
+def run_in_processes(config, func, calls, jobs=None, chunksize=1):
+    """Call ``func(config, *args, **kwargs)`` in a pool of processes.
+
+    ``calls`` is a list of ``(args, kwargs)``. The calls are sent to the
+    workers in batches of ``chunksize``. See :func:`map_in_processes`.
+
+    """
+    calls = list(calls)
+    jobserver = get_jobserver()
+    jobs = jobs or (jobserver and jobserver.jobs) or os.cpu_count() or 1
+    slots = JobSlots(jobserver)
+    batches = [calls[i:i + chunksize] for i in range(0, len(calls), chunksize)]
+    futures = []
+    results = []
+
+    def collect(block):
+        # Show output and gather results for batches in order, as far
+        # as they've finished.
+        while len(results) < len(calls):
+            future = futures[len(results) // chunksize]
+            if not (block or future.done()):
+                return
+            for result, exc, traceback_str, chunks in future.result():
+                replay_output(chunks)
+                if exc is not None:
+                    exc.__cause__ = ProcessTraceback(traceback_str)
+                    raise exc
+                results.append(result)
+
+    executor = ProcessPoolExecutor(
+        max_workers=min(jobs, len(batches) or 1), initializer=init_worker, initargs=(config,))
+    try:
+        for batch in batches:
+            # Each batch beyond the first needs a jobserver token, which
+            # is held until the batch is done.
+            token = slots.acquire()
+            future = executor.submit(call_in_worker, func, batch)
+            future.add_done_callback(lambda f, token=token: slots.release(token))
+            futures.append(future)
+            collect(block=False)
+        collect(block=True)
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+        slots.close()
+
+    return results
+
+
+def map_in_processes(config, func, items, jobs=None, chunksize=1):
+    """Call ``func(config, item)`` for each item in a pool of processes.
+
+    This is for CPU-bound Python code, which can't run concurrently in
+    threads. Each worker process gets a copy of ``config`` when it's
+    started. ``func`` must be picklable (i.e., defined at the top level
+    of a module), as must the items and results.
+
+    Output written to stdout and stderr in the workers is shown in the
+    same order as the items (and, when running tasks concurrently, in
+    order with the output of other tasks).
+
+    Args:
+        func: The function to call
+        items (list): The items to call ``func`` with
+        jobs (int): Max number of worker processes; defaults to the
+            number of jobserver slots or the number of CPUs; when a
+            jobserver is active, each batch beyond the first also
+            needs a jobserver token to run
+        chunksize (int): Number of items to send to a worker at once;
+            larger batches cut down on overhead for quick calls
+
+    Returns:
+        list: The result for each item in the same order as ``items``
+
+    Raises:
+        The first exception (in item order) raised by ``func``, after
+        showing the output for the items up to and including it; its
+        ``__cause__`` has the traceback from the worker process
+
+    """
+    return run_in_processes(
+        config, func, [((item,), {}) for item in items], jobs=jobs, chunksize=chunksize)
@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .util import args_to_str, as_list
+
+
+__all__ = ['ResourcePool', 'get_limits', 'parse_resources', 'resource_pool']
+
+
+class ResourcePool:
+
+    """Named counting semaphores for throttling tasks and commands.
+
+    Each resource has a limit on the total amount of it that can be in
+    use at once; a task or command declares the amount of each resource
+    it needs (usually 1). For example, with a limit of 2 for "db", at
+    most two tasks that need 1 "db" can run at the same time.
+
+    All the resources needed by a task or command are acquired together
+    or not at all, under a single :class:`threading.Condition`, so two
+    tasks can't each hold part of what the other needs and deadlock.
+    (Acquiring more resources while already holding some can still
+    deadlock, so tasks should declare everything they need up front.)
+
+    Holding resources is reentrant per thread: if a thread already holds
+    some of a resource (e.g., a task that declares "db" runs a command
+    that also declares "db"), only the amount beyond what it holds is
+    acquired.
+
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._limits = {}
+        self._in_use = {}
+        self._local = threading.local()
+
+    def get_held(self):
+        """Get the amounts of resources held by the current thread."""
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = {}
+        return held
+
+    def get_needed(self, resources, limits=None):
+        # Figure out what needs to be acquired, accounting for what the
+        # current thread already holds. Limits are fixed the first time
+        # a resource is seen.
+        held = self.get_held()
+        needed = {}
+        for name, amount in resources.items():
+            limit = self._limits.setdefault(name, (limits or {}).get(name, 1))
+            if amount > limit:
+                raise ValueError(
+                    'Amount of {name} needed ({amount}) is more than its limit ({limit})'.format(
+                        name=name, amount=amount, limit=limit))
+            amount -= held.get(name, 0)
+            if amount > 0:
+                needed[name] = amount
+        return needed
+
+    def is_available(self, needed):
+        return all(
+            self._in_use.get(name, 0) + amount <= self._limits[name]
+            for name, amount in needed.items())
+
+    def acquire(self, resources, limits=None, timeout=None):
+        """Wait for ``resources`` and acquire them all at once.
+
+        Args:
+            resources (dict): Amounts of resources to acquire
+            limits (dict): Limits for resources that haven't been seen
+                before; the default limit is 1
+            timeout: Max seconds to wait
+
+        Returns:
+            dict: The amounts that were acquired, to be passed to
+                :meth:`release`, or ``None`` if ``timeout`` expired
+
+        """
+        with self._condition:
+            needed = self.get_needed(resources, limits)
+            if not self._condition.wait_for(lambda: self.is_available(needed), timeout):
+                return None
+            self._take(needed)
+        return needed
+
+    def try_acquire(self, resources, limits=None):
+        """Acquire ``resources`` only if they're all available now."""
+        return self.acquire(resources, limits, timeout=0)
+
+    def release(self, acquired):
+        with self._condition:
+            for name, amount in acquired.items():
+                self._in_use[name] -= amount
+            self._condition.notify_all()
+
+    @contextmanager
+    def holding(self, acquired):
+        """Mark resources as held by the current thread.
+
+        Used when resources were acquired in another thread (e.g., by
+        a scheduler) on behalf of this one. They're released on exit.
+
+        """
+        held = self.get_held()
+        for name, amount in acquired.items():
+            held[name] = held.get(name, 0) + amount
+        try:
+            yield acquired
+        finally:
+            for name, amount in acquired.items():
+                held[name] -= amount
+                if not held[name]:
+                    del held[name]
+            self.release(acquired)
+
+    @contextmanager
+    def hold(self, resources, limits=None):
+        """Acquire ``resources`` for the duration of a ``with`` block."""
+        acquired = self.acquire(resources, limits) if resources else {}
+        with self.holding(acquired):
+            yield acquired
+
+    def _take(self, needed):
+        for name, amount in needed.items():
+            self._in_use[name] = self._in_use.get(name, 0) + amount
+
+
+def parse_resources(resources, format_kwargs=None):
+    """Parse resources into an ordered map of names to amounts.
+
+    ``resources`` can be a dict of names to amounts or a list of names
+    (or a comma-separated string of names), optionally with an amount
+    like "uploads:2". The default amount is 1. Names may contain format
+    strings, which will be filled from ``format_kwargs``.
+
+    """
+    if isinstance(resources, dict):
+        items = resources.items()
+    else:
+        items = []
+        for item in as_list(resources):
+            name, _, amount = item.partition(':')
+            items.append((name, amount or 1))
+    parsed = OrderedDict()
+    for name, amount in items:
+        name = args_to_str(name, format_kwargs=format_kwargs)
+        parsed[name] = parsed.get(name, 0) + int(amount)
+    return parsed
+
+
+def get_limits(config, resources):
+    """Get the limits for ``resources`` from ``config.resources``."""
+    return {name: int(config._get_dotted('resources.' + name, 1)) for name in resources}
+
+
+resource_pool = ResourcePool()
@@ -1,37 +1,235 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
 from importlib.machinery import SourceFileLoader
 from itertools import chain
 
 from .config import Config, RawConfig
-from .task import Task
-from .util import get_hr, print_debug, print_header, print_info, print_warning
+from .jobserver import JobServer, JobSlots, get_jobserver, set_jobserver
+from .resources import get_limits
+from .runners.env import env_cache
+from .scheduler import OrderedOutput, OutputSlot, Scheduler, TaskNode
+from .state import Journal, get_config_fingerprint
+from .task import InvocationCache, Task, set_invocation_cache
+from .util import (
+    as_list, get_hr, print_debug, print_error, print_header, print_info, print_success,
+    print_warning)
 
 
 class TaskRunner:
 
     def __init__(self, config_file=None, env=None, tasks_module='tasks.py', default_echo=False,
-                 default_hide=None, debug=False):
+                 default_hide=None, jobs=None, resume=False, debug=False):
         self.config_file = config_file
         self.env = env
         self.tasks_module = tasks_module
         self.default_echo = default_echo
         self.default_hide = default_hide
+        self.jobs = jobs
+        self.resume = resume
         self.debug = debug
+        self.journal = None
 
     def run(self, args):
+        env_cache.clear()
+
+        # Tasks declared with once=True are run once per run.
+        previous_invocation_cache = set_invocation_cache(InvocationCache())
+
+        try:
+            # -j N creates a jobserver that's shared by everything run from
+            # here; otherwise, one inherited via $MAKEFLAGS is used, if any.
+            if self.jobs:
+                jobserver = JobServer.create(self.jobs)
+                previous_jobserver = set_jobserver(jobserver)
+                try:
+                    return self._run(args)
+                finally:
+                    set_jobserver(previous_jobserver)
+                    jobserver.close()
+            return self._run(args)
+        finally:
+            set_invocation_cache(previous_invocation_cache)
+
+    def _run(self, args):
         all_tasks = self.load_tasks(self.tasks_module)
         tasks_to_run = self.get_tasks_to_run(all_tasks, args)
-        configs = {}
+        nodes = self.get_nodes(all_tasks, tasks_to_run)
 
-        for task, task_args in tasks_to_run:
-            self.print_debug('Task to run:', task.name, task_args)
+        for node in nodes:
+            self.print_debug('Task to run:', node.task.name, node.args)
+
+        self.journal = Journal()
+        self.journal.start(args, resume=self.resume)
+
+        envs = as_list(self.env)
+        if len(envs) > 1:
+            self.run_envs(envs, nodes)
+        else:
+            # Configs are loaded up front so tasks that run concurrently
+            # don't race to load them.
+            configs = {}
+            for node in nodes:
+                task_env = self.env or node.task.default_env
+                if task_env not in configs:
+                    configs[task_env] = self.load_config(task_env)
+                if node.task.resources:
+                    node.resources = node.task.get_resources(configs[task_env])
+                    node.limits = get_limits(configs[task_env], node.resources)
+            fingerprints = {env: get_config_fingerprint(c) for (env, c) in configs.items()}
+
+            def run_node(node):
+                task_env = self.env or node.task.default_env
+                self.run_node(node, configs[task_env], fingerprints[task_env])
+
+            Scheduler(self.jobs).run(nodes, run_node)
+
+        # Everything succeeded, so there's nothing to resume.
+        self.journal.clear()
+
+    def run_node(self, node, config, fingerprint):
+        """Run a node unless the journal says it was already completed.
+
+        When resuming, invocations completed in the previous run with
+        the same env, args, and config are skipped. Each invocation
+        that's run successfully is recorded in the journal.
+
+        """
+        task = node.task
+        env = config.get('env')
+        kwargs = task.parse_args(config, node.args)
+        if self.resume and self.journal.is_completed(task, env, kwargs, fingerprint):
+            if not task.is_hidden(config, kwargs):
+                print_info('Skipping {task.name} task: completed in previous run'.format(
+                    task=task))
+            return
+        task.run(config, node.args)
+        self.journal.record(task, env, kwargs, fingerprint)
+
+    def run_envs(self, envs, nodes):
+        """Run the tasks in each of ``envs``.
+
+        Each env's config is loaded once, and the envs are run
+        concurrently (up to ``-j`` at a time), each in its own worker.
+        Within an env, tasks are run one at a time. Output for each env
+        is shown together (see :class:`OrderedOutput`), and a summary is
+        shown at the end.
+
+        If the tasks fail in one env, envs that haven't been started yet
+        aren't run. After the summary, the first failure is re-raised.
 
+        """
+        configs = OrderedDict((env, self.load_config(env)) for env in envs)
+        outcomes = OrderedDict((env, None) for env in envs)
+        output = OrderedOutput(len(envs))
+        slots = JobSlots(get_jobserver())
+        failed = threading.Event()
+
+        def run_env(index, env):
+            start_time = time.monotonic()
+            try:
+                if failed.is_set():
+                    return
+                with slots.slot(), OutputSlot(output, index).activate():
+                    print_header('Running in {env} env'.format(env=env))
+                    config, fingerprint = configs[env], get_config_fingerprint(configs[env])
+                    Scheduler().run(nodes, lambda node: self.run_node(node, config, fingerprint))
+            except BaseException as exc:
+                failed.set()
+                outcomes[env] = (exc, time.monotonic() - start_time)
+            else:
+                outcomes[env] = (None, time.monotonic() - start_time)
+            finally:
+                output.finish(index)
+
+        try:
+            with output.install(), ThreadPoolExecutor(max_workers=self.jobs or 1) as executor:
+                for future in [executor.submit(run_env, i, env) for i, env in enumerate(envs)]:
+                    future.result()
+        finally:
+            slots.close()
+
+        print_header('Summary:')
+        failures = []
+        for env, outcome in outcomes.items():
+            if outcome is None:
+                print_warning('{env}: not run'.format(env=env))
+                continue
+            exc, elapsed_time = outcome
+            if exc is None:
+                print_success('{env}: succeeded in {elapsed_time:.1f}s'.format(
+                    env=env, elapsed_time=elapsed_time))
+            else:
+                if isinstance(exc, SystemExit) and isinstance(exc.code, int):
+                    reason = 'exit code {code}'.format(code=exc.code)
+                elif isinstance(exc, SystemExit):
+                    reason = exc.code
+                else:
+                    reason = '{name}: {exc}'.format(name=exc.__class__.__name__, exc=exc)
+                print_error('{env}: failed after {elapsed_time:.1f}s ({reason})'.format(
+                    env=env, elapsed_time=elapsed_time, reason=reason))
+                failures.append(exc)
+
+        if failures:
+            raise failures[0]
+
+    def get_nodes(self, all_tasks, tasks_to_run):
+        """Resolve the dependencies of the tasks to run.
+
+        Returns a list of :class:`TaskNode`s in serial order: each
+        task's dependencies come before it, and otherwise tasks are in
+        the order they were specified.
+
+        Dependencies are run with their default args, and each one is
+        run only once, no matter how many tasks depend on it. A task
+        specified on the command line without args also counts as the
+        dependency of that name.
+
+        Tasks specified on the command line are run in succession: each
+        one depends on the one before it, so with ``-j``, only their
+        declared dependencies are run concurrently.
+
+        """
+        nodes = []
+        dependency_nodes = {}
+        added_as_dependency = set()
+
+        def add(task, args, path, after=None):
+            depends = [] if after is None else [after]
+            for name in task.depends:
+                if name in path:
+                    cycle = ' -> '.join(path + (name,))
+                    raise TaskRunnerError('Circular task dependency: {cycle}'.format(cycle=cycle))
+                node = dependency_nodes.get(name)
+                if node is None:
+                    try:
+                        dependency = all_tasks[name]
+                    except KeyError:
+                        raise TaskRunnerError(
+                            'Unknown task: {name} (dependency of {task.name})'.format(
+                                name=name, task=task)) from None
+                    node = add(dependency, [], path + (name,))
+                    dependency_nodes[name] = node
+                    added_as_dependency.add(name)
+                if node not in depends:
+                    depends.append(node)
+            node = TaskNode(task, args, len(nodes), depends)
+            nodes.append(node)
+            return node
+
+        previous = None
         for task, task_args in tasks_to_run:
-            task_env = self.env or task.default_env
-            if task_env not in configs:
-                configs[task_env] = self.load_config(task_env)
-            task_config = configs[task_env]
-            task.run(task_config, task_args)
+            if task_args:
+                previous = add(task, task_args, (task.name,), previous)
+            elif task.name in added_as_dependency:
+                continue
+            else:
+                previous = add(task, task_args, (task.name,), previous)
+                dependency_nodes.setdefault(task.name, previous)
+
+        return nodes
 
     def load_config(self, env=None):
         config = Config(
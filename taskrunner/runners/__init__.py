@@ -1,2 +1,4 @@
 from .exc import RunAborted, RunError
 from .local import LocalRunner
+from .pipeline import PipelineRunner
+from .streams import StreamingRun
@@ -0,0 +1,380 @@
+import atexit
+import json
+import os
+import queue
+import shlex
+import struct
+import sys
+import threading
+from subprocess import PIPE, Popen
+
+from ..util import Capture, Hide, print_hr, print_info
+from .exc import RunAborted, RunError
+from .result import Result
+from .streams import get_buffer, get_forwarder, get_output
+
+
+__all__ = ['Agent', 'AgentPool', 'agent_pool']
+
+
+# Request ID, JSON message size, body size; see agent_server.py
+HEADER = struct.Struct('!III')
+
+SERVER_PATH = os.path.join(os.path.dirname(__file__), 'agent_server.py')
+
+# Reads the server's source from stdin and runs it. The rest of stdin
+# is then used for the protocol.
+BOOTSTRAP = (
+    "import sys; "
+    "exec(compile(sys.stdin.buffer.read({size}), 'taskrunner-agent', 'exec'))")
+
+
+def get_server_source():
+    with open(SERVER_PATH, 'rb') as fp:
+        return fp.read()
+
+
+class Agent:
+
+    """Client for a taskrunner agent running on a (remote) host.
+
+    The agent is a small, stdlib-only Python program (see
+    ``agent_server.py``) that's bootstrapped with ``python3 -c`` over
+    an ssh connection (or any other command that connects stdin and
+    stdout to it). Its source is sent over stdin, so nothing needs to
+    be installed on the host.
+
+    Requests and responses are framed messages: a fixed size header
+    with the request ID and the sizes of a JSON message and a raw body.
+    Each request is handled in its own thread by the agent, so several
+    commands can run at once over the same connection (e.g., from
+    different threads here). Command output is streamed back in chunks
+    as it's produced.
+
+    For testing, :meth:`local` starts an agent as a local subprocess.
+
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = None
+        self.closed = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._channels = {}
+        self._next_id = 1
+        self._reader = None
+
+    @classmethod
+    def over_ssh(cls, ssh_cmd, python='python3'):
+        """Create an agent that's started with ``ssh_cmd``.
+
+        ``ssh_cmd`` should be the ssh command up to and including the
+        destination.
+
+        """
+        source = get_server_source()
+        bootstrap = BOOTSTRAP.format(size=len(source))
+        remote_cmd = ' '.join((python, '-u', '-c', shlex.quote(bootstrap)))
+        return cls(ssh_cmd + [remote_cmd])
+
+    @classmethod
+    def local(cls, python=sys.executable):
+        """Create an agent that runs as a local subprocess."""
+        source = get_server_source()
+        return cls([python, '-u', '-c', BOOTSTRAP.format(size=len(source))])
+
+    def start(self):
+        try:
+            self.proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE)
+            self.proc.stdin.write(get_server_source())
+            self.proc.stdin.flush()
+            _, message, _ = self._read_frame()
+        except (OSError, EOFError, ValueError):
+            self._terminate()
+            raise RunAborted('Could not start agent: {cmd}'.format(cmd=' '.join(self.cmd)))
+        if message.get('type') != 'ready':
+            self._terminate()
+            raise RunAborted('Agent did not start properly')
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+        return self
+
+    def close(self):
+        if self.proc is None or self.closed:
+            return
+        try:
+            self._send(0, {'op': 'exit'})
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except Exception:
+            self._terminate()
+        self.closed = True
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run(self, cmd, cwd=None, env=None, path=None, input=None, echo=False, hide=None,
+            capture=Capture.full, capture_limit=None, prefix=None):
+        """Run a command via the agent.
+
+        ``cmd`` is a list of args or a string to run with ``/bin/sh``.
+        ``path`` replaces ``$PATH`` for the command; it may contain
+        ``$PATH``, which will be expanded on the agent's host. ``input``
+        may be bytes or the path to a local file.
+
+        Output is shown and captured the same way as with
+        :class:`LocalRunner`.
+
+        Returns a :class:`Result` or raises :class:`RunError`.
+
+        """
+        cmd_str = cmd if isinstance(cmd, str) else ' '.join(cmd)
+        if isinstance(cmd, str):
+            cmd = ['/bin/sh', '-c', cmd]
+
+        hide = Hide(hide) if hide is not None else Hide.none
+        capture = Capture(capture) if capture is not None else Capture.full
+
+        if hide in (Hide.stdout, Hide.all):
+            echo = False
+
+        if isinstance(input, str):
+            with open(input, 'rb') as fp:
+                input = fp.read()
+        elif input is not None and not isinstance(input, (bytes, bytearray)):
+            raise RunAborted('Input for agent commands must be bytes or a file path')
+
+        if echo:
+            print_hr()
+            print_info('RUNNING:', cmd_str)
+            if cwd:
+                print_info('    CWD:', cwd)
+            if path:
+                print_info('   PATH:', path)
+            print_hr()
+
+        buffers = {
+            'stdout': get_buffer(capture, capture_limit),
+            'stderr': get_buffer(capture, capture_limit),
+        }
+        consoles = {'stdout': sys.stdout, 'stderr': sys.stderr}
+        forwarders = {
+            name: get_forwarder(consoles[name], prefix) for name in consoles
+            if hide not in (Hide(name), Hide.all)}
+
+        message = {'op': 'run', 'cmd': cmd, 'cwd': cwd, 'env': env, 'path': path}
+        request_id, channel = self._request(message, input or b'')
+        return_code = None
+        try:
+            for message, body in self._iter_channel(channel):
+                kind = message.get('type')
+                if kind in buffers:
+                    buffers[kind].write(body)
+                    if kind in forwarders:
+                        forwarders[kind].write(body)
+                elif kind == 'exit':
+                    return_code = message['return_code']
+                    if message.get('error'):
+                        raise RunAborted('Could not run command: {error}'.format(
+                            error=message['error']))
+                    break
+        except BaseException:
+            if return_code is None and not self.closed:
+                self._send(0, {'op': 'kill', 'id': request_id})
+            raise
+        finally:
+            self._release(request_id)
+            for forwarder in forwarders.values():
+                forwarder.close()
+
+        out = get_output(buffers['stdout'])
+        err = get_output(buffers['stderr'])
+
+        if return_code:
+            raise RunError(return_code, out, err)
+
+        return Result(return_code, out, err)
+
+    def read_file(self, path):
+        """Read a file on the agent's host."""
+        return self.call('read_file', path=path)[1]
+
+    def write_file(self, path, data, mode=None):
+        """Write a file on the agent's host (atomically)."""
+        self.call('write_file', data, path=path, mode=mode)
+
+    def environ(self):
+        """Get the agent's environment."""
+        return self.call('env')[0]['env']
+
+    def call(self, op, body=b'', chunks=None, **params):
+        """Make a request that has a single response.
+
+        If ``chunks`` is passed, it's streamed to the agent in separate
+        frames after the request, so it isn't limited to the max frame
+        size and doesn't need to be held in memory. Streaming stops
+        early if the agent responds before it's done.
+
+        Returns the response's message and body.
+
+        """
+        params['op'] = op
+        if chunks is not None:
+            params['stream'] = True
+        request_id, channel = self._request(params, body)
+        try:
+            if chunks is not None:
+                self._stream(request_id, channel, chunks)
+            for message, body in self._iter_channel(channel):
+                return message, body
+        finally:
+            self._release(request_id)
+
+    def _iter_channel(self, channel):
+        while True:
+            response = channel.get()
+            if response is None:
+                raise RunAborted('Lost connection to agent')
+            message, body = response
+            if message.get('type') == 'error':
+                raise RunAborted('Agent error: {message}'.format(message=message['message']))
+            yield message, body
+
+    def _request(self, message, body=b''):
+        if self.closed:
+            raise RunAborted('Agent is closed')
+        channel = queue.Queue()
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._channels[request_id] = channel
+        try:
+            self._send(request_id, message, body)
+        except OSError:
+            self._release(request_id)
+            raise RunAborted('Lost connection to agent')
+        return request_id, channel
+
+    def _stream(self, request_id, channel, chunks):
+        # If getting the chunks fails, the agent is told that the input
+        # is incomplete so the request doesn't wait for the rest.
+        end = {'op': 'chunk', 'end': True}
+        try:
+            for chunk in chunks:
+                if not channel.empty():
+                    # The agent has already responded (e.g., with an
+                    # error), so it doesn't need the rest.
+                    return
+                if chunk:
+                    try:
+                        self._send(request_id, {'op': 'chunk'}, chunk)
+                    except OSError:
+                        raise RunAborted('Lost connection to agent')
+        except RunAborted:
+            raise
+        except BaseException:
+            end['error'] = True
+            raise
+        finally:
+            try:
+                self._send(request_id, end)
+            except OSError:
+                # The lost connection is reported while waiting for the
+                # response.
+                pass
+
+    def _release(self, request_id):
+        with self._lock:
+            self._channels.pop(request_id, None)
+
+    def _send(self, request_id, message, body=b''):
+        data = json.dumps(message).encode('utf-8')
+        with self._write_lock:
+            stdin = self.proc.stdin
+            stdin.write(HEADER.pack(request_id, len(data), len(body)))
+            stdin.write(data)
+            if body:
+                stdin.write(body)
+            stdin.flush()
+
+    def _read_exactly(self, size):
+        data = self.proc.stdout.read(size)
+        if len(data) != size:
+            raise EOFError
+        return data
+
+    def _read_frame(self):
+        request_id, message_size, body_size = HEADER.unpack(self._read_exactly(HEADER.size))
+        message = json.loads(self._read_exactly(message_size).decode('utf-8'))
+        body = self._read_exactly(body_size) if body_size else b''
+        return request_id, message, body
+
+    def _read_responses(self):
+        # Dispatch responses to the channels of their requests. When the
+        # connection is lost, all the waiting requests are woken up.
+        try:
+            while True:
+                request_id, message, body = self._read_frame()
+                with self._lock:
+                    channel = self._channels.get(request_id)
+                if channel is not None:
+                    channel.put((message, body))
+        except (OSError, EOFError, ValueError):
+            pass
+        self.closed = True
+        with self._lock:
+            channels = list(self._channels.values())
+        for channel in channels:
+            channel.put(None)
+
+    def _terminate(self):
+        self.closed = True
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class AgentPool:
+
+    """Agents shared by all remote commands, one per destination.
+
+    Agents are started on first use and closed when the process exits.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._agents = {}
+        self._registered = False
+
+    def get(self, destination, ssh_cmd, python='python3'):
+        """Get the agent for ``destination``, starting it if needed."""
+        key = (destination, python)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+            if not self._registered:
+                atexit.register(self.close)
+                self._registered = True
+        with lock:
+            agent = self._agents.get(key)
+            if agent is None or agent.closed:
+                agent = Agent.over_ssh(ssh_cmd, python).start()
+                self._agents[key] = agent
+        return agent
+
+    def close(self):
+        with self._lock:
+            agents, self._agents = list(self._agents.values()), {}
+        for agent in agents:
+            agent.close()
+
+
+agent_pool = AgentPool()
@@ -0,0 +1,331 @@
+# Remote side of the taskrunner agent (see agent.py).
+#
+# This module is sent to the remote host and run with ``python3 -c``,
+# so it must be self-contained and only use the standard library. It
+# reads framed requests from stdin and writes framed responses to
+# stdout.
+#
+# Each frame is a header (request ID, JSON length, body length) followed
+# by a JSON message and a raw body. Requests are handled concurrently in
+# separate threads; responses for different requests may be interleaved
+# but each frame is written atomically.
+#
+# A request with ``stream`` set is followed by ``chunk`` frames with the
+# same request ID carrying its input, the last of which has ``end`` set.
+import hashlib
+import json
+import os
+import queue
+import struct
+import subprocess
+import sys
+import threading
+import traceback
+import zlib
+
+
+HEADER = struct.Struct('!III')
+
+READ_SIZE = 64 * 1024
+
+COPY_SIZE = 1024 * 1024
+
+# Max number of streamed chunks waiting to be handled for a request
+STREAM_QUEUE_SIZE = 16
+
+# Block signature: weak (Adler-32) checksum, strong checksum, anchor
+# (the first bytes of the block)
+ANCHOR_SIZE = 8
+BLOCK = struct.Struct('!I16s{}s'.format(ANCHOR_SIZE))
+
+# Delta instructions: copy blocks (start, count); data (size)
+COPY = struct.Struct('!cII')
+DATA = struct.Struct('!cI')
+
+
+class Server:
+
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.write_lock = threading.Lock()
+        self.procs = {}
+        self.inputs = {}
+
+    def send(self, request_id, message, body=b''):
+        data = json.dumps(message).encode('utf-8')
+        with self.write_lock:
+            self.stdout.write(HEADER.pack(request_id, len(data), len(body)))
+            self.stdout.write(data)
+            if body:
+                self.stdout.write(body)
+            self.stdout.flush()
+
+    def read_exactly(self, size):
+        data = self.stdin.read(size)
+        if len(data) != size:
+            raise EOFError
+        return data
+
+    def read_frame(self):
+        request_id, message_size, body_size = HEADER.unpack(self.read_exactly(HEADER.size))
+        message = json.loads(self.read_exactly(message_size).decode('utf-8'))
+        body = self.read_exactly(body_size) if body_size else b''
+        return request_id, message, body
+
+    def serve(self):
+        self.send(0, {'type': 'ready', 'pid': os.getpid()})
+        while True:
+            try:
+                request_id, message, body = self.read_frame()
+            except EOFError:
+                break
+            op = message.get('op')
+            if op == 'exit':
+                break
+            if op == 'kill':
+                proc = self.procs.get(message.get('id'))
+                if proc is not None and proc.poll() is None:
+                    proc.kill()
+                continue
+            if op == 'chunk':
+                # Chunks for a request that has already finished (e.g.,
+                # because it failed) are dropped.
+                chunks = self.inputs.get(request_id)
+                if chunks is None:
+                    pass
+                elif message.get('error'):
+                    chunks.put(EOFError('The input was not completed'))
+                elif message.get('end'):
+                    chunks.put(None)
+                else:
+                    chunks.put(body)
+                continue
+            handler = getattr(self, 'do_' + str(op), None)
+            if handler is None:
+                message = 'Unknown op: {op}'.format(op=op)
+                self.send(request_id, {'type': 'error', 'message': message})
+                continue
+            if message.get('stream'):
+                self.inputs[request_id] = queue.Queue(STREAM_QUEUE_SIZE)
+            thread = threading.Thread(
+                target=self.handle, args=(handler, request_id, message, body))
+            thread.daemon = True
+            thread.start()
+        for proc in list(self.procs.values()):
+            if proc.poll() is None:
+                proc.kill()
+
+    def handle(self, handler, request_id, message, body):
+        try:
+            handler(request_id, message, body)
+        except Exception as exc:
+            self.send(request_id, {
+                'type': 'error',
+                'message': '{name}: {exc}'.format(name=exc.__class__.__name__, exc=exc),
+                'traceback': traceback.format_exc(),
+            })
+        finally:
+            chunks = self.inputs.pop(request_id, None)
+            if chunks is not None:
+                # Make room in case the reader is waiting to add a chunk
+                # that was received before the input was removed.
+                while not chunks.empty():
+                    chunks.get_nowait()
+
+    def iter_input(self, request_id):
+        chunks = self.inputs[request_id]
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def do_run(self, request_id, message, body):
+        env = os.environ.copy()
+        env.update(message.get('env') or {})
+        path = message.get('path')
+        if path:
+            env['PATH'] = path.replace('$PATH', os.environ.get('PATH', ''))
+        try:
+            proc = subprocess.Popen(
+                message['cmd'], cwd=message.get('cwd') or None, env=env, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as exc:
+            self.send(request_id, {'type': 'exit', 'return_code': 127, 'error': str(exc)})
+            return
+        self.procs[request_id] = proc
+        readers = []
+        for name in ('stdout', 'stderr'):
+            reader = threading.Thread(
+                target=self.forward, args=(request_id, name, getattr(proc, name)))
+            reader.daemon = True
+            reader.start()
+            readers.append(reader)
+        try:
+            if body:
+                proc.stdin.write(body)
+        except (BrokenPipeError, OSError):
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+        for reader in readers:
+            reader.join()
+        return_code = proc.wait()
+        del self.procs[request_id]
+        self.send(request_id, {'type': 'exit', 'return_code': return_code})
+
+    def forward(self, request_id, name, file):
+        fd = file.fileno()
+        while True:
+            chunk = os.read(fd, READ_SIZE)
+            if not chunk:
+                break
+            self.send(request_id, {'type': name}, chunk)
+        file.close()
+
+    def do_read_file(self, request_id, message, body):
+        with open(message['path'], 'rb') as fp:
+            data = fp.read()
+        self.send(request_id, {'type': 'result'}, data)
+
+    def do_write_file(self, request_id, message, body):
+        path = message['path']
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = '{path}.taskrunner-{request_id}'.format(path=path, request_id=request_id)
+        with open(temp_path, 'wb') as fp:
+            fp.write(body)
+        mode = message.get('mode')
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.rename(temp_path, path)
+        self.send(request_id, {'type': 'result', 'size': len(body)})
+
+    def do_env(self, request_id, message, body):
+        self.send(request_id, {'type': 'result', 'env': dict(os.environ)})
+
+    def do_remove(self, request_id, message, body):
+        try:
+            os.remove(message['path'])
+        except FileNotFoundError:
+            pass
+        self.send(request_id, {'type': 'result'})
+
+    def do_chmod(self, request_id, message, body):
+        os.chmod(message['path'], message['mode'])
+        self.send(request_id, {'type': 'result'})
+
+    def do_signature(self, request_id, message, body):
+        # Signatures of the full blocks of a file, used to build a delta
+        # against it (a partial last block is never matched).
+        path = message['path']
+        block_size = message['block_size']
+        if not os.path.isfile(path):
+            self.send(request_id, {'type': 'result', 'exists': False})
+            return
+        blocks = []
+        file_hash = hashlib.sha256()
+        mode = os.stat(path).st_mode & 0o7777
+        with open(path, 'rb') as fp:
+            while True:
+                block = fp.read(block_size)
+                if not block:
+                    break
+                file_hash.update(block)
+                if len(block) == block_size:
+                    strong = hashlib.blake2b(block, digest_size=16).digest()
+                    blocks.append(BLOCK.pack(zlib.adler32(block), strong, block[:ANCHOR_SIZE]))
+        self.send(request_id, {
+            'type': 'result',
+            'exists': True,
+            'mode': mode,
+            'sha256': file_hash.hexdigest(),
+        }, b''.join(blocks))
+
+    def do_patch(self, request_id, message, body):
+        # Rebuild a file from the existing file and a compressed delta,
+        # which is streamed in chunks.
+        path = message['path']
+        block_size = message['block_size']
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = '{path}.taskrunner-{request_id}'.format(path=path, request_id=request_id)
+        file_hash = hashlib.sha256()
+        decompressor = zlib.decompressobj()
+        delta = bytearray()
+        old = open(path, 'rb') if os.path.isfile(path) else None
+        try:
+            with open(temp_path, 'wb') as fp:
+                for chunk in self.iter_input(request_id):
+                    delta += decompressor.decompress(chunk)
+                    pos = self.apply_delta(delta, old, block_size, fp, file_hash)
+                    del delta[:pos]
+            if delta or not decompressor.eof:
+                raise ValueError('Incomplete delta for {path}'.format(path=path))
+            if file_hash.hexdigest() != message['sha256']:
+                raise ValueError('Checksum mismatch after patching {path}'.format(path=path))
+            mode = message.get('mode')
+            if mode is not None:
+                os.chmod(temp_path, mode)
+            os.rename(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            if old is not None:
+                old.close()
+        self.send(request_id, {'type': 'result'})
+
+    def apply_delta(self, delta, old, block_size, fp, file_hash):
+        # Apply the complete instructions at the start of the delta and
+        # return where the first incomplete one starts.
+        pos = 0
+        while True:
+            if delta[pos:pos + 1] == b'C':
+                if len(delta) - pos < COPY.size:
+                    return pos
+                _, start, count = COPY.unpack_from(delta, pos)
+                pos += COPY.size
+                old.seek(start * block_size)
+                remaining = count * block_size
+                while remaining:
+                    data = old.read(min(remaining, COPY_SIZE))
+                    if not data:
+                        raise ValueError('Delta refers to blocks past the end of the file')
+                    file_hash.update(data)
+                    fp.write(data)
+                    remaining -= len(data)
+            else:
+                if len(delta) - pos < DATA.size:
+                    return pos
+                _, size = DATA.unpack_from(delta, pos)
+                if len(delta) - pos - DATA.size < size:
+                    return pos
+                pos += DATA.size
+                data = delta[pos:pos + size]
+                pos += size
+                file_hash.update(data)
+                fp.write(data)
+
+
+def main():
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    # Anything that writes to fd 1 directly would corrupt the protocol,
+    # so stdout is moved to a new fd and fd 1 is pointed at stderr.
+    stdout = os.fdopen(os.dup(stdout.fileno()), 'wb')
+    os.dup2(2, 1)
+    Server(stdin, stdout).serve()
+
+
+if __name__ == '__main__':
+    main()
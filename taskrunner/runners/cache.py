@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from .result import Result
+
+
+__all__ = ['ResultCache', 'result_cache']
+
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+# magic, created time, return code, stdout size, stderr size
+HEADER = struct.Struct('!4sdiQQ')
+
+MAGIC = b'TRC1'
+
+HASH_READ_SIZE = 1024 * 1024
+
+
+def get_default_directory():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'taskrunner', 'results')
+
+
+class ResultCache:
+
+    """Cache results of commands on disk.
+
+    Results are keyed by a hash of everything that could affect the
+    output of a command (see :meth:`make_key`). Only successful results
+    should be cached.
+
+    Each entry is a small binary header followed by the command's raw
+    stdout and stderr. Entries are written atomically, so the cache can
+    be shared by concurrent runs. Reading an entry touches it, and when
+    the cache grows past ``max_size`` bytes, the least recently used
+    entries are evicted.
+
+    The default location is ``$XDG_CACHE_HOME/taskrunner/results``.
+
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory or get_default_directory()
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = None
+        self._file_hashes = {}
+
+    def make_key(self, *parts, env=None, inputs=()):
+        """Make a cache key.
+
+        Args:
+            parts: Anything that can be JSON-encoded (e.g., the kind of
+                command, the command itself, and its cwd)
+            env (dict): Environment variables that affect the command
+            inputs (list): Input files or directories; their contents
+                are included in the key
+
+        """
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(parts, sort_keys=True, default=str).encode())
+        hasher.update(json.dumps(sorted((env or {}).items())).encode())
+        for path in inputs:
+            hasher.update(path.encode())
+            hasher.update(self.hash_path(path))
+        return hasher.hexdigest()
+
+    def hash_path(self, path):
+        """Hash the contents of a file or of all the files in a dir."""
+        if os.path.isdir(path):
+            hasher = hashlib.sha256()
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for name in sorted(file_names):
+                    file_path = os.path.join(dir_path, name)
+                    hasher.update(os.path.relpath(file_path, path).encode())
+                    hasher.update(self.hash_file(file_path))
+            return hasher.digest()
+        return self.hash_file(path)
+
+    def hash_file(self, path):
+        # Hashes are remembered for as long as the file's stat info is
+        # unchanged, so repeated lookups don't read the file again.
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return b'missing'
+        stat_key = (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        digest = self._file_hashes.get(stat_key)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(HASH_READ_SIZE), b''):
+                    hasher.update(chunk)
+            digest = hasher.digest()
+            self._file_hashes[stat_key] = digest
+        return digest
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, ttl=None):
+        """Get the cached result for ``key``.
+
+        Returns ``None`` if there's no entry or if the entry is older
+        than ``ttl`` seconds.
+
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return None
+        try:
+            magic, created, return_code, out_size, err_size = HEADER.unpack_from(data)
+        except struct.error:
+            magic = None
+        if magic != MAGIC or len(data) != HEADER.size + out_size + err_size:
+            self._remove(path)
+            return None
+        if ttl is not None and time.time() - created > ttl:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        out_end = HEADER.size + out_size
+        return Result(return_code, data[HEADER.size:out_end], data[out_end:])
+
+    def put(self, key, result):
+        """Add ``result`` to the cache."""
+        out, err = bytes(result.stdout_bytes), bytes(result.stderr_bytes)
+        header = HEADER.pack(MAGIC, time.time(), result.return_code, len(out), len(err))
+        size = len(header) + len(out) + len(err)
+        if size > self.max_size:
+            return
+        path = self.get_path(key)
+        dir_path = os.path.dirname(path)
+        os.makedirs(dir_path, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(header)
+                fp.write(out)
+                fp.write(err)
+            os.replace(temp_path, path)
+        except BaseException:
+            self._remove(temp_path)
+            raise
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries if the cache is too big."""
+        with self._lock:
+            if self._size is not None and self._size <= self.max_size:
+                return
+            entries = []
+            for dir_path, _, file_names in os.walk(self.directory):
+                for name in file_names:
+                    if name.startswith('.tmp-'):
+                        continue
+                    path = os.path.join(dir_path, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            size = sum(entry[1] for entry in entries)
+            if size > self.max_size:
+                # Evict down to 90% of max size so that eviction isn't
+                # triggered again by the next put.
+                target = self.max_size * 0.9
+                for _, entry_size, path in sorted(entries):
+                    if size <= target:
+                        break
+                    self._remove(path)
+                    size -= entry_size
+            self._size = size
+
+    def clear(self):
+        with self._lock:
+            for dir_path, _, file_names in os.walk(self.directory):
+                for name in file_names:
+                    self._remove(os.path.join(dir_path, name))
+            self._size = 0
+            self._file_hashes.clear()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+result_cache = ResultCache()
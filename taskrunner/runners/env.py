@@ -0,0 +1,105 @@
+import os
+import shutil
+import threading
+
+from ..util import abs_path, as_tuple
+
+
+class EnvCache:
+
+    """Cache environments and executable lookups for a run.
+
+    Resolving ``bin.dirs``, building a modified ``$PATH``, and searching
+    ``$PATH`` for an executable all involve repeated file system probing
+    and string building, so they're done once per distinct input and
+    reused for the rest of the run.
+
+    - ``bin.dirs`` are resolved once per config object. Dirs that
+      didn't exist when first resolved are checked again on each call
+      so that dirs created during a run (e.g., a virtualenv) are
+      picked up.
+    - The ``$PATH`` for each combination of path options is computed
+      once (per base ``$PATH``). Environments themselves are built from
+      the live :data:`os.environ` on each call, so changes a task makes
+      to :data:`os.environ` are seen by the commands it runs later.
+    - Executables are keyed by name and effective ``$PATH``. A cached
+      executable that has since been removed is looked up again.
+
+    :meth:`clear` is called at the start of each :meth:`TaskRunner.run`.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._bin_dirs = {}
+            self._paths = {}
+            self._executables = {}
+
+    def get_bin_dirs(self, config):
+        """Get the ``bin.dirs`` from ``config`` that exist."""
+        dirs = as_tuple(config._get_dotted('bin.dirs', []))
+        key = (id(config), dirs, os.getcwd())
+        with self._lock:
+            entry = self._bin_dirs.get(key)
+            if entry is None:
+                # The config is kept in the entry so its ID can't be reused.
+                paths = [abs_path(d, format_kwargs=config) for d in dirs]
+                entry = (config, [[p, os.path.isdir(p)] for p in paths])
+                self._bin_dirs[key] = entry
+            else:
+                for item in entry[1]:
+                    if not item[1]:
+                        item[1] = os.path.isdir(item[0])
+            return [p for (p, exists) in entry[1] if exists]
+
+    def get_env(self, path=None, prepend_path=None, append_path=None, extra=None):
+        """Get environment for the specified ``$PATH`` options.
+
+        Returns a tuple of ``(env, path)``. If no options are passed,
+        the env will be ``None``, meaning the current environment
+        should be inherited as is.
+
+        """
+        if not (path or prepend_path or append_path or extra):
+            return None, None
+
+        env = os.environ.copy()
+        new_path = None
+
+        if path or prepend_path or append_path:
+            key = (path, prepend_path, append_path, env.get('PATH'))
+            with self._lock:
+                new_path = self._paths.get(key)
+                if new_path is None:
+                    new_path = [path] if path else [env.get('PATH', os.defpath)]
+                    if prepend_path:
+                        new_path = [prepend_path] + new_path
+                    if append_path:
+                        new_path = new_path + [append_path]
+                    new_path = ':'.join(new_path)
+                    self._paths[key] = new_path
+            env['PATH'] = new_path
+
+        if extra:
+            env.update(extra)
+        return env, new_path
+
+    def which(self, exe, path=None):
+        """Get the absolute path to ``exe`` on ``path``."""
+        if os.path.dirname(exe):
+            return shutil.which(exe, path=path)
+        key = (exe, path)
+        executable = self._executables.get(key)
+        if executable is None or not os.access(executable, os.X_OK):
+            executable = shutil.which(exe, path=path)
+            if executable is not None:
+                with self._lock:
+                    self._executables[key] = executable
+        return executable
+
+
+env_cache = EnvCache()
@@ -1,4 +1,4 @@
-from .result import Result
+from .result import BaseResult
 
 
 class RunAborted(Exception):
@@ -7,7 +7,12 @@ class RunAborted(Exception):
         self.why = why
 
 
-class RunError(Exception, Result):
+class RunError(Exception, BaseResult):
     def __init__(self, return_code, stdout, stderr):
         super().__init__('Exited with return code {}'.format(return_code))
-        Result.__init__(self, return_code, stdout, stderr)
+        BaseResult.__init__(self, return_code, stdout, stderr)
+
+    def __reduce__(self):
+        # Exceptions are pickled with their message as the only arg by
+        # default, which doesn't match __init__.
+        return self.__class__, (self.return_code, self._stdout, self._stderr), vars(self)
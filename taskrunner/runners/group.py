@@ -0,0 +1,69 @@
+import threading
+from contextlib import contextmanager
+
+
+class ProcessGroup:
+
+    """Track processes started by runners so they can be killed together.
+
+    A group is activated per thread. While a group is active, the
+    processes started by :class:`LocalRunner` and
+    :class:`PipelineRunner` in that thread are added to it::
+
+        group = ProcessGroup()
+        with group.activate():
+            local(config, 'sleep 60')
+
+        # In another thread
+        group.kill()
+
+    Processes started after the group has been killed are killed right
+    away.
+
+    """
+
+    _local = threading.local()
+
+    def __init__(self):
+        self.killed = False
+        self._lock = threading.Lock()
+        self._procs = set()
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'group', None)
+
+    @contextmanager
+    def activate(self):
+        previous = self.current()
+        self._local.group = self
+        try:
+            yield self
+        finally:
+            self._local.group = previous
+
+    def add(self, proc):
+        with self._lock:
+            self._procs.add(proc)
+            killed = self.killed
+        if killed:
+            proc.kill()
+
+    def discard(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def kill(self):
+        with self._lock:
+            self.killed = True
+            procs = list(self._procs)
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+
+
+def add_to_current_group(proc):
+    group = ProcessGroup.current()
+    if group is not None:
+        group.add(proc)
+    return group
@@ -0,0 +1,213 @@
+import os
+import platform
+import resource
+
+from ..util import as_list
+
+
+__all__ = ['ProcessLimits']
+
+
+# ioprio_set(2) isn't exposed by the os module, so it's called via
+# syscall(2); the syscall number depends on the architecture.
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    'riscv64': 30,
+    's390x': 282,
+}
+
+IOPRIO_CLASSES = {
+    'none': 0,
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+
+IOPRIO_CLASS_SHIFT = 13
+
+IOPRIO_WHO_PROCESS = 1
+
+RLIMITS = {
+    'as': 'RLIMIT_AS',
+    'cpu': 'RLIMIT_CPU',
+    'nofile': 'RLIMIT_NOFILE',
+}
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def _load_ioprio_set():
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if number is None or not platform.system() == 'Linux':
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        syscall = libc.syscall
+    except (AttributeError, ImportError, OSError):
+        return None
+
+    def ioprio_set(pid, prio):
+        result = syscall(number, IOPRIO_WHO_PROCESS, pid, prio)
+        if result == -1:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    return ioprio_set
+
+
+_ioprio_set = _load_ioprio_set()
+
+
+class ProcessLimits:
+
+    """Scheduling options and resource limits for a child process.
+
+    These are applied to the command by its pid right after it's
+    started (see :meth:`apply`), so they only affect the command and
+    anything it starts afterwards. Nothing runs in the child between
+    fork and exec, so this is safe to use while other threads are
+    running, and :mod:`subprocess` can still use ``posix_spawn()``.
+
+    - ``cpu_affinity``: CPUs the command may run on, as a set of CPU
+      numbers or a string like "0-3,6"
+    - ``nice``: Increment to the command's nice level
+    - ``ionice``: I/O scheduling class and, optionally, priority level
+      (0-7), as a string like "idle" or "best-effort:7" or a tuple like
+      ``('best-effort', 7)``; Linux only
+    - ``rlimits``: Resource limits as a dict or a string like
+      "as=2G,cpu=60,nofile=1024"; the supported limits are "as"
+      (address space in bytes; K, M, G, and T suffixes are allowed),
+      "cpu" (CPU seconds), and "nofile" (open files); each value may
+      be a single limit (used as both the soft and hard limit) or a
+      ``(soft, hard)`` pair
+
+    Options are validated up front so that mistakes are reported in
+    this process instead of failing in the child.
+
+    """
+
+    def __init__(self, cpu_affinity=None, nice=None, ionice=None, rlimits=None):
+        self.cpu_affinity = self.parse_cpu_affinity(cpu_affinity)
+        self.nice = int(nice) if nice not in (None, '') else None
+        self.ionice = self.parse_ionice(ionice)
+        self.rlimits = self.parse_rlimits(rlimits)
+
+    def __bool__(self):
+        return any(option is not None for option in (
+            self.cpu_affinity, self.nice, self.ionice, self.rlimits))
+
+    def apply(self, pid):
+        """Apply the limits to the process with ``pid``.
+
+        The nice level is relative to this process's. If the process
+        has already exited, this does nothing. Raises :class:`OSError`
+        if the limits can't be applied (e.g., when raising a hard limit
+        without permission).
+
+        """
+        try:
+            if self.cpu_affinity is not None:
+                os.sched_setaffinity(pid, self.cpu_affinity)
+            if self.nice is not None:
+                priority = os.getpriority(os.PRIO_PROCESS, 0) + self.nice
+                os.setpriority(os.PRIO_PROCESS, pid, priority)
+            if self.ionice is not None:
+                _ioprio_set(pid, self.ionice)
+            if self.rlimits is not None:
+                for which, limits in self.rlimits:
+                    resource.prlimit(pid, which, limits)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def parse_cpu_affinity(cpus):
+        if cpus is None or cpus == '':
+            return None
+        if not hasattr(os, 'sched_setaffinity'):
+            raise ValueError('CPU affinity is not supported on this platform')
+        if isinstance(cpus, int):
+            cpus = [cpus]
+        parsed = set()
+        for item in as_list(cpus):
+            if isinstance(item, int):
+                parsed.add(item)
+                continue
+            start, _, end = str(item).partition('-')
+            try:
+                start = int(start)
+                end = int(end) if end else start
+            except ValueError:
+                raise ValueError('Bad CPU affinity: {cpus}'.format(cpus=cpus))
+            parsed.update(range(start, end + 1))
+        if not parsed:
+            raise ValueError('Bad CPU affinity: {cpus}'.format(cpus=cpus))
+        return frozenset(parsed)
+
+    @staticmethod
+    def parse_ionice(ionice):
+        if ionice is None or ionice == '':
+            return None
+        if _ioprio_set is None:
+            raise ValueError('I/O priority is not supported on this platform')
+        if isinstance(ionice, str):
+            ionice_class, _, level = ionice.partition(':')
+        else:
+            ionice_class, level = (tuple(ionice) + (None,))[:2]
+        ionice_class = str(ionice_class).strip().replace('_', '-')
+        if ionice_class not in IOPRIO_CLASSES:
+            raise ValueError('Unknown I/O priority class: {ionice_class}'.format(
+                ionice_class=ionice_class))
+        level = int(level) if level not in (None, '') else 4
+        if not 0 <= level <= 7:
+            raise ValueError('I/O priority level must be from 0 to 7')
+        if ionice_class in ('none', 'idle'):
+            level = 0
+        return (IOPRIO_CLASSES[ionice_class] << IOPRIO_CLASS_SHIFT) | level
+
+    @classmethod
+    def parse_rlimits(cls, rlimits):
+        if not rlimits:
+            return None
+        if not hasattr(resource, 'prlimit'):
+            raise ValueError('Resource limits are not supported on this platform')
+        if isinstance(rlimits, str):
+            items = []
+            for item in as_list(rlimits):
+                name, sep, value = item.partition('=')
+                if not sep:
+                    raise ValueError('Bad resource limit: {item}'.format(item=item))
+                items.append((name.strip(), value.strip()))
+        else:
+            items = rlimits.items()
+        parsed = []
+        for name, value in items:
+            if name not in RLIMITS:
+                raise ValueError('Unknown resource limit: {name}'.format(name=name))
+            if isinstance(value, (list, tuple)):
+                soft, hard = value
+            else:
+                soft = hard = value
+            soft, hard = cls.parse_rlimit_value(soft), cls.parse_rlimit_value(hard)
+            parsed.append((getattr(resource, RLIMITS[name]), (soft, hard)))
+        return tuple(parsed)
+
+    @staticmethod
+    def parse_rlimit_value(value):
+        if value is None or value in ('unlimited', 'infinity'):
+            return resource.RLIM_INFINITY
+        if isinstance(value, str):
+            value = value.strip()
+            multiplier = SIZE_SUFFIXES.get(value[-1:].upper(), 1)
+            if multiplier != 1:
+                value = value[:-1]
+            try:
+                return int(float(value) * multiplier)
+            except ValueError:
+                raise ValueError('Bad resource limit value: {value}'.format(value=value))
+        return int(value)
@@ -1,50 +1,164 @@
 import os
 import shlex
 import sys
-from subprocess import PIPE, Popen
+import time
+from subprocess import PIPE, Popen, TimeoutExpired
 
-from ..util import Hide, print_info, print_hr
+from ..jobserver import get_jobserver
+from ..util import Capture, Hide, print_info, print_hr
 from .base import Runner
+from .env import env_cache
 from .exc import RunAborted, RunError
+from .group import add_to_current_group
+from .limits import ProcessLimits
 from .result import Result
+from .streams import (
+    Input, KernelTee, StreamingRun, get_buffer, get_console_fd, get_forwarder, get_output, pump)
 
 
-class LocalRunner(Runner):
+# Characters that need a shell to be interpreted. Quotes aren't included
+# because shlex handles them the same way the shell does.
+SHELL_CHARS = frozenset('|&;<>()$`\\*?[]{}#~!\n')
+
+# Builtins and keywords that don't have an executable equivalent (or
+# that wouldn't have the intended effect if run as a separate process).
+SHELL_BUILTINS = frozenset((
+    '.', ':', 'alias', 'bg', 'break', 'builtin', 'case', 'cd', 'command', 'continue', 'declare',
+    'dirs', 'disown', 'eval', 'exec', 'exit', 'export', 'fg', 'for', 'function', 'getopts',
+    'hash', 'if', 'jobs', 'let', 'local', 'popd', 'pushd', 'read', 'readonly', 'return', 'select',
+    'set', 'shift', 'shopt', 'source', 'time', 'times', 'trap', 'type', 'typeset', 'ulimit',
+    'umask', 'unalias', 'unset', 'until', 'wait', 'while',
+))
+
+
+def split_simple_command(cmd):
+    """Split ``cmd`` into args if it can be run without a shell.
+
+    Returns ``None`` if ``cmd`` uses shell syntax (pipes, redirects,
+    variables, globs, etc), starts with a variable assignment or
+    builtin, or can't be parsed.
+
+    """
+    if SHELL_CHARS.intersection(cmd):
+        return None
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not args or '=' in args[0] or args[0] in SHELL_BUILTINS:
+        return None
+    return args
+
 
-    """Run a command on the local host."""
+def resolve_command(cmd, env=None, cwd=None):
+    """Figure out how to launch ``cmd`` with :class:`Popen`.
 
-    def run(self, cmd, cd=None, path=None, prepend_path=None, append_path=None, echo=False,
-            hide=None, timeout=None, debug=False):
+    Returns a tuple of ``(cmd, executable, shell)``. If ``cmd`` can be
+    run without a shell, it will be converted to a list of args and
+    ``executable`` will be the absolute path to its executable. Relative
+    paths to executables (like ``./build.sh``) are relative to ``cwd``,
+    where the command will be run.
+
+    If the executable for a string command can't be found, the command
+    is run via the shell anyway so that it fails the same way it always
+    has (with exit code 127). Raises :class:`RunAborted` if the
+    executable for a list of args can't be found.
+
+    """
+    if isinstance(cmd, str):
+        args = split_simple_command(cmd)
+        if args is None:
+            return cmd, None, True
+    else:
+        args = cmd
+    exe = args[0]
+    if os.path.dirname(exe):
+        exe = os.path.abspath(os.path.join(cwd or os.getcwd(), exe))
+    executable = env_cache.which(exe, path=(env or os.environ).get('PATH'))
+    if executable is None:
         if isinstance(cmd, str):
-            cmd_str = cmd
-            exe = shlex.split(cmd)[0]
-            shell = True
-        else:
-            cmd_str = ' '.join(cmd)
-            exe = cmd[0]
-            shell = False
+            return cmd, None, True
+        raise RunAborted('Command not found: {exe}'.format(exe=args[0]))
+    return args, executable, False
+
+
+class LocalRunner(Runner):
+
+    """Run a command on the local host.
+
+    ``env`` can be used to set extra environment variables for the
+    command. The environment and executable lookups are cached for the
+    run (see :class:`EnvCache`).
+
+    String commands that don't use any shell syntax are split and run
+    directly instead of via ``/bin/sh``. Commands run directly are
+    launched from the executable's absolute path without closing fds
+    so that :mod:`subprocess` can use ``posix_spawn()`` where it's
+    available (when ``cd`` isn't specified).
+
+    Output is forwarded to the console as it's produced (unless it's
+    hidden) and captured according to the ``capture`` policy:
+
+        - full: Capture all output (the default)
+        - head_tail: Capture only the first and last ``capture_limit``
+          / 2 bytes of output
+        - none: Don't capture output
+
+    If ``stream`` is set, a :class:`StreamingRun` will be returned
+    instead of a :class:`Result`. Output won't be forwarded to the
+    console in this case; instead, the caller will iterate over it line
+    by line as it's produced. ``on_failure`` is passed through to the
+    :class:`StreamingRun`.
+
+    ``input`` is fed to the command's stdin; see :class:`Input` for the
+    kinds of input that are accepted.
+
+    ``cpu_affinity``, ``nice``, ``ionice``, and ``rlimits`` are applied
+    to the command by its pid as soon as it's started; see
+    :class:`ProcessLimits`.
+
+    If a jobserver is active (see :class:`JobServer`), it's passed down
+    to the command.
+
+    If ``prefix`` is set, it's added to the start of each line of output
+    shown on the console (see :class:`PrefixForwarder`).
+
+    If ``passthrough`` is set (and ``prefix`` isn't), output that isn't
+    hidden bypasses Python entirely: when ``capture`` is "none", the
+    command inherits this process's stdout and stderr; otherwise, on
+    Linux, output is copied to the console inside the kernel with
+    :class:`KernelTee` and only the captured copy is read by Python.
+
+    """
+
+    def run(self, cmd, cd=None, path=None, prepend_path=None, append_path=None, env=None,
+            echo=False, hide=None, timeout=None, capture=Capture.full, capture_limit=None,
+            stream=False, on_failure=None, passthrough=False, input=None, cpu_affinity=None,
+            nice=None, ionice=None, rlimits=None, prefix=None, debug=False):
+        cmd_str = cmd if isinstance(cmd, str) else ' '.join(cmd)
 
         cwd = os.path.normpath(os.path.abspath(cd)) if cd else None
 
         hide = Hide(hide) if hide is not None else Hide.none
-
-        stdout = stderr = PIPE
+        capture = Capture(capture) if capture is not None else Capture.full
 
         if hide in (Hide.stdout, Hide.all):
             echo = False
 
-        env = None
-        munge_path = path or prepend_path or append_path
+        try:
+            limits = ProcessLimits(cpu_affinity, nice, ionice, rlimits)
+        except ValueError as exc:
+            raise RunAborted(str(exc))
 
-        if munge_path:
-            env = os.environ.copy()
-            path = [path] if path else [env['PATH']]
-            if prepend_path:
-                path = [prepend_path] + path
-            if append_path:
-                path = path + [append_path]
-            path = ':'.join(path)
-            env['PATH'] = path
+        jobserver = get_jobserver()
+        pass_fds = ()
+        if jobserver is not None:
+            env = jobserver.get_env(env)
+            pass_fds = jobserver.pass_fds
+
+        munge_path = path or prepend_path or append_path
+        env, path = env_cache.get_env(path, prepend_path, append_path, extra=env)
+        cmd, executable, shell = resolve_command(cmd, env, cwd)
 
         if echo:
             print_hr()
@@ -55,28 +169,88 @@ class LocalRunner(Runner):
                 print_info('   PATH:', path)
             print_hr()
 
+        buffers = {
+            'stdout': get_buffer(capture, capture_limit),
+            'stderr': get_buffer(capture, capture_limit),
+        }
+
+        consoles = {'stdout': sys.stdout, 'stderr': sys.stderr}
+        shown = [name for name in consoles if hide not in (Hide(name), Hide.all)]
+        pipes = {'stdout': PIPE, 'stderr': PIPE}
+        tee_fds = {}
+
+        if passthrough and not stream and not prefix:
+            for name in shown:
+                fd = get_console_fd(consoles[name])
+                if fd is None:
+                    continue
+                if capture is Capture.none:
+                    pipes[name] = fd
+                elif KernelTee.available:
+                    tee_fds[name] = fd
+
+        input = Input(input)
+
+        try:
+            proc = Popen(
+                cmd, executable=executable, cwd=cwd, env=env, stdin=input.stdin,
+                stdout=pipes['stdout'], stderr=pipes['stderr'], shell=shell,
+                close_fds=shell or bool(pass_fds), pass_fds=pass_fds)
+        except FileNotFoundError:
+            exe = cmd_str.split(None, 1)[0] if cmd_str.strip() else cmd_str
+            raise RunAborted('Command not found: {exe}'.format(exe=exe))
+        except Exception:
+            raise RunAborted('Could not run command')
+        finally:
+            input.close()
+
+        if limits:
+            try:
+                limits.apply(proc.pid)
+            except OSError as exc:
+                proc.kill()
+                proc.wait()
+                raise RunAborted('Could not apply process limits: {exc}'.format(exc=exc))
+
+        group = add_to_current_group(proc)
+        feed = input.feed(proc.stdin)
+
+        if stream:
+            return StreamingRun(
+                proc, buffers, timeout=timeout, on_failure=on_failure, feed=feed)
+
+        tees = {name: KernelTee(fd) for name, fd in tee_fds.items()}
+        forwarders = {
+            name: get_forwarder(consoles[name], prefix) for name in shown
+            if pipes[name] is PIPE and name not in tees}
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
         try:
-            with Popen(cmd, cwd=cwd, env=env, stdout=stdout, stderr=stderr, shell=shell) as proc:
+            with proc:
+                files = {name: getattr(proc, name) for name in pipes if pipes[name] is PIPE}
                 try:
-                    out, err = proc.communicate(timeout=timeout)
+                    pump(files, buffers, forwarders, timeout, cmd, tees, feed)
+                    # When no output is piped, e.g. with passthrough and
+                    # no capture, this is where the timeout applies.
+                    wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                    return_code = proc.wait(wait)
                 except:
                     proc.kill()
                     proc.wait()
                     raise
-                return_code = proc.poll()
-        except FileNotFoundError:
-            raise RunAborted('Command not found: {exe}'.format(exe=exe))
+                finally:
+                    for tee in tees.values():
+                        tee.close()
+                    if group is not None:
+                        group.discard(proc)
+        except TimeoutExpired:
+            raise RunAborted('Command timed out after {timeout}s'.format(timeout=timeout))
         except Exception:
             raise RunAborted('Could not run command')
 
-        out = out.decode()
-        err = err.decode()
-
-        if hide not in (Hide.stdout, Hide.all) and out:
-            print(out, end='')
-
-        if hide not in (Hide.stderr, Hide.all) and err:
-            print(err, end='', file=sys.stderr)
+        out = get_output(buffers['stdout'])
+        err = get_output(buffers['stderr'])
 
         if return_code:
             raise RunError(return_code, out, err)
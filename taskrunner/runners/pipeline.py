@@ -0,0 +1,328 @@
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from subprocess import PIPE, Popen, TimeoutExpired
+
+from ..jobserver import get_jobserver
+from ..util import Capture, Hide, print_hr, print_info
+from .base import Runner
+from .env import env_cache
+from .exc import RunAborted, RunError
+from .group import add_to_current_group
+from .limits import ProcessLimits
+from .local import resolve_command
+from .result import Result
+from .streams import Forwarder, Input, get_buffer, get_console_fd, get_output, pump
+
+
+class PipelineResult(Result):
+
+    """Result of running a pipeline.
+
+    ``return_codes`` contains the return code of each stage, like
+    ``$PIPESTATUS`` in bash.
+
+    """
+
+    __slots__ = ('return_codes',)
+
+    def __init__(self, return_code, stdout, stderr, return_codes=()):
+        super().__init__(return_code, stdout, stderr)
+        self.return_codes = list(return_codes)
+
+
+class PythonStage(threading.Thread):
+
+    """Run a Python callable as a pipeline stage.
+
+    The callable is passed binary file objects for its input and output
+    (``func(stdin, stdout)``). The output is closed when it returns so
+    the next stage will see EOF.
+
+    If the callable raises, the traceback is written to the pipeline's
+    stderr and the stage's return code will be 1. If the next stage
+    exits before reading all of the output, the return code will be
+    ``-SIGPIPE``, matching what a process would get.
+
+    """
+
+    def __init__(self, func, stdin, stdout, stderr):
+        super().__init__(daemon=True)
+        self.func = func
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def run(self):
+        try:
+            self.func(self.stdin, self.stdout)
+            self.stdout.flush()
+        except BrokenPipeError:
+            self.returncode = -signal.SIGPIPE
+        except Exception:
+            self.stderr.write(traceback.format_exc().encode())
+            self.returncode = 1
+        else:
+            self.returncode = 0
+        finally:
+            for file in (self.stdin, self.stdout, self.stderr):
+                try:
+                    file.close()
+                except OSError:
+                    pass
+
+    def wait(self, timeout=None):
+        self.join(timeout)
+        if self.is_alive():
+            raise TimeoutExpired(self.func, timeout)
+        return self.returncode
+
+    def kill(self):
+        # Threads can't be killed, but closing its input and output will
+        # cause the callable to fail on its next read or write.
+        for file in (self.stdin, self.stdout):
+            try:
+                file.close()
+            except (OSError, ValueError):
+                pass
+
+
+class PipelineRunner(Runner):
+
+    """Run commands connected by pipes without a shell.
+
+    Each stage can be a command string, a list of args, or a Python
+    callable (see :class:`PythonStage`). Stages are connected with
+    :func:`os.pipe` directly, so only the stages that use shell syntax
+    go through ``/bin/sh``.
+
+    ``input`` is fed to the first stage (see :class:`Input`).
+
+    ``cpu_affinity``, ``nice``, ``ionice``, and ``rlimits`` are applied
+    to each command stage (see :class:`ProcessLimits`); they don't
+    apply to Python stages.
+
+    The output of the last stage and the stderr of all stages are
+    forwarded and captured the same way :class:`LocalRunner` does it.
+
+    The return code of the pipeline is the return code of the last
+    stage that failed (i.e., it works like ``set -o pipefail``). The
+    return codes of all the stages are available via
+    :attr:`PipelineResult.return_codes` (or ``RunError.return_codes``).
+
+    If the pipeline hasn't finished after ``timeout`` seconds, all of
+    the stages are killed and :class:`RunAborted` is raised.
+
+    """
+
+    def run(self, stages, cd=None, path=None, prepend_path=None, append_path=None, env=None,
+            echo=False, hide=None, timeout=None, capture=Capture.full, capture_limit=None,
+            passthrough=False, input=None, cpu_affinity=None, nice=None, ionice=None,
+            rlimits=None, debug=False):
+        if not stages:
+            raise ValueError('At least one pipeline stage must be specified')
+
+        cwd = os.path.normpath(os.path.abspath(cd)) if cd else None
+
+        hide = Hide(hide) if hide is not None else Hide.none
+        capture = Capture(capture) if capture is not None else Capture.full
+
+        if hide in (Hide.stdout, Hide.all):
+            echo = False
+
+        try:
+            limits = ProcessLimits(cpu_affinity, nice, ionice, rlimits)
+        except ValueError as exc:
+            raise RunAborted(str(exc))
+
+        jobserver = get_jobserver()
+        pass_fds = ()
+        if jobserver is not None:
+            env = jobserver.get_env(env)
+            pass_fds = jobserver.pass_fds
+
+        munge_path = path or prepend_path or append_path
+        env, path = env_cache.get_env(path, prepend_path, append_path, extra=env)
+
+        resolved = [
+            stage if callable(stage) else resolve_command(stage, env, cwd) for stage in stages]
+
+        if echo:
+            print_hr()
+            print_info('RUNNING:', ' | '.join(self.describe(stage) for stage in stages))
+            if cwd:
+                print_info('    CWD:', cwd)
+            if munge_path:
+                print_info('   PATH:', path)
+            print_hr()
+
+        buffers = {
+            'stdout': get_buffer(capture, capture_limit),
+            'stderr': get_buffer(capture, capture_limit),
+        }
+
+        consoles = {'stdout': sys.stdout, 'stderr': sys.stderr}
+        shown = [name for name in consoles if hide not in (Hide(name), Hide.all)]
+        pipes = {'stdout': PIPE, 'stderr': PIPE}
+
+        if passthrough and capture is Capture.none:
+            for name in shown:
+                if get_console_fd(consoles[name]) is not None:
+                    pipes[name] = None
+
+        # fds that need to be closed in this process once all the stages
+        # have been started (the stages have their own copies).
+        parent_fds = []
+        files = {}
+
+        if pipes['stderr'] is PIPE:
+            err_read, err_write = os.pipe()
+            files['stderr'] = os.fdopen(err_read, 'rb', buffering=0)
+            parent_fds.append(err_write)
+        else:
+            err_write = sys.stderr.fileno()
+
+        input = Input(input)
+        feed = None
+        stage_procs = []
+        stdin = None
+
+        # fds and files that haven't been handed off to a stage yet; if a
+        # stage can't be started, these are closed along with everything
+        # else that was opened for the pipeline.
+        owned_fds = set()
+        stage_files = []
+
+        try:
+            if input.chunks is not None:
+                stdin, feed_fd = os.pipe()
+                owned_fds.add(stdin)
+                feed = (os.fdopen(feed_fd, 'wb', buffering=0), input.chunks)
+            elif input.stdin is not None:
+                fd = input.stdin if isinstance(input.stdin, int) else input.stdin.fileno()
+                stdin = os.dup(fd)
+                owned_fds.add(stdin)
+
+            for i, stage in enumerate(resolved):
+                last = i == len(resolved) - 1
+                if not last or pipes['stdout'] is PIPE:
+                    read_fd, stdout = os.pipe()
+                    owned_fds.update((read_fd, stdout))
+                    if last:
+                        files['stdout'] = os.fdopen(read_fd, 'rb', buffering=0)
+                        owned_fds.discard(read_fd)
+                else:
+                    read_fd, stdout = None, os.dup(sys.stdout.fileno())
+                    owned_fds.add(stdout)
+
+                if callable(stage):
+                    if stdin is None:
+                        stage_files.append(open(os.devnull, 'rb'))
+                    else:
+                        stage_files.append(os.fdopen(stdin, 'rb'))
+                        owned_fds.discard(stdin)
+                    stage_files.append(os.fdopen(stdout, 'wb'))
+                    owned_fds.discard(stdout)
+                    stage_files.append(os.fdopen(os.dup(err_write), 'wb'))
+                    proc = PythonStage(stage, *stage_files)
+                    proc.start()
+                    stage_procs.append(proc)
+                    stage_files = []
+                else:
+                    cmd, executable, shell = stage
+                    proc = Popen(
+                        cmd, executable=executable, cwd=cwd, env=env, stdin=stdin, stdout=stdout,
+                        stderr=err_write, shell=shell, close_fds=shell or bool(pass_fds),
+                        pass_fds=pass_fds)
+                    stage_procs.append(proc)
+                    add_to_current_group(proc)
+                    for fd in (stdin, stdout):
+                        if fd is not None:
+                            os.close(fd)
+                            owned_fds.discard(fd)
+
+                stdin = None if last else read_fd
+
+                if limits and not callable(stage):
+                    try:
+                        limits.apply(proc.pid)
+                    except OSError as exc:
+                        raise RunAborted('Could not apply process limits: {exc}'.format(exc=exc))
+        except RunAborted:
+            self.abort(stage_procs, owned_fds, stage_files, files, feed)
+            raise
+        except FileNotFoundError:
+            self.abort(stage_procs, owned_fds, stage_files, files, feed)
+            stage = self.describe(stages[i])
+            raise RunAborted('Command not found: {stage}'.format(stage=stage))
+        except Exception:
+            self.abort(stage_procs, owned_fds, stage_files, files, feed)
+            raise RunAborted('Could not run pipeline')
+        finally:
+            input.close()
+            for fd in parent_fds:
+                os.close(fd)
+
+        forwarders = {
+            name: Forwarder(consoles[name]) for name in shown if pipes[name] is PIPE}
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        try:
+            pump(files, buffers, forwarders, timeout, stages, feed=feed)
+            return_codes = []
+            for proc in stage_procs:
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                return_codes.append(proc.wait(wait))
+        except TimeoutExpired:
+            self.abort(stage_procs, (), (), files, feed)
+            raise RunAborted('Pipeline timed out after {timeout}s'.format(timeout=timeout))
+        except Exception:
+            self.abort(stage_procs, (), (), files, feed)
+            raise RunAborted('Could not run pipeline')
+
+        failures = [code for code in return_codes if code]
+        return_code = failures[-1] if failures else 0
+
+        out = get_output(buffers['stdout'])
+        err = get_output(buffers['stderr'])
+
+        if return_code:
+            exc = RunError(return_code, out, err)
+            exc.return_codes = return_codes
+            raise exc
+
+        return PipelineResult(return_code, out, err, return_codes)
+
+    def describe(self, stage):
+        if callable(stage):
+            return '<{name}>'.format(name=getattr(stage, '__name__', repr(stage)))
+        if isinstance(stage, str):
+            return stage
+        return ' '.join(stage)
+
+    def abort(self, stage_procs, fds, stage_files, files, feed):
+        # Close everything that was opened for the pipeline, then kill
+        # and reap the stages that were started.
+        for fd in fds:
+            os.close(fd)
+        file_objs = list(stage_files) + list(files.values())
+        if feed is not None:
+            file_objs.append(feed[0])
+        for file in file_objs:
+            try:
+                file.close()
+            except OSError:
+                pass
+        self.kill(stage_procs)
+
+    def kill(self, stage_procs):
+        for proc in stage_procs:
+            if proc.returncode is None:
+                proc.kill()
+        for proc in stage_procs:
+            proc.wait()
@@ -1,11 +1,163 @@
+from array import array
+from collections.abc import Sequence
 
-class Result:
+
+class Output:
+
+    """Raw output from a command stream.
+
+    The output is stored once as bytes or, for large outputs, as an
+    :class:`mmap.mmap` of a temporary file. It's decoded on access and
+    lines are indexed lazily the first time they're accessed.
+
+    """
+
+    __slots__ = ('data', 'encoding', '_line_starts')
+
+    def __init__(self, data=b'', encoding='utf-8'):
+        if isinstance(data, str):
+            data = data.encode(encoding)
+        self.data = data
+        self.encoding = encoding
+        self._line_starts = None
+
+    @property
+    def text(self):
+        return str(self.data, self.encoding, 'replace')
+
+    @property
+    def lines(self):
+        return Lines(self)
+
+    def line_starts(self):
+        """Get the offset of the start of each line (built once)."""
+        if self._line_starts is None:
+            data = self.data
+            size = len(data)
+            starts = array('Q')
+            pos = 0
+            while pos < size:
+                starts.append(pos)
+                pos = data.find(b'\n', pos)
+                if pos == -1:
+                    break
+                pos += 1
+            self._line_starts = starts
+        return self._line_starts
+
+    def __reduce__(self):
+        # Output that was spilled to an mmap is pickled as bytes (e.g.,
+        # when it's returned from a worker process).
+        return self.__class__, (bytes(self.data), self.encoding)
+
+    def __bytes__(self):
+        return bytes(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bool__(self):
+        return len(self.data) > 0
+
+
+class Lines(Sequence):
+
+    """Read-only view of an :class:`Output`'s lines.
+
+    Lines are split on ``\\n``; trailing ``\\r`` is stripped. Each line
+    is decoded when it's accessed.
+
+    """
+
+    __slots__ = ('_output',)
+
+    def __init__(self, output):
+        self._output = output
+
+    def __len__(self):
+        return len(self._output.line_starts())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        output = self._output
+        starts = output.line_starts()
+        start = starts[index]
+        index = index % len(starts)
+        if index + 1 < len(starts):
+            end = starts[index + 1] - 1
+        else:
+            end = len(output.data)
+            if output.data[end - 1:end] == b'\n':
+                end -= 1
+        line = output.data[start:end]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        return line.decode(output.encoding, 'replace')
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, Lines)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class BaseResult:
+
+    """Result of running a command.
+
+    This doesn't define any storage of its own so that it can be
+    combined with :class:`Exception` (see :class:`RunError`).
+
+    """
+
+    __slots__ = ()
 
     def __init__(self, return_code, stdout, stderr):
         self.return_code = return_code
-        self.stdout = stdout
-        self.stderr = stderr
-        self.succeeded = self.return_code == 0
-        self.failed = not self.succeeded
-        self.stdout_lines = stdout.splitlines() if stdout else []
-        self.stderr_lines = stderr.splitlines() if stderr else []
+        self._stdout = stdout if isinstance(stdout, Output) else Output(stdout or b'')
+        self._stderr = stderr if isinstance(stderr, Output) else Output(stderr or b'')
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+    @property
+    def stdout(self):
+        return self._stdout.text
+
+    @property
+    def stderr(self):
+        return self._stderr.text
+
+    @property
+    def stdout_bytes(self):
+        return self._stdout.data
+
+    @property
+    def stderr_bytes(self):
+        return self._stderr.data
+
+    @property
+    def stdout_lines(self):
+        return self._stdout.lines
+
+    @property
+    def stderr_lines(self):
+        return self._stderr.lines
+
+
+class Result(BaseResult):
+
+    __slots__ = ('return_code', '_stdout', '_stderr')
+
+    def __repr__(self):
+        return '<{cls} return_code={code} stdout={out} bytes stderr={err} bytes>'.format(
+            cls=self.__class__.__name__, code=self.return_code, out=len(self._stdout),
+            err=len(self._stderr))
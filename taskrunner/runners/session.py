@@ -0,0 +1,201 @@
+import re
+import sys
+import uuid
+from concurrent.futures import Future
+
+from ..util import Hide, abort, args_to_str, print_hr, print_info
+from .exc import RunAborted, RunError
+from .local import LocalRunner
+from .result import Result
+
+
+__all__ = ['RemoteSession']
+
+
+class RemoteSession:
+
+    """Run a sequence of remote commands over a single SSH connection.
+
+    Commands are queued with :meth:`run` and sent together as one
+    script when :meth:`execute` is called (which happens automatically
+    at the end of a ``with remote_session(...)`` block). Each command
+    runs in its own subshell with stdin redirected from ``/dev/null``.
+
+    Before and after each command, a marker line with a per-session
+    random token is written to stdout and stderr; the end marker
+    includes the command's exit code. The markers are used to split the
+    session's output back into a :class:`Result` for each command and
+    are filtered out of the output shown on the console.
+
+    By default, the session stops at the first command that fails;
+    commands after it aren't run and their results will be ``None``.
+    Set ``keep_going`` to run all of the commands regardless.
+
+    """
+
+    def __init__(self, ssh_cmd, sudo_cmd=None, cd=None, path=None, echo=False, hide=None,
+                 keep_going=False, abort_on_failure=True, format_kwargs=None, debug=False):
+        self.ssh_cmd = ssh_cmd
+        self.sudo_cmd = sudo_cmd
+        self.cd = cd
+        self.path = path
+        self.echo = echo
+        self.hide = Hide(hide) if hide is not None else Hide.none
+        self.keep_going = keep_going
+        self.abort_on_failure = abort_on_failure
+        self.format_kwargs = format_kwargs
+        self.debug = debug
+        self.marker = 'TASKRUNNER-{token}'.format(token=uuid.uuid4().hex)
+        self.marker_re = re.compile(
+            rb'\n' + self.marker.encode() + rb':(\d+):(start|end)(?::(-?\d+))?\n')
+        self.results = []
+        self._queue = []
+
+    def run(self, cmd, cd=None):
+        """Queue ``cmd`` to be run on the remote host.
+
+        Returns a :class:`Future` for the command's result; the result
+        is available once the session has been executed.
+
+        """
+        cmd = args_to_str(cmd, format_kwargs=self.format_kwargs)
+        cd = args_to_str(cd, format_kwargs=self.format_kwargs) or None
+        future = Future()
+        self._queue.append((cmd, cd, future))
+        return future
+
+    def cancel(self):
+        """Discard queued commands without running them."""
+        for _, _, future in self._queue:
+            future.cancel()
+        self._queue = []
+
+    def get_script(self, queue):
+        marker = self.marker
+        script = ["_mark () { printf '\\n%s\\n' \"$1\"; printf '\\n%s\\n' \"$1\" >&2; }"]
+        if self.path:
+            script.append('export PATH="{path}"'.format(path=self.path))
+        for i, (cmd, cd, _) in enumerate(queue):
+            cd = cd or self.cd
+            script.append('_mark {marker}:{i}:start'.format(marker=marker, i=i))
+            script.append('(')
+            if cd:
+                script.append('  cd {cd} || exit 1'.format(cd=cd))
+            script.append('  {cmd}'.format(cmd=cmd))
+            script.append(') </dev/null')
+            script.append('rc=$?')
+            script.append('_mark {marker}:{i}:end:$rc'.format(marker=marker, i=i))
+            if not self.keep_going:
+                script.append('[ $rc -eq 0 ] || exit $rc')
+        return script
+
+    def execute(self):
+        """Run the queued commands and set their results.
+
+        Returns the list of results for the commands that were queued.
+
+        """
+        queue, self._queue = self._queue, []
+        if not queue:
+            return []
+
+        # ssh -T someone@somehost sudo -u svusrXYZ bash <<'TASKRUNNER-<token>'
+        #     _mark () { printf '\n%s\n' "$1"; printf '\n%s\n' "$1" >&2; }
+        #     _mark TASKRUNNER-<token>:0:start
+        #     (
+        #       cd <cd> || exit 1
+        #       <cmd>
+        #     ) </dev/null
+        #     rc=$?
+        #     _mark TASKRUNNER-<token>:0:end:$rc
+        #     [ $rc -eq 0 ] || exit $rc
+        #     ...
+        # TASKRUNNER-<token>
+        script = self.get_script(queue)
+        bash_cmd = "bash <<'{marker}'\n{script}\n{marker}".format(
+            marker=self.marker, script='\n'.join(script))
+        if self.sudo_cmd:
+            bash_cmd = ' '.join((self.sudo_cmd, bash_cmd))
+
+        try:
+            run = LocalRunner().run(
+                self.ssh_cmd + [bash_cmd], stream=True, on_failure=lambda exc: None,
+                debug=self.debug)
+        except RunAborted as exc:
+            for _, _, future in queue:
+                future.cancel()
+            if self.debug:
+                raise
+            abort(1, str(exc))
+
+        try:
+            self.show(run, queue)
+        finally:
+            run.close()
+
+        results = self.demultiplex(run.result, queue)
+        for (_, _, future), result in zip(queue, results):
+            future.set_result(result)
+        self.results.extend(results)
+
+        if self.abort_on_failure:
+            for (cmd, _, _), result in zip(queue, results):
+                if result is not None and result.failed:
+                    abort(2, 'Remote command failed with exit code {code}: {cmd}'.format(
+                        code=result.return_code, cmd=cmd))
+            if run.result.failed and results[-1] is None:
+                abort(2, 'Remote session failed with exit code {code}'.format(
+                    code=run.result.return_code))
+
+        return results
+
+    def show(self, run, queue):
+        # Show output as it's produced, leaving out the markers and the
+        # blank lines that are added in front of them.
+        consoles = {'stdout': sys.stdout, 'stderr': sys.stderr}
+        shown = {name for name in consoles if self.hide not in (Hide(name), Hide.all)}
+        echo = self.echo and 'stdout' in shown
+        held_blank = {name: False for name in consoles}
+        for name, line in run:
+            if line.startswith(self.marker):
+                held_blank[name] = False
+                if echo and name == 'stdout' and line.endswith(':start'):
+                    i = int(line.split(':')[1])
+                    print_hr()
+                    print_info('RUNNING:', queue[i][0])
+                    print_hr()
+                continue
+            if name not in shown:
+                continue
+            if held_blank[name]:
+                consoles[name].write('\n')
+            held_blank[name] = not line
+            if line:
+                consoles[name].write(line + '\n')
+                consoles[name].flush()
+
+    def demultiplex(self, session_result, queue):
+        # Split the session's output into results for each command.
+        streams = {}
+        for name in ('stdout', 'stderr'):
+            data = bytes(getattr(session_result, name + '_bytes'))
+            sections = {}
+            start = None
+            for match in self.marker_re.finditer(data):
+                i = int(match.group(1))
+                if match.group(2) == b'start':
+                    start = match.end()
+                elif start is not None:
+                    sections[i] = (data[start:match.start()], int(match.group(3)))
+                    start = None
+            streams[name] = sections
+        results = []
+        for i in range(len(queue)):
+            if i not in streams['stdout']:
+                results.append(None)
+                continue
+            out, return_code = streams['stdout'][i]
+            err = streams['stderr'].get(i, (b'', return_code))[0]
+            result_type = RunError if return_code else Result
+            results.append(result_type(return_code, out, err))
+        return results
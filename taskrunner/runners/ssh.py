@@ -0,0 +1,135 @@
+import atexit
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from ..util import print_warning
+
+
+__all__ = ['SSHPool', 'ssh_pool']
+
+
+# How long to wait for a master connection to be established before
+# falling back to regular connections.
+CONNECT_TIMEOUT = 30
+
+
+class SSHPool:
+
+    """Pool of persistent SSH master connections.
+
+    One OpenSSH ControlMaster connection is started per destination
+    (``user@host``) the first time it's used. Subsequent connections to
+    the same destination are multiplexed over the master's control
+    socket, so they don't have to do a TCP and key exchange handshake.
+
+    The control sockets live in a private temporary directory. Masters
+    are shut down when the process exits (or when :meth:`close` is
+    called).
+
+    If a master can't be started, a warning is shown and connections to
+    that destination are made the usual way.
+
+    Usage::
+
+        ssh_cmd = ['ssh', '-T'] + ssh_pool.get_options(destination)
+        ssh_cmd += [destination, remote_cmd]
+
+    """
+
+    def __init__(self, ssh='ssh'):
+        self.ssh = ssh
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._control_paths = {}
+        self._directory = None
+
+    def get_options(self, destination):
+        """Get the ssh options for connecting via a master connection.
+
+        The master is started if necessary. If it can't be started,
+        an empty list is returned.
+
+        """
+        with self._lock:
+            lock = self._locks.setdefault(destination, threading.Lock())
+        with lock:
+            if destination not in self._control_paths:
+                self._control_paths[destination] = self.start(destination)
+            control_path = self._control_paths[destination]
+        if control_path is None:
+            return []
+        return ['-o', 'ControlPath={control_path}'.format(control_path=control_path)]
+
+    def get_control_path(self, destination):
+        with self._lock:
+            if self._directory is None:
+                # Unix socket paths are limited to ~100 chars, so this
+                # is kept as short as possible.
+                self._directory = tempfile.mkdtemp(prefix='tr-ssh-')
+                atexit.register(self.close)
+        name = hashlib.sha1(destination.encode()).hexdigest()[:16]
+        return os.path.join(self._directory, name)
+
+    def start(self, destination):
+        """Start a master connection; returns its control path."""
+        control_path = self.get_control_path(destination)
+        cmd = [
+            self.ssh,
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPersist=yes',
+            '-o', 'ControlPath={control_path}'.format(control_path=control_path),
+            '-N', '-f', destination,
+        ]
+        try:
+            # The master daemonizes after connecting, but it keeps the
+            # stderr it was given, so stderr is sent to a file rather than
+            # a pipe that would never be closed.
+            with tempfile.TemporaryFile() as err:
+                return_code = subprocess.call(
+                    cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=err,
+                    timeout=CONNECT_TIMEOUT)
+                err.seek(0)
+                reason = err.read().decode(errors='replace').strip()
+        except (OSError, subprocess.SubprocessError) as exc:
+            return_code, reason = None, str(exc)
+        if return_code != 0:
+            reason = reason or 'exit code {return_code}'.format(return_code=return_code)
+            print_warning(
+                'Could not start SSH master connection to {destination}; connecting without '
+                'multiplexing: {reason}'.format(destination=destination, reason=reason))
+            return None
+        return control_path
+
+    def stop(self, destination):
+        """Shut down the master connection to ``destination``."""
+        with self._lock:
+            control_path = self._control_paths.pop(destination, None)
+        if control_path is not None:
+            cmd = [
+                self.ssh,
+                '-o', 'ControlPath={control_path}'.format(control_path=control_path),
+                '-O', 'exit', destination,
+            ]
+            try:
+                subprocess.run(
+                    cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL, timeout=CONNECT_TIMEOUT)
+            except (OSError, subprocess.SubprocessError):
+                pass
+
+    def close(self):
+        """Shut down all master connections."""
+        for destination in list(self._control_paths):
+            self.stop(destination)
+        with self._lock:
+            directory, self._directory = self._directory, None
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+            atexit.unregister(self.close)
+
+
+ssh_pool = SSHPool()
@@ -0,0 +1,569 @@
+import codecs
+import mmap
+import os
+import selectors
+import tempfile
+import threading
+import time
+from functools import partial
+from subprocess import PIPE, TimeoutExpired
+
+from ..util import Capture
+from .exc import RunError
+from .result import Output, Result
+
+
+DEFAULT_CAPTURE_LIMIT = 1024 * 1024
+
+# Fully captured output larger than this is spilled to a temporary file
+# and exposed via mmap instead of being kept in memory.
+SPILL_THRESHOLD = 8 * 1024 * 1024
+
+READ_SIZE = 64 * 1024
+
+
+class FullBuffer:
+
+    """Capture all output.
+
+    Once more than ``spill_threshold`` bytes have been written, output
+    is moved to an anonymous temporary file, which is then mapped into
+    memory by :meth:`getvalue`.
+
+    """
+
+    def __init__(self, limit=None, spill_threshold=None):
+        self.spill_threshold = SPILL_THRESHOLD if spill_threshold is None else spill_threshold
+        self._data = bytearray()
+        self._file = None
+
+    def write(self, data):
+        if self._file is not None:
+            self._file.write(data)
+        elif len(self._data) + len(data) > self.spill_threshold:
+            self._file = tempfile.TemporaryFile(prefix='taskrunner-')
+            self._file.write(self._data)
+            self._file.write(data)
+            self._data = None
+        else:
+            self._data += data
+
+    def getvalue(self):
+        if self._file is None:
+            return bytes(self._data)
+        with self._file as file:
+            file.flush()
+            # The mapping remains valid after the file is closed.
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class HeadTailBuffer:
+
+    """Capture the first and last ``limit / 2`` bytes of output.
+
+    Anything in between is counted but discarded, so memory use is
+    bounded by ``limit`` no matter how much output is written.
+
+    """
+
+    def __init__(self, limit=None):
+        limit = DEFAULT_CAPTURE_LIMIT if limit is None else limit
+        self.head_size = limit // 2
+        self.tail_size = limit - self.head_size
+        self.omitted = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+
+    def write(self, data):
+        head_room = self.head_size - len(self._head)
+        if head_room > 0:
+            self._head += data[:head_room]
+            data = data[head_room:]
+        if data:
+            self._tail += data
+            excess = len(self._tail) - self.tail_size
+            if excess > 0:
+                # Deleting from the front of a bytearray is cheap.
+                del self._tail[:excess]
+                self.omitted += excess
+
+    def getvalue(self):
+        if not self.omitted:
+            return bytes(self._head + self._tail)
+        marker = '\n[... {self.omitted} bytes omitted ...]\n'.format(self=self)
+        return b''.join((self._head, marker.encode(), self._tail))
+
+
+class NullBuffer:
+
+    """Discard all output."""
+
+    def __init__(self, limit=None):
+        pass
+
+    def write(self, data):
+        pass
+
+    def getvalue(self):
+        return b''
+
+
+BUFFER_TYPES = {
+    Capture.full: FullBuffer,
+    Capture.head_tail: HeadTailBuffer,
+    Capture.none: NullBuffer,
+}
+
+
+def get_output(buffer, encoding='utf-8'):
+    return Output(buffer.getvalue(), encoding)
+
+
+def get_buffer(capture=Capture.full, limit=None):
+    capture = Capture(capture) if capture is not None else Capture.full
+    return BUFFER_TYPES[capture](limit)
+
+
+class Forwarder:
+
+    """Decode output incrementally and write it to a text stream.
+
+    Multi-byte characters that are split across chunks are held back
+    until the rest of the character arrives.
+
+    """
+
+    def __init__(self, file, encoding='utf-8'):
+        self.file = file
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+
+    def write(self, data):
+        text = self.decoder.decode(data)
+        if text:
+            self.file.write(text)
+            self.file.flush()
+
+    def close(self):
+        text = self.decoder.decode(b'', final=True)
+        if text:
+            self.file.write(text)
+            self.file.flush()
+
+
+class PrefixForwarder(Forwarder):
+
+    """Forward output line by line with a prefix on each line.
+
+    Used when output from several commands is shown at the same time
+    (e.g., when running a command on several hosts). Only complete
+    lines are written, and writes from all prefix forwarders are
+    serialized, so lines from different commands aren't interleaved.
+
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, file, prefix, encoding='utf-8'):
+        super().__init__(file, encoding)
+        self.prefix = prefix
+        self.partial_line = ''
+
+    def write(self, data):
+        lines = (self.partial_line + self.decoder.decode(data)).split('\n')
+        self.partial_line = lines.pop()
+        if lines:
+            self.write_lines(lines)
+
+    def close(self):
+        text = self.partial_line + self.decoder.decode(b'', final=True)
+        self.partial_line = ''
+        if text:
+            self.write_lines([text])
+
+    def write_lines(self, lines):
+        prefix = self.prefix
+        text = ''.join([prefix + line + '\n' for line in lines])
+        with self.lock:
+            self.file.write(text)
+            self.file.flush()
+
+
+def get_forwarder(file, prefix=None):
+    if prefix:
+        return PrefixForwarder(file, prefix)
+    return Forwarder(file)
+
+
+def get_console_fd(file):
+    """Get the file descriptor backing a console stream like stdout.
+
+    Any buffered output is flushed first so that output written
+    directly to the file descriptor appears in order. If ``file``
+    isn't backed by a file descriptor (e.g., it has been replaced with
+    a :class:`io.StringIO`), ``None`` is returned.
+
+    """
+    try:
+        file.flush()
+        return file.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _load_tee():
+    # tee(2) isn't exposed by the os module, so it's looked up in libc
+    # when splice(2) is available (i.e., on Linux).
+    if not hasattr(os, 'splice'):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        tee = libc.tee
+    except (AttributeError, ImportError, OSError):
+        return None
+    tee.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint)
+    tee.restype = ctypes.c_ssize_t
+
+    def checked_tee(fd_in, fd_out, count):
+        result = tee(fd_in, fd_out, count, 0)
+        if result == -1:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return result
+
+    return checked_tee
+
+
+_tee = _load_tee()
+
+
+class KernelTee:
+
+    """Copy output from a pipe to a file descriptor inside the kernel.
+
+    Data in the pipe is duplicated into a private pipe with tee(2) and
+    then moved to ``fd`` with splice(2), so the bytes written to ``fd``
+    never pass through Python. The duplicate is read back so the output
+    can still be captured.
+
+    If ``fd`` doesn't support splicing (e.g., some terminals), this
+    falls back to reading and writing in user space.
+
+    Only available on Linux; check :attr:`available` first.
+
+    """
+
+    available = _tee is not None
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.enabled = True
+        self._read_fd, self._write_fd = os.pipe()
+
+    def transfer(self, pipe_fd):
+        """Transfer available data from ``pipe_fd``; return a copy.
+
+        Returns an empty bytes object at EOF.
+
+        """
+        if self.enabled:
+            count = _tee(pipe_fd, self._write_fd, READ_SIZE)
+            if not count:
+                return b''
+            moved = 0
+            try:
+                while moved < count:
+                    moved += os.splice(pipe_fd, self.fd, count - moved)
+            except OSError:
+                # Splicing failed, possibly after some of the data was
+                # already moved. The rest is still in the pipe, so it's
+                # copied through user space from here on.
+                self.enabled = False
+                data = self._read_exactly(count)
+                self._read_exactly(count - moved, pipe_fd)
+                self._write_all(memoryview(data)[moved:])
+                return data
+            return self._read_exactly(count)
+        data = os.read(pipe_fd, READ_SIZE)
+        self._write_all(data)
+        return data
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    def _read_exactly(self, count, fd=None):
+        fd = self._read_fd if fd is None else fd
+        chunks = []
+        while count:
+            chunk = os.read(fd, count)
+            chunks.append(chunk)
+            count -= len(chunk)
+        return b''.join(chunks)
+
+    def _write_all(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+
+class Input:
+
+    """Input for a command's stdin.
+
+    ``source`` can be any of the following:
+
+        - bytes: Written to the command's stdin
+        - str or path-like object: Path to a file; the file is opened
+          and its file descriptor is handed to the command directly so
+          its contents never pass through this process
+        - int or file object with a file descriptor: Handed to the
+          command directly
+        - file-like object without a file descriptor (e.g.,
+          :class:`io.BytesIO`): Read and written in chunks
+        - iterable: Chunks (bytes or str) written to the command's stdin
+
+    When the input needs to be written by this process, :attr:`stdin`
+    is :data:`PIPE` and :attr:`chunks` is an iterator of chunks to
+    write. Chunks are pulled from the iterator only as the command
+    consumes them, so memory use stays bounded.
+
+    """
+
+    def __init__(self, source=None):
+        self.stdin = None
+        self.chunks = None
+        self._file = None
+
+        if source is None:
+            pass
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            self.stdin = PIPE
+            self.chunks = iter((source,))
+        elif isinstance(source, str) or hasattr(source, '__fspath__'):
+            self._file = open(source, 'rb')
+            self.stdin = self._file
+        elif isinstance(source, int):
+            self.stdin = source
+        elif hasattr(source, 'read'):
+            try:
+                source.fileno()
+            except (AttributeError, OSError, ValueError):
+                self.stdin = PIPE
+                self.chunks = iter(partial(source.read, READ_SIZE), b'')
+            else:
+                self.stdin = source
+        else:
+            self.stdin = PIPE
+            self.chunks = (c.encode() if isinstance(c, str) else c for c in source)
+
+    def close(self):
+        """Close the input file, if one was opened.
+
+        This should be called once the command has been started.
+
+        """
+        if self._file is not None:
+            self._file.close()
+
+    def feed(self, file):
+        """Get the ``feed`` arg for :func:`iter_chunks`."""
+        return None if self.chunks is None else (file, self.chunks)
+
+
+def iter_chunks(files, timeout=None, cmd=None, tees=None, feed=None):
+    """Yield ``(name, chunk)`` pairs as output becomes available.
+
+    Args:
+        files (dict): Map of names (e.g., 'stdout') to readable pipes
+        timeout: Raise :class:`TimeoutExpired` if all of the pipes
+            haven't been closed after this many seconds
+        cmd: Command to pass along to :class:`TimeoutExpired`
+        tees (dict): Map of names to :class:`KernelTee`s; output from
+            these pipes is copied to the tee's file descriptor as it's
+            read
+        feed (tuple): A writable pipe and an iterator of chunks to
+            write to it as it becomes writable; the pipe is closed when
+            the iterator is exhausted (see :class:`Input`)
+
+    Chunks are read with :func:`os.read` as soon as they're available,
+    so they'll be at most ``READ_SIZE`` bytes each.
+
+    """
+    tees = tees or {}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        for name, file in files.items():
+            selector.register(file, selectors.EVENT_READ, name)
+        if feed is not None:
+            feed_file, feed_chunks = feed
+            feed_view = memoryview(b'')
+            os.set_blocking(feed_file.fileno(), False)
+            selector.register(feed_file, selectors.EVENT_WRITE, None)
+        while selector.get_map():
+            if deadline is None:
+                wait = None
+            else:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    raise TimeoutExpired(cmd, timeout)
+            for key, events in selector.select(wait):
+                if key.data is None:
+                    # The input pipe is writable. It's non-blocking, so
+                    # this writes as much as the pipe can currently take.
+                    try:
+                        while not feed_view:
+                            feed_view = memoryview(next(feed_chunks))
+                        feed_view = feed_view[os.write(key.fd, feed_view[:READ_SIZE]):]
+                    except BlockingIOError:
+                        pass
+                    except (StopIteration, BrokenPipeError):
+                        # Out of input or the command closed its stdin.
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                    continue
+                if key.data in tees:
+                    chunk = tees[key.data].transfer(key.fd)
+                else:
+                    chunk = os.read(key.fd, READ_SIZE)
+                if chunk:
+                    yield key.data, chunk
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+
+
+def pump(files, buffers, forwarders, timeout=None, cmd=None, tees=None, feed=None):
+    """Copy output from ``files`` to ``buffers`` and ``forwarders``.
+
+    Args:
+        files (dict): Map of names to readable pipes
+        buffers (dict): Map of names to capture buffers
+        forwarders (dict): Map of names to :class:`Forwarder`s; pipes
+            with no forwarder aren't shown
+
+    The remaining args are passed through to :func:`iter_chunks`. The
+    forwarders are closed when the pipes are exhausted.
+
+    """
+    try:
+        for name, chunk in iter_chunks(files, timeout, cmd, tees, feed):
+            buffers[name].write(chunk)
+            if name in forwarders:
+                forwarders[name].write(chunk)
+    finally:
+        for forwarder in forwarders.values():
+            forwarder.close()
+
+
+class StreamingRun:
+
+    """Iterate over the output of a running command line by line.
+
+    Yields ``(name, line)`` pairs, where ``name`` is 'stdout' or
+    'stderr', while the command runs. Lines don't include line endings.
+    Output is captured according to the buffers passed in, and once
+    the output has been consumed, :attr:`result` will be set.
+
+    If the command fails, ``on_failure`` is called with the
+    :class:`RunError`; by default, the error is raised. A command that
+    doesn't finish within ``timeout`` seconds is killed and then fails
+    the same way.
+
+    Iteration can be stopped early by calling :meth:`close` (or using
+    the run as a context manager), which kills the command::
+
+        with runner.run('find /', stream=True) as run:
+            for name, line in run:
+                if line.endswith('needle'):
+                    break
+
+    """
+
+    def __init__(self, proc, buffers, timeout=None, on_failure=None, encoding='utf-8',
+                 feed=None):
+        self.proc = proc
+        self.buffers = buffers
+        self.timeout = timeout
+        self.feed = feed
+        self.on_failure = on_failure
+        self.encoding = encoding
+        self.result = None
+        self._events = self._iter_events()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._events)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def wait(self):
+        """Consume any remaining output and return the result."""
+        for _ in self:
+            pass
+        return self.result
+
+    def close(self):
+        """Kill the command if it's still running."""
+        self._events.close()
+        if self.result is None:
+            self._kill()
+            self.result = self._make_result(Result)
+
+    def _iter_events(self):
+        proc = self.proc
+        files = {'stdout': proc.stdout, 'stderr': proc.stderr}
+        decoders = {name: codecs.getincrementaldecoder(self.encoding)(errors='replace')
+                    for name in files}
+        partial_lines = {name: '' for name in files}
+
+        try:
+            for name, chunk in iter_chunks(files, self.timeout, proc.args, feed=self.feed):
+                self.buffers[name].write(chunk)
+                text = partial_lines[name] + decoders[name].decode(chunk)
+                lines = text.split('\n')
+                partial_lines[name] = lines.pop()
+                for line in lines:
+                    yield name, line.rstrip('\r')
+        except TimeoutExpired:
+            # The command is killed and then handled like any other
+            # failure below.
+            self._kill()
+        except:
+            self._kill()
+            raise
+
+        for name, decoder in decoders.items():
+            line = partial_lines[name] + decoder.decode(b'', final=True)
+            if line:
+                yield name, line.rstrip('\r')
+
+        proc.wait()
+
+        if proc.returncode:
+            self.result = self._make_result(RunError)
+            if self.on_failure is None:
+                raise self.result
+            self.on_failure(self.result)
+        else:
+            self.result = self._make_result(Result)
+
+    def _kill(self):
+        proc = self.proc
+        if proc.poll() is None:
+            proc.kill()
+        for file in (proc.stdin, proc.stdout, proc.stderr):
+            if file is not None and not file.closed:
+                file.close()
+        proc.wait()
+
+    def _make_result(self, result_type):
+        out = get_output(self.buffers['stdout'], self.encoding)
+        err = get_output(self.buffers['stderr'], self.encoding)
+        return result_type(self.proc.returncode, out, err)
@@ -0,0 +1,470 @@
+import fnmatch
+import hashlib
+import json
+import mmap
+import os
+import posixpath
+import stat
+import struct
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from ..util import as_list
+
+
+__all__ = ['Syncer', 'make_delta']
+
+
+ADLER_MOD = 65521
+
+MIN_BLOCK_SIZE = 2048
+
+MAX_BLOCK_SIZE = 128 * 1024
+
+# These must match agent_server.py
+ANCHOR_SIZE = 8
+BLOCK = struct.Struct('!I16s{}s'.format(ANCHOR_SIZE))
+COPY = struct.Struct('!cII')
+DATA = struct.Struct('!cI')
+
+HASH_READ_SIZE = 1024 * 1024
+
+# Number of blocks' worth of offsets after a mismatch that are checked
+# one at a time (see :func:`scan`)
+SCAN_BLOCKS = 2
+
+# Number of the blocks following the last match whose anchors are
+# searched for, and how many times each one is tried when it's found
+# but the block doesn't match
+ANCHOR_LOOKAHEAD = 8
+MAX_ANCHOR_TRIES = 16
+
+# Approximate size of the compressed delta frames sent to the agent
+FRAME_SIZE = 256 * 1024
+
+
+def get_block_size(size):
+    # Like rsync, scale the block size with the square root of the file
+    # size so that the number of blocks grows slowly.
+    block_size = int(size ** 0.5) // 8 * 8
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def parse_signature(data):
+    """Parse the block signatures of a remote file.
+
+    Returns a tuple of a dict mapping weak checksums to ``[(strong
+    checksum, block index), ...]`` and a list of the anchors of the
+    blocks (their first few bytes) in order.
+
+    """
+    blocks = {}
+    anchors = []
+    for index, (weak, strong, anchor) in enumerate(BLOCK.iter_unpack(data)):
+        blocks.setdefault(weak, []).append((strong, index))
+        anchors.append(anchor)
+    return blocks, anchors
+
+
+def match_block(data, pos, block_size, blocks):
+    """Get the index of the block matching the data at ``pos``."""
+    block = data[pos:pos + block_size]
+    candidates = blocks.get(zlib.adler32(block))
+    if candidates is None:
+        return None
+    strong = strong_checksum(block)
+    return next((index for (s, index) in candidates if s == strong), None)
+
+
+def scan(data, pos, stop, block_size, blocks):
+    """Check every offset from ``pos`` to ``stop`` for a block.
+
+    A rolling Adler-32 checksum, which is updated in constant time as
+    the window moves one byte, is compared with the blocks' weak
+    checksums, and candidates are confirmed with a strong checksum.
+    This is done in Python, so it's only used for short stretches.
+
+    Returns a tuple of ``(pos, index)`` or ``(None, None)``.
+
+    """
+    L = block_size
+    weak = zlib.adler32(data[pos:pos + L])
+    a, b = weak & 0xffff, weak >> 16
+    while True:
+        if ((b << 16) | a) in blocks:
+            index = match_block(data, pos, L, blocks)
+            if index is not None:
+                return pos, index
+        if pos + 1 >= stop:
+            return None, None
+        old, new = data[pos], data[pos + L]
+        a = (a - old + new) % ADLER_MOD
+        b = (b - L * old + a - 1) % ADLER_MOD
+        pos += 1
+
+
+class BlockFinder:
+
+    """Find where the blocks of a remote file are in ``data``.
+
+    After a block has been matched, the data right after it is checked
+    for a matching block first, so unchanged stretches are handled a
+    block at a time. When that doesn't match, the data is searched for
+    the next block:
+
+        - The next few offsets are scanned with a rolling checksum (see
+          :func:`scan`), which finds blocks after small insertions,
+          deletions, and changes.
+        - Past that, the anchors of the blocks that come after the last
+          match in the remote file are searched for with ``find()``,
+          which finds where the remote file resumes after a change of
+          any size without touching each byte in Python. Candidates
+          are confirmed with the checksums.
+
+    If neither finds anything, the rest of the data is only checked at
+    block boundaries until a block matches again. This means blocks
+    that were moved far from where they were and lost their alignment
+    are sent as literal data, but data that's all new is processed at
+    the speed of the checksums rather than a byte at a time.
+
+    """
+
+    def __init__(self, data, blocks, anchors, block_size):
+        self.data = data
+        self.blocks = blocks
+        self.anchors = anchors
+        self.block_size = block_size
+        self.end = len(data) - block_size + 1
+        # Where the search for each anchor failed; data doesn't change,
+        # so it would fail again from anywhere after that.
+        self._missing = {}
+
+    def __iter__(self):
+        """Yield ``(pos, index)`` for each matching block in order."""
+        pos = 0
+        next_index = 0
+        search = True
+        while self.blocks and pos < self.end:
+            index = match_block(self.data, pos, self.block_size, self.blocks)
+            if index is None and search:
+                found, index = self.find(pos + 1, next_index)
+                if index is None:
+                    search = False
+                else:
+                    pos = found
+            if index is None:
+                pos += self.block_size
+                continue
+            yield pos, index
+            pos += self.block_size
+            next_index = index + 1
+            search = True
+
+    def find(self, pos, next_index):
+        """Find the next block at or after ``pos``.
+
+        Returns a tuple of ``(pos, index)`` or ``(None, None)``.
+
+        """
+        if pos >= self.end:
+            return None, None
+        stop = min(pos + SCAN_BLOCKS * self.block_size, self.end)
+        found, index = scan(self.data, pos, stop, self.block_size, self.blocks)
+        if index is not None:
+            return found, index
+        return self.find_anchor(stop, next_index)
+
+    def find_anchor(self, pos, next_index):
+        data = self.data
+        best = (None, None)
+        limit = self.end
+        for index in range(next_index, min(next_index + ANCHOR_LOOKAHEAD, len(self.anchors))):
+            if pos >= self._missing.get(index, self.end):
+                continue
+            start = pos
+            for _ in range(MAX_ANCHOR_TRIES):
+                found = data.find(self.anchors[index], start, limit + ANCHOR_SIZE - 1)
+                if found == -1:
+                    if best[0] is None:
+                        self._missing[index] = pos
+                    break
+                match = match_block(data, found, self.block_size, self.blocks)
+                if match is not None:
+                    # Later anchors only need to be searched for before
+                    # this one.
+                    best = (found, match)
+                    limit = found
+                    break
+                start = found + 1
+        return best
+
+
+def make_delta(data, blocks, block_size, anchors=()):
+    """Make a delta that turns the remote file into ``data``.
+
+    ``blocks`` and ``anchors`` come from the remote file's block
+    signatures (see :func:`parse_signature`); the blocks are found in
+    ``data`` with :class:`BlockFinder`. Runs of matching blocks are
+    sent as copy instructions; everything else is sent as literal data.
+
+    Yields chunks of the (uncompressed) delta.
+
+    """
+    literal_start = 0
+    copy_start = copy_count = None
+
+    def flush_copy():
+        if copy_count:
+            yield COPY.pack(b'C', copy_start, copy_count)
+
+    def flush_literal(end):
+        start = literal_start
+        while start < end:
+            chunk = data[start:min(end, start + HASH_READ_SIZE)]
+            yield DATA.pack(b'D', len(chunk))
+            yield bytes(chunk)
+            start += len(chunk)
+
+    for pos, index in BlockFinder(data, blocks, anchors, block_size):
+        if pos > literal_start:
+            yield from flush_copy()
+            copy_count = None
+            yield from flush_literal(pos)
+        if copy_count and copy_start + copy_count == index:
+            copy_count += 1
+        else:
+            yield from flush_copy()
+            copy_start, copy_count = index, 1
+        literal_start = pos + block_size
+
+    yield from flush_copy()
+    yield from flush_literal(len(data))
+
+
+def compress_delta(chunks, level=6, frame_size=FRAME_SIZE):
+    """Compress delta chunks into frames of about ``frame_size`` bytes.
+
+    Frames are yielded as they fill up, so the delta is never held in
+    memory all at once.
+
+    """
+    compressor = zlib.compressobj(level)
+    frame = []
+    frame_length = 0
+    for chunk in chunks:
+        view = memoryview(chunk)
+        # Big chunks are compressed in pieces so frames don't get much
+        # bigger than frame_size when the data doesn't compress.
+        for start in range(0, len(view), frame_size):
+            data = compressor.compress(view[start:start + frame_size])
+            if data:
+                frame.append(data)
+                frame_length += len(data)
+                if frame_length >= frame_size:
+                    yield b''.join(frame)
+                    frame = []
+                    frame_length = 0
+    frame.append(compressor.flush())
+    yield b''.join(frame)
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(HASH_READ_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_manifest_directory():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'taskrunner', 'sync')
+
+
+class Syncer:
+
+    """Push a local directory tree to a host via its :class:`Agent`.
+
+    Only files that differ are transferred, and only the parts of them
+    that differ: the host sends block signatures of its copy of a file
+    and a delta against them is sent back (see :func:`make_delta`),
+    compressed with zlib and streamed in frames, so files of any size
+    can be sent. Files are handled in parallel.
+
+    A manifest of what was last synced to each host and destination is
+    kept in ``$XDG_CACHE_HOME/taskrunner/sync``, along with the hashes
+    of the local files (keyed by their size and mtime so files aren't
+    hashed again unless they change). Files whose hashes match the
+    manifest are skipped without contacting the host at all, so syncing
+    an unchanged tree doesn't make any connection. Pass ``check=True``
+    to ignore the manifest and compare against the host.
+
+    If ``delete`` is set, files that were previously synced but no
+    longer exist locally are removed from the host.
+
+    """
+
+    def __init__(self, source, destination, host_key, exclude=None, delete=False, check=False,
+                 jobs=4, compress_level=6):
+        self.source = os.path.abspath(source)
+        self.destination = destination
+        self.host_key = host_key
+        self.exclude = as_list(exclude)
+        self.delete = delete
+        self.check = check
+        self.jobs = jobs
+        self.compress_level = compress_level
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        manifest_key = hashlib.sha1(
+            json.dumps([host_key, destination, self.source]).encode()).hexdigest()
+        self.manifest_path = os.path.join(get_manifest_directory(), manifest_key + '.json')
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path) as fp:
+                manifest = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+        return manifest.get('local', {}), manifest.get('remote', {})
+
+    def save_manifest(self, local, remote):
+        directory = os.path.dirname(self.manifest_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'local': local, 'remote': remote}, fp)
+        os.replace(temp_path, self.manifest_path)
+
+    def is_excluded(self, rel_path):
+        name = os.path.basename(rel_path)
+        return any(
+            fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern)
+            for pattern in self.exclude)
+
+    def scan(self, local_cache):
+        """Get ``{rel_path: [size, mtime_ns, mode, sha256]}`` for the tree.
+
+        Hashes are reused from ``local_cache`` for files whose size and
+        mtime haven't changed; the rest are hashed in parallel.
+
+        """
+        files = {}
+        for dir_path, dir_names, file_names in os.walk(self.source):
+            rel_dir = os.path.relpath(dir_path, self.source)
+            dir_names[:] = [
+                d for d in sorted(dir_names)
+                if not self.is_excluded(os.path.normpath(os.path.join(rel_dir, d)))]
+            for name in sorted(file_names):
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+                if self.is_excluded(rel_path):
+                    continue
+                st = os.stat(os.path.join(dir_path, name))
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                entry = [st.st_size, st.st_mtime_ns, stat.S_IMODE(st.st_mode), None]
+                cached = local_cache.get(rel_path)
+                if cached and cached[:2] == entry[:2]:
+                    entry[3] = cached[3]
+                files[rel_path] = entry
+        to_hash = [rel_path for rel_path, entry in files.items() if entry[3] is None]
+        if to_hash:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                paths = [os.path.join(self.source, rel_path) for rel_path in to_hash]
+                for rel_path, digest in zip(to_hash, executor.map(hash_file, paths)):
+                    files[rel_path][3] = digest
+        return files
+
+    def plan(self):
+        """Figure out what needs to be synced.
+
+        Returns a tuple of ``(local files, remote manifest, changed,
+        deleted)``.
+
+        """
+        local_cache, remote = self.load_manifest()
+        local = self.scan(local_cache)
+        if self.check:
+            remote = {}
+        changed = [
+            rel_path for rel_path, entry in local.items()
+            if remote.get(rel_path) != [entry[3], entry[2]]]
+        deleted = []
+        if self.delete:
+            deleted = [rel_path for rel_path in remote if rel_path not in local]
+        return local, remote, changed, deleted
+
+    def remote_path(self, rel_path):
+        return posixpath.join(self.destination, *rel_path.split(os.sep))
+
+    def sync_file(self, agent, rel_path, entry):
+        """Sync a single file; returns whether it was transferred."""
+        size, _, mode, digest = entry
+        remote_path = self.remote_path(rel_path)
+        block_size = get_block_size(size)
+        message, signature = agent.call('signature', path=remote_path, block_size=block_size)
+        if message.get('exists'):
+            if message['sha256'] == digest:
+                if message['mode'] != mode:
+                    agent.call('chmod', path=remote_path, mode=mode)
+                return False
+            blocks, anchors = parse_signature(signature)
+        else:
+            blocks, anchors = {}, []
+        with open(os.path.join(self.source, rel_path), 'rb') as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            try:
+                delta = make_delta(data, blocks, block_size, anchors)
+                frames = self.count_sent(compress_delta(delta, self.compress_level))
+                agent.call(
+                    'patch', chunks=frames, path=remote_path, block_size=block_size,
+                    sha256=digest, mode=mode)
+            finally:
+                if size:
+                    data.close()
+        return True
+
+    def count_sent(self, frames):
+        for frame in frames:
+            with self._lock:
+                self.bytes_sent += len(frame)
+            yield frame
+
+    def run(self, get_agent):
+        """Sync the tree.
+
+        ``get_agent`` is called to get the :class:`Agent` for the host
+        if (and only if) anything needs to be synced.
+
+        Returns a dict with lists of the ``transferred``, ``unchanged``,
+        and ``deleted`` files and the number of ``bytes_sent``.
+
+        """
+        local, remote, changed, deleted = self.plan()
+        summary = {
+            'transferred': [],
+            'unchanged': [rel_path for rel_path in local if rel_path not in changed],
+            'deleted': deleted,
+            'bytes_sent': 0,
+        }
+        if changed or deleted:
+            agent = get_agent()
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                results = executor.map(
+                    lambda rel_path: self.sync_file(agent, rel_path, local[rel_path]), changed)
+                for rel_path, transferred in zip(changed, results):
+                    key = 'transferred' if transferred else 'unchanged'
+                    summary[key].append(rel_path)
+                    remote[rel_path] = [local[rel_path][3], local[rel_path][2]]
+                for rel_path in deleted:
+                    agent.call('remove', path=self.remote_path(rel_path))
+                    remote.pop(rel_path, None)
+            summary['bytes_sent'] = self.bytes_sent
+        self.save_manifest(local, remote)
+        return summary
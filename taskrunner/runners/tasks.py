@@ -1,31 +1,102 @@
+import hashlib
+import math
 import os
+import shlex
+import sys
+from collections import ChainMap, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from ..jobserver import JobSlots, get_jobserver
+from ..processes import map_in_processes
+from ..resources import get_limits, parse_resources, resource_pool
+from ..scheduler import OutputSlot
 from ..task import task
-from ..util import abort, abs_path, args_to_str, as_list
+from ..util import (
+    Capture, Hide, abort, abs_path, args_to_str, as_list, print_hr, print_info, print_success)
 
+from .agent import agent_pool
+from .cache import result_cache
+from .env import env_cache
 from .exc import RunAborted, RunError
+from .group import ProcessGroup
 from .local import LocalRunner
+from .pipeline import PipelineRunner
+from .session import RemoteSession
+from .ssh import ssh_pool
+from .sync import Syncer
 
 
-__all__ = ['local', 'remote']
+__all__ = [
+    'local', 'local_many', 'local_map', 'map_in_processes', 'remote', 'remote_many',
+    'remote_session', 'sync']
+
+
+# The max length of a single arg on Linux (MAX_ARG_STRLEN). Batches
+# built by local_map() are kept under this so that they work even when
+# the command is run via ``sh -c``, where the whole command is one arg.
+MAX_ARG_STRLEN = 128 * 1024
 
 
 def get_default_prepend_path(config):
-    prepend_path = as_list(config._get_dotted('bin.dirs', []))
-    prepend_path = [abs_path(p, format_kwargs=config) for p in prepend_path]
-    prepend_path = [p for p in prepend_path if os.path.isdir(p)]
+    prepend_path = env_cache.get_bin_dirs(config)
     prepend_path = ':'.join(prepend_path)
     return prepend_path or None
 
 
+def get_failure_handler(kind, abort_on_failure):
+    # Failure handler for streaming runs, which fail after the command
+    # has been started and the caller has consumed its output.
+    def on_failure(exc):
+        if abort_on_failure:
+            msg = '{kind} command failed with exit code {exc.return_code}'
+            abort(2, msg.format(kind=kind, exc=exc))
+    return on_failure
+
+
+def get_cache_key(kind, parts, env=None, input=None, cache_inputs=None):
+    # Key for the result cache. Input that's streamed from a file object
+    # or iterator can't be included in the key, so it can't be cached.
+    inputs = [os.path.abspath(p) for p in as_list(cache_inputs)]
+    if isinstance(input, (bytes, bytearray, memoryview)):
+        parts += (hashlib.sha256(input).hexdigest(),)
+    elif isinstance(input, str):
+        inputs.append(os.path.abspath(input))
+    elif input is not None:
+        abort(1, 'Results of commands with streamed input cannot be cached')
+    return result_cache.make_key(kind, *parts, env=env, inputs=inputs)
+
+
+def get_cached_result(key, cache_ttl, cmd_str, echo, hide):
+    # Get result from cache and show its output as if it had been run.
+    result = result_cache.get(key, float(cache_ttl) if cache_ttl is not None else None)
+    if result is not None:
+        hide = Hide(hide) if hide is not None else Hide.none
+        if echo and hide not in (Hide.stdout, Hide.all):
+            print_hr()
+            print_info(' CACHED:', cmd_str)
+            print_hr()
+        if hide not in (Hide.stdout, Hide.all) and result.stdout_bytes:
+            sys.stdout.write(result.stdout)
+            sys.stdout.flush()
+        if hide not in (Hide.stderr, Hide.all) and result.stderr_bytes:
+            sys.stderr.write(result.stderr)
+            sys.stderr.flush()
+    return result
+
+
 @task
 def local(config, cmd, cd=None, path=None, prepend_path=None, append_path=None, sudo=False,
-          run_as=None, echo=False, hide=None, abort_on_failure=True, inject_context=True):
+          run_as=None, echo=False, hide=None, capture='full', capture_limit=None, stream=False,
+          passthrough=False, env=None, pipe=False, abort_on_failure=True, inject_context=True,
+          input=None, cpu_affinity=None, nice=None, ionice=None, rlimits=None, cache=False,
+          cache_ttl=None, cache_inputs=None, cache_env=None, resources=None):
     """Run a command locally.
 
     Args:
         cmd (str|list): The command to run locally; if it contains
-            format strings, those will be filled from ``config``
+            format strings, those will be filled from ``config``; if
+            ``pipe`` is set, this is a list of pipeline stages instead
         cd: Where to run the command on the remote host
         path: Replace ``$PATH`` with path(s)
         prepend_path: Add extra path(s) to front of ``$PATH``
@@ -33,29 +104,116 @@ def local(config, cmd, cd=None, path=None, prepend_path=None, append_path=None,
         sudo: Run as sudo?
         run_as: Run command as a different user with
             ``sudo -u <run_as>``
+        capture: How much output to capture in the result: "full",
+            "head_tail", or "none"; output is always streamed to the
+            console as it's produced unless it's hidden
+        capture_limit: Max bytes to capture when ``capture`` is
+            "head_tail"
+        stream: Instead of waiting for the command to finish, return
+            an iterator of ``(name, line)`` pairs as output is produced;
+            see :class:`StreamingRun`
+        passthrough: Let output that isn't hidden go straight to the
+            console without passing through Python; combine with
+            ``capture='none'`` when the result's output isn't needed
+        env (dict): Extra environment variables for the command
+        pipe: Run the commands in ``cmd`` as a pipeline, connecting
+            the output of each stage to the input of the next without
+            going through a shell; stages may also be Python callables
+            (see :class:`PipelineRunner`)
+        input: Input for the command's stdin: bytes, a file path, an
+            open file or file descriptor, or an iterable of chunks; it
+            is streamed to the command as it's consumed and file paths
+            and descriptors are handed to the command directly (see
+            :class:`Input`)
+        cpu_affinity: CPUs the command may run on, like "0-3,6"
+        nice: Increment to the command's nice level
+        ionice: I/O scheduling class and level, like "idle" or
+            "best-effort:7" (Linux only)
+        rlimits: Resource limits, like "as=2G,cpu=60,nofile=1024"
+        cache: Reuse the result of a previous successful run of the
+            same command (see below)
+        cache_ttl: Max age in seconds of a cached result to reuse
+        cache_inputs (list): Files or directories whose contents the
+            command's output depends on
+        cache_env (list): Names of environment variables the
+            command's output depends on
+        resources (dict|list): Named resources the command needs while
+            it runs, like "db" or "uploads:2" (see below)
+
+    The scheduling options and resource limits are applied to the
+    command before it's exec'd (see :class:`ProcessLimits`). Like
+    other options, they can be set for all local commands via
+    ``defaults.taskrunner.runners.tasks.local.*`` in the config.
 
     If none of the path options are specified, the default is prepend
     ``config.bin.dirs`` to the front of ``$PATH``
 
+    When ``cache`` is set, results are cached on disk (see
+    :class:`ResultCache`), keyed by the command, its cwd, its ``$PATH``,
+    ``env``, the variables named in ``cache_env``, its input, and the
+    contents of ``cache_inputs``. If a matching result is found, the
+    command isn't run and the cached output is shown instead. Only
+    commands that succeed are cached.
+
+    When ``resources`` are specified, the command waits until they're
+    available and holds them while it runs. The amount of a resource
+    that can be in use at once is set by ``resources.<name>`` in the
+    config (default 1; see :class:`ResourcePool`).
+
     """
     if sudo and run_as:
         abort(1, 'Only one of --sudo or --run-as may be passed')
-    if sudo:
-        cmd = ('sudo', cmd)
-    elif run_as:
-        cmd = ('sudo', '-u', run_as, cmd)
+    if pipe and stream:
+        abort(1, 'Only one of --pipe or --stream may be passed')
+    if resources and stream:
+        abort(1, 'Only one of --resources or --stream may be passed')
+    if cache and (pipe or stream or Capture(capture) is not Capture.full):
+        abort(1, '--cache can only be used when all output is captured (and not streamed)')
 
-    cmd = args_to_str(cmd, format_kwargs=(config if inject_context else None))
+    def prepare(cmd):
+        if sudo:
+            cmd = ('sudo', cmd)
+        elif run_as:
+            cmd = ('sudo', '-u', run_as, cmd)
+        return args_to_str(cmd, format_kwargs=(config if inject_context else None))
+
+    if pipe:
+        cmd = [stage if callable(stage) else prepare(stage) for stage in cmd]
+    else:
+        cmd = prepare(cmd)
 
     if path is prepend_path is append_path is None:
         prepend_path = get_default_prepend_path(config)
 
-    runner = LocalRunner()
+    if cache:
+        cache_env_vars = {name: os.environ.get(name) for name in as_list(cache_env)}
+        cache_env_vars.update(env or {})
+        cache_env_vars['PATH'] = (
+            env_cache.get_env(path, prepend_path, append_path)[1] or os.environ.get('PATH'))
+        cache_parts = (cmd, os.path.abspath(cd or os.curdir))
+        cache_key = get_cache_key('local', cache_parts, cache_env_vars, input, cache_inputs)
+        result = get_cached_result(cache_key, cache_ttl, cmd, echo, hide)
+        if result is not None:
+            return result
+
+    run_kwargs = dict(
+        cd=cd, path=path, prepend_path=prepend_path, append_path=append_path, env=env, echo=echo,
+        hide=hide, capture=capture, capture_limit=capture_limit, passthrough=passthrough,
+        input=input, cpu_affinity=cpu_affinity, nice=nice, ionice=ionice, rlimits=rlimits,
+        debug=config.debug)
+
+    resources = parse_resources(resources, format_kwargs=config)
 
     try:
-        return runner.run(
-            cmd, cd=cd, path=path, prepend_path=prepend_path, append_path=append_path, echo=echo,
-            hide=hide, debug=config.debug)
+        with resource_pool.hold(resources, get_limits(config, resources)):
+            if pipe:
+                return PipelineRunner().run(cmd, **run_kwargs)
+            result = LocalRunner().run(
+                cmd, stream=stream, on_failure=get_failure_handler('Local', abort_on_failure),
+                **run_kwargs)
+        if cache:
+            result_cache.put(cache_key, result)
+        return result
     except RunAborted as exc:
         if config.debug:
             raise
@@ -66,10 +224,135 @@ def local(config, cmd, cd=None, path=None, prepend_path=None, append_path=None,
         return exc
 
 
+def local_many(config, cmds, jobs=None, fail_fast=False, abort_on_failure=True, **kwargs):
+    """Run local commands concurrently.
+
+    Args:
+        cmds (list): The commands to run; each is run with :func:`local`
+        jobs (int): Max number of commands to run at once; defaults to
+            the number of jobserver slots or the number of CPUs; when a
+            jobserver is active, each command beyond the first also
+            needs a jobserver token to run
+        fail_fast: When a command fails, kill the commands that are
+            still running and don't start any more
+        abort_on_failure: Abort after all the commands have finished
+            if any of them failed
+        kwargs: Passed through to :func:`local` for each command
+
+    Returns:
+        list: A result for each command in the same order as ``cmds``;
+            commands that weren't started because of ``fail_fast`` will
+            have ``None`` as their result
+
+    """
+    if kwargs.get('stream') or kwargs.get('pipe'):
+        raise ValueError('local_many() does not support stream or pipe')
+
+    cmds = list(cmds)
+    jobserver = get_jobserver()
+    jobs = jobs or (jobserver and jobserver.jobs) or os.cpu_count() or 1
+    slots = JobSlots(jobserver)
+    group = ProcessGroup()
+    output_slot = OutputSlot.current()
+    results = [None] * len(cmds)
+
+    def run(cmd):
+        if group.killed:
+            return None
+        with slots.slot(), group.activate(), OutputSlot.inherit(output_slot):
+            if group.killed:
+                return None
+            result = local(config, cmd, abort_on_failure=False, **kwargs)
+        if result.failed and fail_fast:
+            group.kill()
+        return result
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run, cmd): i for i, cmd in enumerate(cmds)}
+        try:
+            for future in as_completed(futures):
+                exc = future.exception()
+                if exc is not None:
+                    group.kill()
+                    for other in futures:
+                        other.cancel()
+                    raise exc
+                results[futures[future]] = future.result()
+        finally:
+            executor.shutdown()
+            slots.close()
+
+    num_failed = sum(1 for result in results if result is None or result.failed)
+    if num_failed and abort_on_failure:
+        abort(2, '{num_failed} of {num_cmds} local commands failed or were cancelled'.format(
+            num_failed=num_failed, num_cmds=len(cmds)))
+
+    return results
+
+
+def local_map(config, cmd, items, max_args=None, inject_context=True, **kwargs):
+    """Run a local command over many items concurrently, like xargs -P.
+
+    The items are shell-quoted and packed into batches that are
+    appended to ``cmd``. Each batch is kept under the system's arg
+    length limits, and ``max_args`` can be used to limit the number of
+    items per batch (e.g., pass 1 to run ``cmd`` once per item).
+
+    ``cmd`` is formatted with ``config`` before the items are added, so
+    items can contain braces.
+
+    Remaining args are passed through to :func:`local_many`.
+
+    Returns:
+        list: A result for each batch, in order
+
+    """
+    cmd = args_to_str(cmd, format_kwargs=(config if inject_context else None))
+    batches = pack_args(cmd, items, max_args)
+    cmds = [' '.join([cmd] + batch) for batch in batches]
+    return local_many(config, cmds, inject_context=False, **kwargs)
+
+
+def get_arg_max():
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    return arg_max if arg_max > 0 else MAX_ARG_STRLEN
+
+
+def pack_args(cmd, items, max_args=None):
+    # Pack shell-quoted items into batches that can be appended to cmd.
+    # Sizes are counted the way the kernel does: each arg costs its length
+    # plus a NUL terminator plus a pointer, and the environment counts
+    # against the limit too (this is what xargs does).
+    env_size = sum(len(k) + len(v) + 2 + 8 for (k, v) in os.environ.items())
+    limit = min(get_arg_max() - env_size - 2048, MAX_ARG_STRLEN) - len(cmd.encode()) - 1
+    batches = []
+    batch = []
+    size = 0
+    for item in items:
+        arg = shlex.quote(str(item))
+        arg_size = len(arg.encode()) + 1 + 8
+        if arg_size > limit:
+            raise ValueError('Arg is too long: {arg:.40}...'.format(arg=arg))
+        if batch and (size + arg_size > limit or (max_args and len(batch) >= max_args)):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(arg)
+        size += arg_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 @task
 def remote(config, cmd, host=None, user=None, cd=None, path=None, prepend_path=None,
-           append_path=None, sudo=False, run_as=None, echo=False, hide=None, abort_on_failure=True,
-           inject_context=True):
+           append_path=None, sudo=False, run_as=None, echo=False, hide=None, capture='full',
+           capture_limit=None, stream=False, passthrough=False, abort_on_failure=True,
+           inject_context=True, input=None, cache=False, cache_ttl=None, cache_inputs=None,
+           multiplex=True, jobs=None, batches=None, prefix=None, agent=False, resources=None):
     """Run a command on the remote host via SSH.
 
     Args:
@@ -77,7 +360,10 @@ def remote(config, cmd, host=None, user=None, cd=None, path=None, prepend_path=N
             contains format strings, those will be filled from ``config``
         user: The user to log in as; command will be run as this user
             unless ``sudo`` or ``run_as`` is specified
-        host: The remote host
+        host (str|list): The remote host; to run the command on several
+            hosts, pass a list of hosts, a comma-separated string, or
+            ``@<group>`` to use the hosts in ``inventory.<group>`` from
+            the config (see :func:`remote_many`)
         cd: Where to run the command on the remote host
         path: Replace ``$PATH`` on remote host with path(s)
         prepend_path: Add extra path(s) to front of remote ``$PATH``
@@ -85,8 +371,61 @@ def remote(config, cmd, host=None, user=None, cd=None, path=None, prepend_path=N
         sudo: Run as sudo?
         run_as: Run command as a different user with
             ``sudo -u <run_as>``
+        capture: How much output to capture in the result: "full",
+            "head_tail", or "none"
+        capture_limit: Max bytes to capture when ``capture`` is
+            "head_tail"
+        stream: Return an iterator of ``(name, line)`` pairs instead
+            of waiting for the command to finish
+        passthrough: Let output that isn't hidden go straight to the
+            console without passing through Python
+        input: Input for the remote command's stdin; see :func:`local`
+        cache: Reuse the result of a previous successful run of the
+            same command on the same host; see :func:`local`
+        cache_ttl: Max age in seconds of a cached result to reuse;
+            setting this is recommended since the remote state can't be
+            included in the cache key
+        cache_inputs (list): Local files or directories whose contents
+            the command's output depends on
+        multiplex: Reuse a persistent master connection to the host
+            (see :class:`SSHPool`)
+        jobs (int): Max number of hosts to run the command on at once
+        batches (str|list): Rolling batch sizes, like "1,25%"
+        prefix: Prefix for each line of output shown on the console
+        agent: Run the command via a persistent agent on the host
+            instead of via a new ssh session and shell script (see
+            :class:`Agent`); the agent is started with the Python
+            specified by ``remote.agent_python`` in the config (default
+            "python3")
+        resources (dict|list): Named resources the command needs while
+            it runs (see :func:`local`); names may contain ``{host}``
+            for per-host resources, like "apt-{host}"
+
+    Returns:
+        Result: When run on a single host
+        OrderedDict: When run on several hosts, a map of hosts to
+            results (see :func:`remote_many`)
 
     """
+    if cache and (stream or Capture(capture) is not Capture.full):
+        abort(1, '--cache can only be used when all output is captured (and not streamed)')
+    if agent and stream:
+        abort(1, 'Only one of --agent or --stream may be passed')
+    if resources and stream:
+        abort(1, 'Only one of --resources or --stream may be passed')
+
+    hosts = get_hosts(config, host)
+    if hosts is not None:
+        if stream:
+            abort(1, '--stream can only be used with a single host')
+        return remote_many(
+            config, cmd, hosts, jobs=jobs, batches=batches, abort_on_failure=abort_on_failure,
+            user=user, cd=cd, path=path, prepend_path=prepend_path, append_path=append_path,
+            sudo=sudo, run_as=run_as, echo=echo, hide=hide, capture=capture,
+            capture_limit=capture_limit, passthrough=passthrough, inject_context=inject_context,
+            input=input, cache=cache, cache_ttl=cache_ttl, cache_inputs=cache_inputs,
+            multiplex=multiplex, agent=agent, resources=resources)
+
     cmd = args_to_str(cmd, format_kwargs=(config if inject_context else None))
     user = args_to_str(user, format_kwargs=config)
     host = args_to_str(host, format_kwargs=config)
@@ -102,16 +441,7 @@ def remote(config, cmd, host=None, user=None, cd=None, path=None, prepend_path=N
     else:
         ssh_connection_str = host
 
-    if path or prepend_path or append_path:
-        if path:
-            path = [path]
-        else:
-            path = ['$PATH']
-        if prepend_path:
-            path = [prepend_path] + path
-        if append_path:
-            path = path + [append_path]
-        path = ':'.join(path)
+    path = get_remote_path(path, prepend_path, append_path)
 
     remote_cmd = []
 
@@ -120,29 +450,56 @@ def remote(config, cmd, host=None, user=None, cd=None, path=None, prepend_path=N
     elif run_as and run_as != user:
         remote_cmd.append('sudo -u {run_as}'.format(run_as=run_as))
 
-    bash_cmd = ["bash <<'EOBASH'"]
+    script = []
     if cd:
-        bash_cmd.append('  cd {cd} || exit 1\n'.format(cd=cd))
+        script.append('  cd {cd} || exit 1\n'.format(cd=cd))
     if path:
-        bash_cmd.append('  export PATH="{path}"\n'.format(path=path))
-    bash_cmd.append('  {cmd}'.format(cmd=cmd))
-    bash_cmd.append('EOBASH')
-    bash_cmd = '\n'.join(bash_cmd)
+        script.append('  export PATH="{path}"\n'.format(path=path))
+    script.append('  {cmd}'.format(cmd=cmd))
+
+    if input is None:
+        bash_cmd = '\n'.join(["bash <<'EOBASH'"] + script + ['EOBASH'])
+    else:
+        # The heredoc would take the place of stdin, so the script is
+        # passed as an arg instead and stdin is left for the input.
+        bash_cmd = 'bash -c {script}'.format(script=shlex.quote('\n'.join(script)))
     remote_cmd.append(bash_cmd)
 
     remote_cmd = ' '.join(remote_cmd)
 
-    # ssh -T someone@somehost sudo -u svusrXYZ bash <<'EOBASH'
+    if cache:
+        cache_parts = (ssh_connection_str, remote_cmd)
+        cache_key = get_cache_key('remote', cache_parts, None, input, cache_inputs)
+        result = get_cached_result(cache_key, cache_ttl, remote_cmd, echo, hide)
+        if result is not None:
+            return result
+
+    # ssh -T [-o ControlPath=...] someone@somehost sudo -u svusrXYZ bash <<'EOBASH'
     #     cd <cd> || exit 1
     #     export PATH="<path>"
     #     <cmd>
     # EOBASH
-    ssh_cmd = ['ssh', '-T', ssh_connection_str, remote_cmd]
+    ssh_options = ssh_pool.get_options(ssh_connection_str) if multiplex else []
+    ssh_cmd = ['ssh', '-T'] + ssh_options + [ssh_connection_str, remote_cmd]
 
     runner = LocalRunner()
+    resources = parse_resources(resources, format_kwargs=ChainMap({'host': host}, config))
 
     try:
-        return runner.run(ssh_cmd, echo=echo, hide=hide, debug=config.debug)
+        with resource_pool.hold(resources, get_limits(config, resources)):
+            if agent:
+                result = run_via_agent(
+                    config, ssh_cmd[:-1], ssh_connection_str, cmd, user=user, cd=cd, path=path,
+                    sudo=sudo, run_as=run_as, echo=echo, hide=hide, capture=capture,
+                    capture_limit=capture_limit, input=input, prefix=prefix)
+            else:
+                result = runner.run(
+                    ssh_cmd, echo=echo, hide=hide, capture=capture, capture_limit=capture_limit,
+                    stream=stream, on_failure=get_failure_handler('Remote', abort_on_failure),
+                    passthrough=passthrough, input=input, prefix=prefix, debug=config.debug)
+        if cache:
+            result_cache.put(cache_key, result)
+        return result
     except RunAborted as exc:
         if config.debug:
             raise
@@ -151,3 +508,281 @@ def remote(config, cmd, host=None, user=None, cd=None, path=None, prepend_path=N
         if abort_on_failure:
             abort(2, 'Remote command failed with exit code {exc.return_code}'.format(**locals()))
         return exc
+
+
+def run_via_agent(config, ssh_cmd, ssh_connection_str, cmd, user=None, cd=None, path=None,
+                  sudo=False, run_as=None, **kwargs):
+    # Run a remote command via the host's agent. The command is run with
+    # bash directly, so cd and PATH are handled by the agent.
+    agent = agent_pool.get(
+        ssh_connection_str, ssh_cmd, config._get_dotted('remote.agent_python', 'python3'))
+    agent_cmd = ['bash', '-c', cmd]
+    if sudo:
+        agent_cmd = ['sudo'] + agent_cmd
+    elif run_as and run_as != user:
+        agent_cmd = ['sudo', '-u', run_as] + agent_cmd
+    return agent.run(agent_cmd, cwd=cd or None, path=path or None, **kwargs)
+
+
+def get_remote_path(path=None, prepend_path=None, append_path=None):
+    if path or prepend_path or append_path:
+        if path:
+            path = [path]
+        else:
+            path = ['$PATH']
+        if prepend_path:
+            path = [prepend_path] + path
+        if append_path:
+            path = path + [append_path]
+        path = ':'.join(path)
+    return path
+
+
+@contextmanager
+def remote_session(config, host=None, user=None, cd=None, path=None, prepend_path=None,
+                   append_path=None, sudo=False, run_as=None, echo=None, hide=None,
+                   keep_going=False, abort_on_failure=True, multiplex=True):
+    """Run several remote commands over a single SSH connection.
+
+    Commands queued in the block are sent to the host together as one
+    script when the block exits, and each command gets its own result::
+
+        with remote_session(config, host='example.com') as session:
+            version = session.run('cat VERSION')
+            session.run('./install.sh', cd='/srv/app')
+
+        print(version.result().stdout)
+
+    Call ``session.execute()`` to run the commands queued so far before
+    the end of the block. If the block raises, the queued commands are
+    discarded.
+
+    The args are the same as for :func:`remote`. ``cd`` is the default
+    for each command and can be overridden per command. ``keep_going``
+    runs all the commands even if some of them fail (by default, the
+    session stops at the first failure). See :class:`RemoteSession`.
+
+    """
+    user = args_to_str(user, format_kwargs=config)
+    host = args_to_str(host, format_kwargs=config)
+    cd = args_to_str(cd, format_kwargs=config)
+    path = args_to_str(path, format_kwargs=config)
+    run_as = args_to_str(run_as, format_kwargs=config)
+
+    if not host:
+        raise ValueError('host must be specified')
+
+    if user:
+        ssh_connection_str = '{user}@{host}'.format(user=user, host=host)
+    else:
+        ssh_connection_str = host
+
+    if sudo:
+        sudo_cmd = 'sudo'
+    elif run_as and run_as != user:
+        sudo_cmd = 'sudo -u {run_as}'.format(run_as=run_as)
+    else:
+        sudo_cmd = None
+
+    if echo is None:
+        echo = config._get_dotted('run.echo', False)
+    if hide is None:
+        hide = config._get_dotted('run.hide', 'none')
+
+    ssh_options = ssh_pool.get_options(ssh_connection_str) if multiplex else []
+    ssh_cmd = ['ssh', '-T'] + ssh_options + [ssh_connection_str]
+
+    session = RemoteSession(
+        ssh_cmd, sudo_cmd=sudo_cmd, cd=cd or None,
+        path=get_remote_path(path, prepend_path, append_path), echo=echo, hide=hide,
+        keep_going=keep_going, abort_on_failure=abort_on_failure, format_kwargs=config,
+        debug=config.debug)
+
+    try:
+        yield session
+    except BaseException:
+        session.cancel()
+        raise
+    session.execute()
+
+
+def get_hosts(config, host):
+    # Get the list of hosts if ``host`` specifies multiple hosts;
+    # returns None if it's a single host.
+    if isinstance(host, str):
+        host = args_to_str(host, format_kwargs=config)
+        if host.startswith('@'):
+            group = host[1:]
+            try:
+                host = config._get_dotted('inventory.{group}'.format(group=group))
+            except KeyError:
+                abort(1, 'Unknown inventory group: {group}'.format(group=group))
+        elif ',' not in host:
+            return None
+    if not isinstance(host, (list, tuple, str)):
+        return None
+    hosts = [args_to_str(h, format_kwargs=config) for h in as_list(host)]
+    hosts = list(OrderedDict.fromkeys(h for h in hosts if h))
+    if not hosts:
+        raise ValueError('host must be specified')
+    return hosts
+
+
+def get_batches(hosts, batches=None):
+    # Split hosts into rolling batches. Each batch size is a number of
+    # hosts or a percentage of the total; the last size is repeated
+    # until all the hosts have been assigned to a batch.
+    sizes = []
+    for size in as_list(batches):
+        size = str(size).strip()
+        if size.endswith('%'):
+            size = math.ceil(len(hosts) * float(size[:-1]) / 100)
+        sizes.append(max(int(size), 1))
+    sizes = sizes or [len(hosts)]
+    i = 0
+    while i < len(hosts):
+        size = sizes.pop(0) if len(sizes) > 1 else sizes[0]
+        yield hosts[i:i + size]
+        i += size
+
+
+def remote_many(config, cmd, hosts, jobs=None, batches=None, abort_on_failure=True, **kwargs):
+    """Run a remote command on several hosts concurrently.
+
+    Args:
+        cmd (str|list): The command to run on each host
+        hosts (list): The hosts to run the command on
+        jobs (int): Max number of hosts to run the command on at once;
+            defaults to all of the hosts in a batch
+        batches (str|list): Rolling batch sizes; each size is a number
+            of hosts or a percentage of the hosts, and the last size is
+            repeated (e.g., "1,25%" runs on one canary host and then on
+            25% of the hosts at a time); if the command fails on any
+            host in a batch, the remaining batches aren't run
+        abort_on_failure: Abort if the command fails on any host
+        kwargs: Passed through to :func:`remote` for each host
+
+    Each line of output shown on the console is prefixed with its host.
+
+    Returns:
+        OrderedDict: A map of hosts to results, in the same order as
+            ``hosts``; hosts in batches that weren't run will have
+            ``None`` as their result
+
+    """
+    input = kwargs.get('input')
+    if input is not None and not isinstance(input, (bytes, bytearray, memoryview, str)):
+        raise ValueError('Input for multiple hosts must be bytes or a file path')
+
+    hosts = list(hosts)
+    width = max(len(host) for host in hosts)
+    results = OrderedDict((host, None) for host in hosts)
+    failed = []
+    output_slot = OutputSlot.current()
+
+    def run(host):
+        prefix = '{host:<{width}} | '.format(host=host, width=width)
+        with OutputSlot.inherit(output_slot):
+            return remote(
+                config, cmd, host=host, abort_on_failure=False, prefix=prefix, **kwargs)
+
+    for batch in get_batches(hosts, batches):
+        with ThreadPoolExecutor(max_workers=min(jobs or len(batch), len(batch))) as executor:
+            futures = [(host, executor.submit(run, host)) for host in batch]
+            for host, future in futures:
+                results[host] = future.result()
+        failed = [host for host in batch if results[host].failed]
+        if failed:
+            break
+
+    if failed and abort_on_failure:
+        num_skipped = sum(1 for result in results.values() if result is None)
+        msg = 'Remote command failed on {num_failed} of {num_hosts} hosts: {failed}'
+        if num_skipped:
+            msg += ' ({num_skipped} hosts skipped)'
+        abort(2, msg.format(
+            num_failed=len(failed), num_hosts=len(hosts), failed=', '.join(failed),
+            num_skipped=num_skipped))
+
+    return results
+
+
+@task
+def sync(config, source, destination, host=None, user=None, delete=False, check=False,
+         exclude=None, jobs=4, compress_level=6, multiplex=True, echo=False, hide=None):
+    """Push a local directory to a remote host, sending only changes.
+
+    Args:
+        source: The local directory to sync
+        destination: The directory on the remote host to sync to
+        host: The remote host
+        user: The user to log in as
+        delete: Remove files from the remote host that were synced
+            previously but no longer exist locally
+        check: Compare all files against the remote host instead of
+            skipping files that haven't changed since the last sync
+        exclude (list): Glob patterns for files and directories to skip
+        jobs (int): Number of files to sync at once
+        compress_level: zlib compression level for data sent
+        multiplex: Reuse a persistent master connection to the host
+
+    Files are compared and transferred like rsync does it, via the
+    host's agent (see :class:`Syncer` and :class:`Agent`). Nothing is
+    sent to the host if none of the files have changed since the last
+    sync.
+
+    Returns:
+        dict: Lists of the ``transferred``, ``unchanged``, and
+            ``deleted`` files and the number of ``bytes_sent``
+
+    """
+    source = abs_path(source, format_kwargs=config)
+    destination = args_to_str(destination, format_kwargs=config)
+    user = args_to_str(user, format_kwargs=config)
+    host = args_to_str(host, format_kwargs=config)
+
+    if not host:
+        raise ValueError('host must be specified')
+    if not os.path.isdir(source):
+        abort(1, 'Not a directory: {source}'.format(source=source))
+
+    if user:
+        ssh_connection_str = '{user}@{host}'.format(user=user, host=host)
+    else:
+        ssh_connection_str = host
+
+    def get_agent():
+        ssh_options = ssh_pool.get_options(ssh_connection_str) if multiplex else []
+        ssh_cmd = ['ssh', '-T'] + ssh_options + [ssh_connection_str]
+        python = config._get_dotted('remote.agent_python', 'python3')
+        return agent_pool.get(ssh_connection_str, ssh_cmd, python)
+
+    syncer = Syncer(
+        source, destination, ssh_connection_str, exclude=exclude, delete=delete, check=check,
+        jobs=int(jobs), compress_level=int(compress_level))
+
+    try:
+        summary = syncer.run(get_agent)
+    except RunAborted as exc:
+        if config.debug:
+            raise
+        abort(1, str(exc))
+
+    hide = Hide(hide) if hide is not None else Hide.none
+    if hide not in (Hide.stdout, Hide.all):
+        if echo:
+            for rel_path in summary['transferred']:
+                print_info('   SENT:', rel_path)
+            for rel_path in summary['deleted']:
+                print_info('DELETED:', rel_path)
+        msg = (
+            'Synced {source} to {ssh_connection_str}:{destination}: {num_transferred} '
+            'transferred, {num_unchanged} unchanged, {num_deleted} deleted, '
+            '{bytes_sent} bytes sent')
+        print_success(msg.format(
+            source=source, ssh_connection_str=ssh_connection_str, destination=destination,
+            num_transferred=len(summary['transferred']),
+            num_unchanged=len(summary['unchanged']), num_deleted=len(summary['deleted']),
+            bytes_sent=summary['bytes_sent']))
+
+    return summary
@@ -0,0 +1,293 @@
+import io
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from .jobserver import JobSlots, get_jobserver
+from .resources import resource_pool
+
+
+__all__ = ['OrderedOutput', 'OutputSlot', 'Scheduler', 'TaskNode']
+
+
+class TaskNode:
+
+    """A task invocation in a run along with the nodes it depends on.
+
+    ``index`` is the node's position in the serial order of the run.
+    ``resources`` and ``limits`` are the amounts of named resources the
+    task needs and their limits (see :class:`ResourcePool`).
+
+    """
+
+    def __init__(self, task, args, index, depends=(), resources=None, limits=None):
+        self.task = task
+        self.args = args
+        self.index = index
+        self.depends = list(depends)
+        self.resources = resources or {}
+        self.limits = limits or {}
+        self.dependents = []
+        for node in self.depends:
+            node.dependents.append(self)
+
+    def __repr__(self):
+        return '<TaskNode {self.index}: {self.task.name} {self.args}>'.format(self=self)
+
+
+class Scheduler:
+
+    """Run task nodes, concurrently when possible.
+
+    If ``jobs`` is 1 (or unset), nodes are run one at a time in serial
+    order. Otherwise, nodes whose dependencies have completed are run on
+    a pool of ``jobs`` worker threads, in serial order as far as that's
+    possible. Each node also needs a job slot to run (see
+    :class:`JobSlots`), so tasks share the ``-j`` budget with the
+    commands they run (and with ``make``, if ``runtasks`` was run from
+    a make recipe).
+
+    Nodes that need named resources are only started when the resources
+    are available; in the meantime, later nodes that are ready and whose
+    resources are available are started instead. The resources are
+    acquired before a node is handed to a worker, so a worker is never
+    tied up waiting for them.
+
+    When a node fails, no more nodes are started. Nodes that are already
+    running are allowed to finish (like ``make`` does), and then the
+    first failure is re-raised.
+
+    Output from concurrently running nodes is kept in serial order (see
+    :class:`OrderedOutput`).
+
+    """
+
+    def __init__(self, jobs=None):
+        self.jobs = jobs
+
+    def run(self, nodes, run_node):
+        """Run ``nodes``, calling ``run_node(node)`` for each."""
+        if not self.jobs or self.jobs < 2:
+            for node in nodes:
+                run_node(node)
+            return
+
+        output = OrderedOutput(len(nodes))
+        slots = JobSlots(get_jobserver())
+        num_pending = {node: len(node.depends) for node in nodes}
+        ready = [node for node in nodes if not node.depends]
+        running = {}
+        failure = None
+
+        def work(node, acquired):
+            try:
+                with resource_pool.holding(acquired), slots.slot():
+                    with OutputSlot(output, node.index).activate():
+                        run_node(node)
+            finally:
+                output.finish(node.index)
+
+        try:
+            with output.install(), ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                while True:
+                    # Nodes are only handed out when a worker is free so
+                    # that queued nodes don't hold resources or run after
+                    # a failure.
+                    while ready and failure is None and len(running) < self.jobs:
+                        node, acquired = self.get_next(ready, bool(running))
+                        if node is None:
+                            break
+                        ready.remove(node)
+                        running[executor.submit(work, node, acquired)] = node
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in sorted(done, key=lambda f: running[f].index):
+                        node = running.pop(future)
+                        exc = future.exception()
+                        if exc is not None:
+                            failure = failure or exc
+                            continue
+                        for dependent in node.dependents:
+                            num_pending[dependent] -= 1
+                            if not num_pending[dependent]:
+                                ready.append(dependent)
+        finally:
+            slots.close()
+
+        if failure is not None:
+            raise failure
+
+    def get_next(self, ready, waiting):
+        """Get the next ready node whose resources are available.
+
+        Returns the node and the resources that were acquired for it. If
+        no node's resources are available and nothing else is running
+        (so nothing will release them), the first node is returned
+        without acquiring its resources; it will wait for them when it
+        runs. Otherwise, if nothing can be started, ``(None, None)`` is
+        returned.
+
+        """
+        ready = sorted(ready, key=lambda n: n.index)
+        for node in ready:
+            try:
+                acquired = resource_pool.try_acquire(node.resources, node.limits)
+            except ValueError:
+                # The node will fail with this error when it runs.
+                return node, {}
+            if acquired is not None:
+                return node, acquired
+        if not waiting:
+            return ready[0], {}
+        return None, None
+
+
+class OrderedOutput:
+
+    """Show output from concurrently running tasks in serial order.
+
+    Each task writes to a numbered slot. While this is installed,
+    ``sys.stdout`` and ``sys.stderr`` are replaced with proxies that
+    send text written from a thread with an active slot to that slot
+    (see :class:`OutputSlot`); other text is written through as usual.
+
+    The output of the first unfinished slot is shown as it's written.
+    Output for later slots is held until all of the slots before them
+    have finished, so the output of a run looks the same as if its
+    tasks had been run one after another.
+
+    """
+
+    def __init__(self, num_slots):
+        self.num_slots = num_slots
+        self._lock = threading.Lock()
+        self._chunks = [[] for _ in range(num_slots)]
+        self._finished = [False] * num_slots
+        self._head = 0
+        self._streams = {}
+
+    @contextmanager
+    def install(self):
+        self._streams = {'stdout': sys.stdout, 'stderr': sys.stderr}
+        sys.stdout = ConsoleProxy(self, 'stdout', self._streams['stdout'])
+        sys.stderr = ConsoleProxy(self, 'stderr', self._streams['stderr'])
+        try:
+            yield self
+        finally:
+            self.close()
+            sys.stdout = self._streams['stdout']
+            sys.stderr = self._streams['stderr']
+
+    def is_live(self, index):
+        """Is output for the slot at ``index`` being shown as written?"""
+        return index == self._head
+
+    def write(self, index, name, text):
+        with self._lock:
+            if index == self._head:
+                self._streams[name].write(text)
+            else:
+                self._chunks[index].append((name, text))
+
+    def finish(self, index):
+        """Mark a slot finished and show output that's now in order."""
+        with self._lock:
+            self._finished[index] = True
+            while self._head < self.num_slots and self._finished[self._head]:
+                self._head += 1
+                if self._head < self.num_slots:
+                    self._flush(self._head)
+
+    def close(self):
+        """Show all held output (e.g., for slots that never finished)."""
+        with self._lock:
+            for index in range(self._head, self.num_slots):
+                self._flush(index)
+            self._head = self.num_slots
+
+    def _flush(self, index):
+        chunks, self._chunks[index] = self._chunks[index], []
+        for name, text in chunks:
+            self._streams[name].write(text)
+        for stream in self._streams.values():
+            stream.flush()
+
+
+class OutputSlot:
+
+    """A slot in an :class:`OrderedOutput`.
+
+    Like a :class:`ProcessGroup`, a slot is activated per thread; code
+    that runs things in other threads on behalf of a task should
+    activate the task's slot in those threads::
+
+        slot = OutputSlot.current()
+
+        # In another thread
+        with OutputSlot.inherit(slot):
+            ...
+
+    """
+
+    _local = threading.local()
+
+    def __init__(self, output, index):
+        self.output = output
+        self.index = index
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'slot', None)
+
+    @classmethod
+    @contextmanager
+    def inherit(cls, slot):
+        """Activate ``slot``, which may be ``None``."""
+        previous = cls.current()
+        cls._local.slot = slot
+        try:
+            yield slot
+        finally:
+            cls._local.slot = previous
+
+    def activate(self):
+        return self.inherit(self)
+
+
+class ConsoleProxy:
+
+    """Stand-in for ``sys.stdout`` or ``sys.stderr`` (see :class:`OrderedOutput`)."""
+
+    def __init__(self, output, name, stream):
+        self._output = output
+        self._name = name
+        self._stream = stream
+
+    def _get_slot(self):
+        slot = OutputSlot.current()
+        return slot if slot is not None and slot.output is self._output else None
+
+    def write(self, text):
+        slot = self._get_slot()
+        if slot is None:
+            return self._stream.write(text)
+        self._output.write(slot.index, self._name, text)
+        return len(text)
+
+    def flush(self):
+        slot = self._get_slot()
+        if slot is None or self._output.is_live(slot.index):
+            self._stream.flush()
+
+    def fileno(self):
+        # Commands that write straight to the console (e.g., with
+        # passthrough) can only do so when their output isn't held.
+        slot = self._get_slot()
+        if slot is not None and not self._output.is_live(slot.index):
+            raise io.UnsupportedOperation('Output is being held for ordering')
+        return self._stream.fileno()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
@@ -0,0 +1,401 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from glob import iglob
+from itertools import chain
+
+
+__all__ = [
+    'FileIndex', 'Journal', 'TaskState', 'expand_paths', 'get_config_fingerprint',
+    'get_task_state',
+]
+
+
+STATE_DIRECTORY = '.taskrunner'
+
+# magic, number of entries, time the index was saved (ns)
+INDEX_HEADER = struct.Struct('!4sIq')
+
+INDEX_MAGIC = b'TRI1'
+
+# Length of the prefix shared with the previous path, length of the
+# rest of the path, size, mtime (ns), inode, content digest
+INDEX_ENTRY = struct.Struct('!HHQqQ16s')
+
+# Files modified this close to when they were hashed might be modified
+# again without their size or mtime changing (depending on the file
+# system's timestamp granularity), so they're always hashed again.
+RACY_WINDOW = 2 * 10 ** 9
+
+HASH_READ_SIZE = 1024 * 1024
+
+GLOB_CHARS = frozenset('*?[')
+
+# Files are hashed in batches so the overhead of handing work to the
+# thread pool isn't paid per file.
+HASH_BATCH_SIZE = 64
+
+
+def now_ns():
+    return int(time.time() * 10 ** 9)
+
+
+def hash_file(path):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(HASH_READ_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.digest()
+
+
+def hash_files(paths):
+    return [hash_file(path) for path in paths]
+
+
+def common_prefix_size(a, b):
+    # Binary search so the comparisons are done on slices (in C) rather
+    # than byte by byte.
+    low, high = 0, min(len(a), len(b), 0xffff)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def expand_paths(patterns, root=None):
+    """Expand glob patterns into a sorted list of abs. file paths.
+
+    Patterns are relative to ``root`` (the current directory by
+    default) and support ``**`` for any number of directories. A
+    directory matched by a pattern includes all the files under it.
+
+    Returns a tuple of ``(paths, unmatched patterns)``.
+
+    """
+    root = root or os.getcwd()
+    paths = set()
+    unmatched = []
+    for pattern in patterns:
+        full_pattern = os.path.join(root, os.path.expanduser(pattern))
+        if GLOB_CHARS.intersection(pattern):
+            matches = iglob(full_pattern, recursive=True)
+        else:
+            matches = [full_pattern] if os.path.exists(full_pattern) else []
+        matched = False
+        for match in matches:
+            matched = True
+            match = os.path.normpath(match)
+            if os.path.isdir(match):
+                for dir_path, _, file_names in os.walk(match):
+                    paths.update(os.path.join(dir_path, name) for name in file_names)
+            else:
+                paths.add(match)
+        if not matched:
+            unmatched.append(pattern)
+    return sorted(paths), unmatched
+
+
+class FileIndex:
+
+    """Persistent index of file states.
+
+    Maps paths to their size, mtime, inode, and a content digest. When
+    the digest of a file is requested, it's only hashed if its stat
+    info doesn't match the index (or if it was modified too recently to
+    trust its mtime); files that need hashing are hashed in parallel.
+
+    The index is stored in a compact binary format: a header followed
+    by fixed size entries sorted by path, with each path stored as the
+    length of the prefix it shares with the previous path plus the rest
+    of the path. Loading and saving are single reads and writes, and
+    saving is atomic.
+
+    """
+
+    def __init__(self, path, jobs=None):
+        self.path = path
+        self.jobs = jobs or min(32, (os.cpu_count() or 1) * 4)
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+
+    def load(self):
+        entries = {}
+        try:
+            with open(self.path, 'rb') as fp:
+                data = fp.read()
+            magic, count, saved_at = INDEX_HEADER.unpack_from(data)
+            if magic != INDEX_MAGIC:
+                raise ValueError('Not a file index')
+            offset = INDEX_HEADER.size
+            previous = b''
+            for _ in range(count):
+                prefix_size, suffix_size, size, mtime_ns, ino, digest = (
+                    INDEX_ENTRY.unpack_from(data, offset))
+                offset += INDEX_ENTRY.size
+                path = previous[:prefix_size] + data[offset:offset + suffix_size]
+                offset += suffix_size
+                trusted = mtime_ns < saved_at - RACY_WINDOW
+                entries[os.fsdecode(path)] = (size, mtime_ns, ino, digest, trusted)
+                previous = path
+        except (FileNotFoundError, ValueError, struct.error):
+            entries = {}
+        return entries
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = sorted((os.fsencode(p), e) for (p, e) in self._entries.items())
+            self._dirty = False
+        chunks = [INDEX_HEADER.pack(INDEX_MAGIC, len(entries), now_ns())]
+        previous = b''
+        for path, (size, mtime_ns, ino, digest, _) in entries:
+            prefix_size = common_prefix_size(previous, path)
+            suffix = path[prefix_size:]
+            chunks.append(INDEX_ENTRY.pack(
+                prefix_size, len(suffix), size, mtime_ns, ino, digest))
+            chunks.append(suffix)
+            previous = path
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(b''.join(chunks))
+        os.replace(temp_path, self.path)
+
+    def get_digests(self, paths):
+        """Get ``{path: digest}`` for ``paths``.
+
+        The digest of a file that doesn't exist is ``None``.
+
+        """
+        with self._lock:
+            if self._entries is None:
+                self._entries = self.load()
+            entries = self._entries
+        digests = {}
+        to_hash = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                digests[path] = None
+                with self._lock:
+                    if entries.pop(path, None) is not None:
+                        self._dirty = True
+                continue
+            key = (st.st_size, st.st_mtime_ns, st.st_ino)
+            entry = entries.get(path)
+            if entry is not None and entry[4] and entry[:3] == key:
+                digests[path] = entry[3]
+            else:
+                to_hash.append((path, key))
+        if to_hash:
+            hashed_at = now_ns()
+            paths_to_hash = [path for path, _ in to_hash]
+            batches = [
+                paths_to_hash[i:i + HASH_BATCH_SIZE]
+                for i in range(0, len(paths_to_hash), HASH_BATCH_SIZE)]
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                hashed = chain.from_iterable(executor.map(hash_files, batches))
+                for (path, key), digest in zip(to_hash, hashed):
+                    digests[path] = digest
+                    trusted = key[1] < hashed_at - RACY_WINDOW
+                    with self._lock:
+                        entries[path] = key + (digest, trusted)
+                        self._dirty = True
+        return digests
+
+    def get_digest(self, paths):
+        """Get a single digest for the names and contents of ``paths``."""
+        hasher = hashlib.sha256()
+        for path, digest in sorted(self.get_digests(paths).items()):
+            hasher.update(os.fsencode(path) + b'\0')
+            hasher.update(digest or b'-')
+        return hasher.hexdigest()
+
+
+class TaskState:
+
+    """State of tasks with declared inputs and outputs.
+
+    For each task invocation (task, env, and args), the digests of its
+    inputs and outputs after its last successful run are kept. If they
+    still match, the task doesn't need to be run again.
+
+    State is kept in the ``.taskrunner`` directory in the current
+    directory; removing it causes all tasks to be run again.
+
+    """
+
+    def __init__(self, directory=None):
+        self.directory = os.path.abspath(directory or STATE_DIRECTORY)
+        self.file_index = FileIndex(os.path.join(self.directory, 'files.idx'))
+        self.records_path = os.path.join(self.directory, 'tasks.json')
+        self._lock = threading.Lock()
+        self._records = None
+
+    def make_key(self, *parts):
+        data = json.dumps(parts, sort_keys=True, default=str).encode()
+        return hashlib.sha256(data).hexdigest()
+
+    def check(self, key, inputs, outputs):
+        """Check whether a task invocation is up to date.
+
+        Args:
+            key: The invocation's key (see :meth:`make_key`)
+            inputs (list): Input file patterns
+            outputs (list): Output file patterns; if any pattern doesn't
+                match anything, the task isn't up to date
+
+        Returns:
+            (bool, str): Whether the task is up to date and the digest
+                of its inputs, which should be passed to :meth:`record`
+                if the task is run successfully
+
+        """
+        input_paths, _ = expand_paths(inputs)
+        inputs_digest = self.file_index.get_digest(input_paths)
+        output_paths, unmatched = expand_paths(outputs)
+        record = self.get_records().get(key)
+        if record is None or unmatched or record[0] != inputs_digest:
+            up_to_date = False
+        else:
+            up_to_date = record[1] == self.file_index.get_digest(output_paths)
+        self.file_index.save()
+        return up_to_date, inputs_digest
+
+    def record(self, key, inputs_digest, outputs):
+        """Record a successful run of a task invocation."""
+        output_paths, _ = expand_paths(outputs)
+        outputs_digest = self.file_index.get_digest(output_paths)
+        self.file_index.save()
+        with self._lock:
+            records = self._load_records()
+            records[key] = [inputs_digest, outputs_digest]
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(records, fp)
+            os.replace(temp_path, self.records_path)
+
+    def get_records(self):
+        with self._lock:
+            return dict(self._load_records())
+
+    def _load_records(self):
+        if self._records is None:
+            try:
+                with open(self.records_path) as fp:
+                    self._records = json.load(fp)
+            except (FileNotFoundError, ValueError):
+                self._records = {}
+        return self._records
+
+
+class Journal:
+
+    """Journal of the task invocations completed in a run.
+
+    As each task invocation in a run completes, it's recorded in
+    ``.taskrunner/journal.json`` along with its env, args, and the
+    fingerprint of its config (see :func:`get_config_fingerprint`). The
+    journal is written atomically after each invocation, so it survives
+    a failed or interrupted run.
+
+    A run started with ``resume`` picks up the journal of the previous
+    run and skips invocations it records as completed, as long as their
+    config hasn't changed since. Other runs start a new journal. When a
+    run succeeds, its journal is removed.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = os.path.abspath(path or os.path.join(STATE_DIRECTORY, 'journal.json'))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._args = None
+
+    def start(self, args, resume=False):
+        """Start the journal for a run of ``args``."""
+        with self._lock:
+            self._args = list(args)
+            self._entries = OrderedDict()
+            if resume:
+                try:
+                    with open(self.path) as fp:
+                        journal = json.load(fp)
+                except (FileNotFoundError, ValueError):
+                    journal = {}
+                for entry in journal.get('completed', []):
+                    self._entries[entry['key']] = entry
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+
+    def make_key(self, task, env, kwargs):
+        return json.dumps([task.qualified_name, env, kwargs], sort_keys=True, default=str)
+
+    def is_completed(self, task, env, kwargs, fingerprint):
+        with self._lock:
+            entry = self._entries.get(self.make_key(task, env, kwargs))
+        return entry is not None and entry['fingerprint'] == fingerprint
+
+    def record(self, task, env, kwargs, fingerprint):
+        key = self.make_key(task, env, kwargs)
+        with self._lock:
+            self._entries[key] = {
+                'key': key,
+                'task': task.name,
+                'env': env,
+                'args': json.loads(json.dumps(kwargs, default=str)),
+                'fingerprint': fingerprint,
+                'completed_at': time.time(),
+            }
+            journal = {'args': self._args, 'completed': list(self._entries.values())}
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(journal, fp, indent=2)
+            os.replace(temp_path, self.path)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def get_config_fingerprint(config):
+    """Get a fingerprint of ``config`` for checking if it's changed.
+
+    Settings that only affect how output is shown (``run``) and
+    ``debug`` aren't included.
+
+    """
+    items = [(k, v) for (k, v) in config.items() if k not in ('run', 'debug')]
+    data = json.dumps(items, sort_keys=True, default=str).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+_task_state_lock = threading.Lock()
+_task_state = None
+
+
+def get_task_state():
+    """Get the task state for the current directory."""
+    global _task_state
+    with _task_state_lock:
+        if _task_state is None or _task_state.directory != os.path.abspath(STATE_DIRECTORY):
+            _task_state = TaskState()
+        return _task_state
@@ -1,19 +1,30 @@
 import argparse
 import inspect
+import json
 import os
+import threading
 import time
 from collections import OrderedDict
+from concurrent.futures import Future
 
-from .util import Hide, cached_property, get_hr, print_debug, print_info
+from .processes import TaskRef, run_in_processes
+from .resources import get_limits, parse_resources, resource_pool
+from .state import get_task_state
+from .util import Hide, args_to_str, as_list, cached_property, get_hr, print_debug, print_info
 
 
-__all__ = ['task']
+__all__ = ['InvocationCache', 'get_invocation_cache', 'set_invocation_cache', 'task']
 
 
 class Task:
 
     def __init__(self, implementation, name=None, description=None, help=None, type=None,
-                 default_env=None, timed=False):
+                 default_env=None, timed=False, depends=None, inputs=None, outputs=None,
+                 once=False, resources=None, executor=None):
+        if executor not in (None, 'thread', 'process'):
+            raise ValueError(
+                "Task executor must be 'thread' or 'process'; got {executor!r}".format(
+                    executor=executor))
         self.implementation = implementation
         self.name = name or implementation.__name__
         self.description = description
@@ -21,13 +32,20 @@ class Task:
         self.types = type or {}
         self.default_env = default_env or os.environ.get('TASKRUNNER_DEFAULT_ENV')
         self.timed = timed
+        self.depends = as_list(depends)
+        self.inputs = as_list(inputs)
+        self.outputs = as_list(outputs)
+        self.once = once
+        self.resources = resources
+        self.executor = executor
 
         self.qualified_name = '.'.join((implementation.__module__, implementation.__qualname__))
         self.defaults_path = '.'.join(('defaults', self.qualified_name))
 
     @classmethod
     def decorator(cls, name_or_wrapped=None, description=None, help=None, type=None,
-                  default_env=None, timed=False):
+                  default_env=None, timed=False, depends=None, inputs=None, outputs=None,
+                  once=False, resources=None, executor=None):
         if callable(name_or_wrapped):
             wrapped = name_or_wrapped
             name = wrapped.__name__
@@ -39,6 +57,12 @@ class Task:
                 type=type,
                 default_env=default_env,
                 timed=timed,
+                depends=depends,
+                inputs=inputs,
+                outputs=outputs,
+                once=once,
+                resources=resources,
+                executor=executor,
             )
         else:
             name = name_or_wrapped
@@ -52,6 +76,12 @@ class Task:
                 type=type,
                 default_env=default_env,
                 timed=timed,
+                depends=depends,
+                inputs=inputs,
+                outputs=outputs,
+                once=once,
+                resources=resources,
+                executor=executor,
             )
         return wrapper
 
@@ -60,16 +90,36 @@ class Task:
             start_time = time.monotonic()
 
         kwargs = self.parse_args(config, args)
+
+        if self.inputs or self.outputs:
+            # Skip the task if its inputs and outputs haven't changed
+            # since it was last run successfully.
+            state = get_task_state()
+            inputs = [args_to_str(pattern, format_kwargs=config) for pattern in self.inputs]
+            outputs = [args_to_str(pattern, format_kwargs=config) for pattern in self.outputs]
+            state_key = state.make_key(self.qualified_name, config.get('env'), kwargs)
+            up_to_date, inputs_digest = state.check(state_key, inputs, outputs)
+            if up_to_date:
+                if not self.is_hidden(config, kwargs):
+                    print_info('Skipping {self.name} task: up to date'.format(self=self))
+                return None
+
         result = self(config, **kwargs)
 
+        if self.inputs or self.outputs:
+            state.record(state_key, inputs_digest, outputs)
+
         if self.timed:
-            hide = kwargs.get('hide', config._get_dotted('run.hide', 'none'))
-            hide = Hide(hide) if hide is not None else Hide.none
-            if hide not in (Hide.stdout, Hide.all):
+            if not self.is_hidden(config, kwargs):
                 self.print_elapsed_time(time.monotonic() - start_time)
 
         return result
 
+    def is_hidden(self, config, kwargs):
+        hide = kwargs.get('hide', config._get_dotted('run.hide', 'none'))
+        hide = Hide(hide) if hide is not None else Hide.none
+        return hide in (Hide.stdout, Hide.all)
+
     def __call__(self, config, *args, **kwargs):
         if config.debug:
             print_debug('Task called:', self.name)
@@ -103,8 +153,40 @@ class Task:
             print_debug('    Final positional args:', repr(args))
             print_debug('    Final keyword args:', repr(kwargs))
 
+        invocations = get_invocation_cache()
+        if self.once and invocations is not None:
+            key = self.get_invocation_key(config, args, kwargs)
+            return invocations.call(key, self.call_implementation, config, *args, **kwargs)
+
+        return self.call_implementation(config, *args, **kwargs)
+
+    def call_implementation(self, config, *args, **kwargs):
+        if not self.resources:
+            return self.call_in_executor(config, *args, **kwargs)
+        resources = self.get_resources(config)
+        with resource_pool.hold(resources, get_limits(config, resources)):
+            return self.call_in_executor(config, *args, **kwargs)
+
+    def call_in_executor(self, config, *args, **kwargs):
+        if self.executor == 'process':
+            # CPU-bound tasks are run in a separate process so they don't
+            # hold the GIL while other tasks are running.
+            return run_in_processes(config, TaskRef(self), [(args, kwargs)], jobs=1)[0]
         return self.implementation(config, *args, **kwargs)
 
+    def get_resources(self, config):
+        return parse_resources(self.resources, format_kwargs=config)
+
+    def get_invocation_key(self, config, args, kwargs):
+        # Args are bound to the task's signature so that the same args
+        # passed positionally or by name (or left at their defaults)
+        # have the same key.
+        bound_args = self.signature.bind(config, *args, **kwargs)
+        bound_args.apply_defaults()
+        arguments = list(bound_args.arguments.items())[1:]
+        data = json.dumps(arguments, sort_keys=True, default=repr)
+        return (self.qualified_name, config.get('env'), data)
+
     def parse_args(self, config, args):
         if config.debug:
             print_debug('Parsing args for task `{self.name}`: {args}'.format(**locals()))
@@ -362,5 +444,71 @@ class Parameter:
         return getattr(self._parameter, name)
 
 
+class InvocationCache:
+
+    """Results of tasks declared with ``once=True``.
+
+    While a cache is active (see :func:`set_invocation_cache`), each
+    distinct invocation of such a task (i.e., the task, env, and args)
+    is run only once and later invocations return its result. The
+    :class:`TaskRunner` activates a new cache for each run.
+
+    Invocations that are in progress are tracked with futures, so when
+    a task is invoked from several threads at once, it's run in one of
+    them and the others wait for its result. Failures aren't cached: if
+    a task fails, the callers waiting on it get the same exception, and
+    the next invocation runs the task again.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._invocations = {}
+
+    def call(self, key, func, *args, **kwargs):
+        with self._lock:
+            invocation = self._invocations.get(key)
+            if invocation is None:
+                invocation = (Future(), threading.get_ident())
+                self._invocations[key] = invocation
+                owner = True
+            else:
+                owner = False
+        future, thread_id = invocation
+        if not owner:
+            if thread_id == threading.get_ident() and not future.done():
+                # A task invoking itself (recursively) with the same args
+                # would otherwise wait for itself forever.
+                return func(*args, **kwargs)
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as exc:
+            with self._lock:
+                del self._invocations[key]
+            future.set_exception(exc)
+            raise
+        future.set_result(result)
+        return result
+
+
+_invocation_cache_lock = threading.Lock()
+_invocation_cache = None
+
+
+def get_invocation_cache():
+    """Get the active invocation cache, if there is one."""
+    with _invocation_cache_lock:
+        return _invocation_cache
+
+
+def set_invocation_cache(invocation_cache):
+    """Set the active invocation cache; returns the previous one."""
+    global _invocation_cache
+    with _invocation_cache_lock:
+        previous, _invocation_cache = _invocation_cache, invocation_cache
+    return previous
+
+
 # Avoid circular import
 from .config import RawConfig
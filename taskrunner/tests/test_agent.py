@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from taskrunner.runners.agent import Agent
+from taskrunner.runners.exc import RunError
+
+
+class TestAgent(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent = Agent.local().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.agent.close()
+
+    def test_run(self):
+        result = self.agent.run(['echo', 'hello'], hide='all')
+        self.assertEqual(result.return_code, 0)
+        self.assertEqual(result.stdout, 'hello\n')
+
+    def test_run_with_shell_cwd_env_and_input(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            result = self.agent.run(
+                'echo "$(pwd) $GREETING"; cat', cwd=temp_dir, env={'GREETING': 'hi'},
+                input=b'from stdin', hide='all')
+        self.assertEqual(result.stdout_lines, [
+            '{} hi'.format(os.path.realpath(temp_dir)),
+            'from stdin',
+        ])
+
+    def test_failure(self):
+        with self.assertRaises(RunError) as context:
+            self.agent.run('echo oops >&2; exit 3', hide='all')
+        self.assertEqual(context.exception.return_code, 3)
+        self.assertEqual(context.exception.stderr, 'oops\n')
+
+    def test_concurrent_commands(self):
+        def run(i):
+            return self.agent.run('sleep 0.1; echo {}'.format(i), hide='all').stdout
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            outputs = list(executor.map(run, range(8)))
+        self.assertEqual(outputs, ['{}\n'.format(i) for i in range(8)])
+
+    def test_read_and_write_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'file.bin')
+            data = bytes(range(256)) * 100
+            self.agent.write_file(path, data, mode=0o600)
+            self.assertEqual(self.agent.read_file(path), data)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import time
+import unittest
+
+from taskrunner.runners.cache import HEADER, ResultCache
+from taskrunner.runners.result import Result
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        self.cache = ResultCache(os.path.join(self.temp_dir, 'cache'), max_size=10000)
+
+    def put(self, name, size, age=0):
+        key = self.cache.make_key('local', name)
+        self.cache.put(key, Result(0, b'x' * size, b''))
+        if age:
+            mtime = time.time() - age
+            os.utime(self.cache.get_path(key), (mtime, mtime))
+        return key
+
+    def test_get_and_put(self):
+        key = self.cache.make_key('local', 'echo hi')
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, Result(0, b'hi\n', b'warning\n'))
+        result = self.cache.get(key)
+        self.assertEqual(result.return_code, 0)
+        self.assertEqual(result.stdout, 'hi\n')
+        self.assertEqual(result.stderr, 'warning\n')
+
+    def test_ttl(self):
+        key = self.put('old', 10)
+        self.assertIsNotNone(self.cache.get(key, ttl=60))
+        time.sleep(0.01)
+        self.assertIsNone(self.cache.get(key, ttl=0.005))
+        self.assertFalse(os.path.exists(self.cache.get_path(key)))
+
+    def test_corrupt_entry_is_removed(self):
+        key = self.put('corrupt', 10)
+        with open(self.cache.get_path(key), 'r+b') as fp:
+            fp.truncate(HEADER.size + 5)
+        self.assertIsNone(self.cache.get(key))
+        self.assertFalse(os.path.exists(self.cache.get_path(key)))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        keys = [self.put(str(i), 2000, age=100 - i) for i in range(4)]
+        # Reading the oldest entry makes it the most recently used.
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.put('new', 2000)
+        remaining = [key for key in keys if os.path.exists(self.cache.get_path(key))]
+        self.assertEqual(remaining, [keys[0], keys[2], keys[3]])
+
+    def test_entries_bigger_than_max_size_are_not_cached(self):
+        key = self.put('huge', 20000)
+        self.assertIsNone(self.cache.get(key))
+
+    def test_inputs_are_part_of_key(self):
+        path = os.path.join(self.temp_dir, 'input.txt')
+        with open(path, 'w') as fp:
+            fp.write('one')
+        key = self.cache.make_key('local', 'cat input.txt', inputs=[path])
+        self.assertEqual(key, self.cache.make_key('local', 'cat input.txt', inputs=[path]))
+        with open(path, 'w') as fp:
+            fp.write('two!')
+        self.assertNotEqual(key, self.cache.make_key('local', 'cat input.txt', inputs=[path]))
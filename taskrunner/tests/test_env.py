@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from taskrunner.runners.env import EnvCache, env_cache
+from taskrunner.runners.local import LocalRunner
+
+
+class TestEnvCache(unittest.TestCase):
+
+    def setUp(self):
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        env_cache.clear()
+        self.addCleanup(env_cache.clear)
+
+    def test_environ_changes_are_seen_by_later_commands(self):
+        os.environ.pop('TASKRUNNER_TEST_VAR', None)
+        run = LocalRunner().run
+        self.assertEqual(run('echo "$TASKRUNNER_TEST_VAR"', prepend_path='/x', hide='all').stdout,
+                         '\n')
+        os.environ['TASKRUNNER_TEST_VAR'] = 'set mid-run'
+        self.assertEqual(run('echo "$TASKRUNNER_TEST_VAR"', prepend_path='/x', hide='all').stdout,
+                         'set mid-run\n')
+
+    def test_get_env(self):
+        cache = EnvCache()
+        os.environ['PATH'] = '/usr/bin:/bin'
+        env, path = cache.get_env(prepend_path='/a', append_path='/z', extra={'X': '1'})
+        self.assertEqual(path, '/a:/usr/bin:/bin:/z')
+        self.assertEqual(env['PATH'], path)
+        self.assertEqual(env['X'], '1')
+        self.assertNotIn('X', os.environ)
+        self.assertEqual(cache.get_env(), (None, None))
+
+        # The computed $PATH follows changes to the base $PATH.
+        os.environ['PATH'] = '/bin'
+        self.assertEqual(cache.get_env(prepend_path='/a')[1], '/a:/bin')
+
+    def test_which(self):
+        cache = EnvCache()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            exe = os.path.join(temp_dir, 'tool')
+            with open(exe, 'w') as fp:
+                fp.write('#!/bin/sh\n')
+            os.chmod(exe, 0o755)
+            self.assertEqual(cache.which('tool', path=temp_dir), exe)
+            os.remove(exe)
+            # A cached executable that was removed is looked up again.
+            self.assertIsNone(cache.which('tool', path=temp_dir))
@@ -0,0 +1,58 @@
+import os
+import select
+import threading
+import unittest
+from unittest import mock
+
+from taskrunner.jobserver import TOKEN, JobServer, JobSlots
+
+
+class TestJobServer(unittest.TestCase):
+
+    def setUp(self):
+        self.jobserver = JobServer.create(3)
+        self.addCleanup(self.jobserver.close)
+
+    def test_makeflags_are_appended_to(self):
+        with mock.patch.dict(os.environ, {'MAKEFLAGS': 'k --no-print-directory'}):
+            makeflags = self.jobserver.get_env()['MAKEFLAGS']
+            self.assertTrue(makeflags.startswith('k --no-print-directory -j3 '), makeflags)
+            makeflags = self.jobserver.get_env({'MAKEFLAGS': 's', 'X': '1'})['MAKEFLAGS']
+            self.assertTrue(makeflags.startswith('s -j3 '), makeflags)
+
+    def test_stale_jobserver_args_are_replaced(self):
+        with mock.patch.dict(os.environ, {'MAKEFLAGS': ' -j8 --jobserver-auth=98,99'}):
+            makeflags = self.jobserver.get_env()['MAKEFLAGS']
+        self.assertNotIn('98,99', makeflags)
+        self.assertIn('--jobserver-auth={0.read_fd},{0.write_fd}'.format(self.jobserver),
+                      makeflags)
+
+    def test_slots(self):
+        slots = JobSlots(self.jobserver)
+        self.addCleanup(slots.close)
+        tokens = [slots.acquire() for _ in range(3)]
+        self.assertEqual(tokens, [None, TOKEN, TOKEN])
+        for token in tokens:
+            slots.release(token)
+        self.assertEqual(os.read(self.jobserver.read_fd, 10), TOKEN * 2)
+
+    def test_token_taken_by_another_process_does_not_block(self):
+        slots = JobSlots(self.jobserver)
+        self.addCleanup(slots.close)
+        self.assertIsNone(slots.acquire())
+        # Another process takes the jobserver's tokens right after they
+        # were reported as readable.
+        os.read(self.jobserver.read_fd, 10)
+        calls = []
+        real_select = select.select
+
+        def select_racing(rlist, wlist, xlist):
+            calls.append(rlist)
+            if len(calls) == 1:
+                return [self.jobserver.poll_fd], [], []
+            return real_select(rlist, wlist, xlist)
+
+        threading.Timer(0.1, slots.release, (None,)).start()
+        with mock.patch('select.select', select_racing):
+            self.assertIsNone(slots.acquire())
+        self.assertEqual(len(calls), 2)
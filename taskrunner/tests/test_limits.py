@@ -0,0 +1,50 @@
+import os
+import resource
+import unittest
+
+from taskrunner.runners.exc import RunAborted
+from taskrunner.runners.limits import ProcessLimits
+from taskrunner.runners.local import LocalRunner
+
+
+# Limits are applied right after the command starts, so commands that
+# check them wait a moment first.
+DELAY = 'sleep 0.2; '
+
+
+class TestProcessLimits(unittest.TestCase):
+
+    def run_cmd(self, cmd, **kwargs):
+        return LocalRunner().run(DELAY + cmd, hide='all', **kwargs).stdout.strip()
+
+    def test_rlimits(self):
+        self.assertEqual(self.run_cmd('ulimit -n', rlimits='nofile=64'), '64')
+
+    def test_nice(self):
+        current = os.getpriority(os.PRIO_PROCESS, 0)
+        self.assertEqual(self.run_cmd('nice', nice=3), str(min(current + 3, 19)))
+
+    @unittest.skipUnless(hasattr(os, 'sched_getaffinity'), 'CPU affinity not supported')
+    def test_cpu_affinity(self):
+        cpu = min(os.sched_getaffinity(0))
+        status = self.run_cmd('grep Cpus_allowed_list /proc/self/status', cpu_affinity=cpu)
+        self.assertEqual(status.split()[-1], str(cpu))
+
+    def test_limits_are_not_applied_to_this_process(self):
+        before = resource.getrlimit(resource.RLIMIT_NOFILE)
+        self.run_cmd('true', rlimits='nofile=64')
+        self.assertEqual(resource.getrlimit(resource.RLIMIT_NOFILE), before)
+
+    def test_bad_options_are_rejected_up_front(self):
+        for kwargs in ({'rlimits': 'bogus=1'}, {'ionice': 'fast'}, {'cpu_affinity': 'x'}):
+            with self.assertRaises(RunAborted):
+                LocalRunner().run('true', hide='all', **kwargs)
+
+    def test_parse(self):
+        limits = ProcessLimits(cpu_affinity='0-2,5', rlimits='as=2G,cpu=60')
+        self.assertEqual(limits.cpu_affinity, {0, 1, 2, 5})
+        self.assertEqual(limits.rlimits, (
+            (resource.RLIMIT_AS, (2 * 1024 ** 3, 2 * 1024 ** 3)),
+            (resource.RLIMIT_CPU, (60, 60)),
+        ))
+        self.assertFalse(ProcessLimits())
@@ -0,0 +1,102 @@
+import os
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+from taskrunner.runners.exc import RunAborted, RunError
+from taskrunner.runners.local import SHELL_BUILTINS, LocalRunner, split_simple_command
+
+
+class TestRelativeExecutable(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.sub_dir = os.path.join(self.temp_dir.name, 'sub')
+        os.mkdir(self.sub_dir)
+        script = os.path.join(self.sub_dir, 'build.sh')
+        with open(script, 'w') as fp:
+            fp.write('#!/bin/sh\necho built in "$(pwd)"\n')
+        os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+
+    def test_string_command_is_resolved_against_cd(self):
+        result = LocalRunner().run('./build.sh', cd=self.sub_dir, hide='all')
+        self.assertTrue(result.succeeded)
+        self.assertEqual(result.stdout.strip(), 'built in {}'.format(self.sub_dir))
+
+    def test_list_command_is_resolved_against_cd(self):
+        result = LocalRunner().run(['./build.sh'], cd=self.sub_dir, hide='all')
+        self.assertTrue(result.succeeded)
+
+
+class TestShellFallback(unittest.TestCase):
+
+    def test_simple_commands_are_run_directly(self):
+        self.assertEqual(split_simple_command('ls -l "a b"'), ['ls', '-l', 'a b'])
+
+    def test_shell_syntax_needs_a_shell(self):
+        for cmd in ('ls | wc', 'echo $HOME', 'ls *.py', 'FOO=1 env', 'a && b'):
+            self.assertIsNone(split_simple_command(cmd), cmd)
+
+    def test_builtins_need_a_shell(self):
+        for builtin in ('pushd', 'popd', 'declare', 'typeset', 'let', 'shopt', 'hash', 'ulimit'):
+            self.assertIn(builtin, SHELL_BUILTINS)
+            self.assertIsNone(split_simple_command(builtin + ' x'), builtin)
+
+    def test_builtin_runs_in_shell(self):
+        result = LocalRunner().run('ulimit -n', hide='all')
+        self.assertTrue(result.stdout.strip().isdigit())
+
+    def test_missing_executable_in_string_command_exits_127(self):
+        with self.assertRaises(RunError) as context:
+            LocalRunner().run('no-such-command-xyz --flag', hide='all')
+        self.assertEqual(context.exception.return_code, 127)
+        self.assertIn('no-such-command-xyz', context.exception.stderr)
+
+    def test_missing_executable_in_list_command_aborts(self):
+        with self.assertRaises(RunAborted):
+            LocalRunner().run(['no-such-command-xyz'], hide='all')
+
+
+class TestPassthrough(unittest.TestCase):
+
+    def setUp(self):
+        # Passthrough writes to the console's fds, so they're replaced
+        # with files that can be read back.
+        self.consoles = {}
+        for name in ('stdout', 'stderr'):
+            console = tempfile.TemporaryFile('w+')
+            self.addCleanup(console.close)
+            self.addCleanup(setattr, sys, name, getattr(sys, name))
+            setattr(sys, name, console)
+            self.consoles[name] = console
+
+    def get_console(self, name):
+        console = self.consoles[name]
+        console.seek(0)
+        return console.read()
+
+    def test_output_is_captured_and_written_to_console(self):
+        result = LocalRunner().run('echo out; echo err >&2', passthrough=True)
+        self.assertEqual(result.stdout, 'out\n')
+        self.assertEqual(result.stderr, 'err\n')
+        self.assertEqual(self.get_console('stdout'), 'out\n')
+        self.assertEqual(self.get_console('stderr'), 'err\n')
+
+    def test_large_output(self):
+        result = LocalRunner().run('seq 100000', passthrough=True)
+        self.assertEqual(len(result.stdout_lines), 100000)
+        self.assertEqual(self.get_console('stdout'), result.stdout)
+
+    def test_without_capture(self):
+        result = LocalRunner().run('echo out', passthrough=True, capture='none')
+        self.assertEqual(result.stdout, '')
+        self.assertEqual(self.get_console('stdout'), 'out\n')
+
+    def test_timeout_without_capture(self):
+        start = time.monotonic()
+        with self.assertRaises(RunAborted):
+            LocalRunner().run('sleep 5', passthrough=True, capture='none', timeout=0.2)
+        self.assertLess(time.monotonic() - start, 2)
@@ -0,0 +1,67 @@
+import os
+import stat
+import tempfile
+import time
+import unittest
+
+from taskrunner.runners.exc import RunAborted, RunError
+from taskrunner.runners.pipeline import PipelineRunner
+
+
+def get_open_fds():
+    return set(os.listdir('/proc/self/fd'))
+
+
+class TestPipelineRunner(unittest.TestCase):
+
+    def test_stages(self):
+        def upper(stdin, stdout):
+            stdout.write(stdin.read().upper())
+
+        result = PipelineRunner().run(['printf "b\\na\\n"', ['sort'], upper], hide='all')
+        self.assertEqual(result.stdout, 'A\nB\n')
+        self.assertEqual(result.return_codes, [0, 0, 0])
+
+    def test_failed_stage(self):
+        with self.assertRaises(RunError) as context:
+            PipelineRunner().run(['false', 'cat'], hide='all')
+        self.assertEqual(context.exception.return_code, 1)
+        self.assertEqual(context.exception.return_codes, [1, 0])
+
+    def test_relative_stage_is_resolved_against_cd(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            script = os.path.join(temp_dir, 'build.sh')
+            with open(script, 'w') as fp:
+                fp.write('#!/bin/sh\necho built in "$(pwd)"\n')
+            os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+            result = PipelineRunner().run(['./build.sh', 'tr a-z A-Z'], cd=temp_dir, hide='all')
+        self.assertTrue(result.stdout.startswith('BUILT IN'))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), '/proc/self/fd not available')
+    def test_fds_are_closed_when_a_stage_cannot_be_started(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # The script's interpreter is missing, so exec fails.
+            script = os.path.join(temp_dir, 'broken.sh')
+            with open(script, 'w') as fp:
+                fp.write('#!/no/such/interpreter\n')
+            os.chmod(script, 0o755)
+            before = get_open_fds()
+            for stages in (['cat', 'cat', [script]], [[script], 'cat']):
+                with self.assertRaises(RunAborted):
+                    PipelineRunner().run(stages, input=b'data', hide='all')
+            self.assertEqual(get_open_fds(), before)
+
+    def test_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(RunAborted):
+            PipelineRunner().run(['sleep 5', 'cat'], timeout=0.2, hide='all')
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_timeout_without_captured_output(self):
+        start = time.monotonic()
+        with self.assertRaises(RunAborted):
+            # Nothing is read from the stages, so only the final wait
+            # can time out.
+            PipelineRunner().run(
+                ['sleep 5', 'cat'], timeout=0.2, hide=None, capture='none', passthrough=True)
+        self.assertLess(time.monotonic() - start, 2)
@@ -0,0 +1,91 @@
+import io
+import os
+import pickle
+import sys
+import unittest
+
+from taskrunner.config import Config
+from taskrunner.processes import ProcessTraceback, map_in_processes
+from taskrunner.runners.exc import RunError
+from taskrunner.runners.local import LocalRunner
+from taskrunner.runners.streams import SPILL_THRESHOLD
+
+
+def square(config, item):
+    print('item', item)
+    if item < 0:
+        raise ValueError('negative item')
+    return item * item
+
+
+def get_pid(config, item):
+    return os.getpid(), config.name
+
+
+def run_big_command(config, item):
+    cmd = 'head -c {size} /dev/zero'.format(size=SPILL_THRESHOLD + 1)
+    return LocalRunner().run(cmd, hide='all')
+
+
+class TestMapInProcesses(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Config(name='test')
+        stdout = sys.stdout
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+        sys.stdout = self.stdout = io.StringIO()
+
+    def test_results_and_output_are_in_order(self):
+        results = map_in_processes(self.config, square, [3, 1, 4, 1, 5], jobs=3)
+        self.assertEqual(results, [9, 1, 16, 1, 25])
+        self.assertEqual(
+            self.stdout.getvalue().splitlines(),
+            ['item 3', 'item 1', 'item 4', 'item 1', 'item 5'])
+
+    def test_chunksize(self):
+        results = map_in_processes(self.config, square, range(7), jobs=2, chunksize=3)
+        self.assertEqual(results, [i * i for i in range(7)])
+
+    def test_runs_in_other_processes_with_config(self):
+        for pid, name in map_in_processes(self.config, get_pid, [1, 2]):
+            self.assertNotEqual(pid, os.getpid())
+            self.assertEqual(name, 'test')
+
+    def test_first_failure_is_raised_with_traceback(self):
+        with self.assertRaises(ValueError) as context:
+            map_in_processes(self.config, square, [1, -1, 2], jobs=1)
+        self.assertIsInstance(context.exception.__cause__, ProcessTraceback)
+        self.assertIn('negative item', str(context.exception.__cause__))
+        self.assertEqual(self.stdout.getvalue().splitlines(), ['item 1', 'item -1'])
+
+    def test_spilled_result_can_be_returned(self):
+        result, = map_in_processes(self.config, run_big_command, [None])
+        self.assertTrue(result.succeeded)
+        self.assertEqual(len(result.stdout_bytes), SPILL_THRESHOLD + 1)
+
+
+class TestPickling(unittest.TestCase):
+
+    def test_spilled_result(self):
+        cmd = 'head -c {size} /dev/zero'.format(size=SPILL_THRESHOLD + 1)
+        result = LocalRunner().run(cmd, hide='all')
+        restored = pickle.loads(pickle.dumps(result))
+        self.assertEqual(restored.return_code, 0)
+        self.assertEqual(restored.stdout_bytes, bytes(result.stdout_bytes))
+
+    def test_run_error(self):
+        exc = RunError(2, b'out', b'err')
+        restored = pickle.loads(pickle.dumps(exc))
+        self.assertEqual(restored.return_code, 2)
+        self.assertEqual(restored.stdout, 'out')
+        self.assertEqual(str(restored), str(exc))
+
+    def test_config(self):
+        config = Config(remote={'host': 'example.com'}, url='https://{remote.host}/')
+        restored = pickle.loads(pickle.dumps(config))
+        self.assertEqual(restored, config)
+        self.assertIs(type(restored), Config)
+        self.assertEqual(restored.remote.host, 'example.com')
+        self.assertFalse(hasattr(restored, 'missing'))
+        with self.assertRaises(KeyError):
+            restored.missing
@@ -0,0 +1,88 @@
+import threading
+import time
+import unittest
+
+from taskrunner.config import Config
+from taskrunner.resources import ResourcePool, get_limits, parse_resources
+
+
+class TestResourcePool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ResourcePool()
+
+    def in_thread(self, func):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_acquire_and_release(self):
+        acquired = self.pool.acquire({'db': 1}, {'db': 2})
+        self.assertEqual(acquired, {'db': 1})
+        self.assertEqual(self.in_thread(lambda: self.pool.try_acquire({'db': 1})), {'db': 1})
+        self.assertIsNone(self.in_thread(lambda: self.pool.try_acquire({'db': 1})))
+        self.pool.release(acquired)
+        self.assertEqual(self.in_thread(lambda: self.pool.try_acquire({'db': 1})), {'db': 1})
+
+    def test_acquire_is_all_or_nothing(self):
+        self.pool.acquire({'db': 1})
+        self.assertIsNone(self.in_thread(lambda: self.pool.try_acquire({'cache': 1, 'db': 1})))
+        # Nothing was taken for the resource that was available.
+        self.assertEqual(self.in_thread(lambda: self.pool.try_acquire({'cache': 1})), {'cache': 1})
+
+    def test_acquire_waits_for_release(self):
+        acquired = self.pool.acquire({'db': 1})
+        timer = threading.Timer(0.1, self.pool.release, [acquired])
+        timer.start()
+        self.addCleanup(timer.join)
+        start = time.monotonic()
+        self.assertEqual(self.in_thread(lambda: self.pool.acquire({'db': 1}, timeout=5)),
+                         {'db': 1})
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_acquire_timeout(self):
+        self.pool.acquire({'db': 1})
+        self.assertIsNone(self.in_thread(lambda: self.pool.acquire({'db': 1}, timeout=0.1)))
+
+    def test_hold_is_reentrant_per_thread(self):
+        with self.pool.hold({'db': 1}, {'db': 2}):
+            with self.pool.hold({'db': 2}) as acquired:
+                # Only the amount beyond what's already held is acquired.
+                self.assertEqual(acquired, {'db': 1})
+                self.assertIsNone(self.in_thread(lambda: self.pool.try_acquire({'db': 1})))
+            self.assertEqual(self.pool.get_held(), {'db': 1})
+            # Other threads don't share what this thread holds.
+            self.assertEqual(self.in_thread(self.pool.get_held), {})
+        self.assertEqual(self.pool.get_held(), {})
+        self.assertEqual(self.in_thread(lambda: self.pool.try_acquire({'db': 2})), {'db': 2})
+
+    def test_holding_resources_acquired_by_another_thread(self):
+        acquired = self.in_thread(lambda: self.pool.acquire({'db': 1}))
+        with self.pool.holding(acquired):
+            self.assertEqual(self.pool.get_held(), {'db': 1})
+            with self.pool.hold({'db': 1}) as nested:
+                self.assertEqual(nested, {})
+        self.assertEqual(self.pool.try_acquire({'db': 1}), {'db': 1})
+
+    def test_amount_over_limit(self):
+        with self.assertRaises(ValueError):
+            self.pool.acquire({'db': 3}, {'db': 2})
+        # The limit is fixed the first time a resource is seen.
+        with self.assertRaises(ValueError):
+            self.pool.acquire({'db': 3}, {'db': 5})
+
+
+class TestParseResources(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_resources('db,uploads:2'), {'db': 1, 'uploads': 2})
+        self.assertEqual(parse_resources(['db', 'db']), {'db': 2})
+        self.assertEqual(parse_resources({'db': '3'}), {'db': 3})
+        self.assertEqual(
+            parse_resources('db-{env}', format_kwargs={'env': 'prod'}), {'db-prod': 1})
+
+    def test_limits_come_from_config(self):
+        config = Config(resources={'db': '2'})
+        self.assertEqual(get_limits(config, {'db': 1, 'uploads': 1}), {'db': 2, 'uploads': 1})
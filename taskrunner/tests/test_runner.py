@@ -0,0 +1,192 @@
+import io
+import os
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from taskrunner.runner import TaskRunner
+
+
+TASKS = '''
+import time
+from taskrunner import task
+
+finished = []
+
+@task
+def build(config):
+    time.sleep(0.2)
+    finished.append('build')
+
+@task
+def lint(config):
+    time.sleep(0.1)
+    finished.append('lint')
+
+@task
+def check(config):
+    finished.append('check')
+
+@task(depends=['build', 'lint'])
+def package(config):
+    finished.append('package')
+
+@task
+def deploy(config):
+    finished.append('deploy')
+'''
+
+
+class RunnerTestCase(unittest.TestCase):
+
+    tasks = TASKS
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(self.temp_dir.name)
+        with open('tasks.py', 'w') as fp:
+            fp.write(textwrap.dedent(self.tasks))
+        stdout = sys.stdout
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+        sys.stdout = io.StringIO()
+
+    def run_tasks(self, *args, **kwargs):
+        runner = TaskRunner(tasks_module=os.path.abspath('tasks.py'), **kwargs)
+        runner.run(list(args))
+        return sys.modules['tasks']
+
+
+class TestTaskOrder(RunnerTestCase):
+
+    def test_argv_tasks_run_in_succession_with_jobs(self):
+        module = self.run_tasks('build', 'check', 'deploy', jobs=3)
+        self.assertEqual(module.finished, ['build', 'check', 'deploy'])
+
+    def test_dependencies_run_concurrently_with_jobs(self):
+        module = self.run_tasks('package', 'deploy', jobs=3)
+        self.assertEqual(module.finished, ['lint', 'build', 'package', 'deploy'])
+
+    def test_argv_task_already_run_as_dependency_is_skipped(self):
+        module = self.run_tasks('package', 'build', 'deploy', jobs=3)
+        self.assertEqual(module.finished, ['lint', 'build', 'package', 'deploy'])
+
+
+class TestResume(RunnerTestCase):
+
+    tasks = '''
+    import os
+    from taskrunner import task
+
+    def record(name):
+        with open('ran.txt', 'a') as fp:
+            fp.write(name + '\\n')
+
+    @task
+    def build(config):
+        record('build')
+
+    @task
+    def package(config, format='whl'):
+        record('package ' + format)
+
+    @task
+    def deploy(config):
+        record('deploy')
+        if os.path.exists('FAIL'):
+            raise RuntimeError('deploy failed')
+    '''
+
+    def get_ran(self):
+        with open('ran.txt') as fp:
+            ran = fp.read().splitlines()
+        os.remove('ran.txt')
+        return ran
+
+    def test_resume_skips_completed_tasks(self):
+        open('FAIL', 'w').close()
+        with self.assertRaises(RuntimeError):
+            self.run_tasks('build', 'package', 'deploy')
+        self.assertEqual(self.get_ran(), ['build', 'package whl', 'deploy'])
+        self.assertTrue(os.path.exists('.taskrunner/journal.json'))
+
+        os.remove('FAIL')
+        self.run_tasks('build', 'package', 'deploy', resume=True)
+        self.assertEqual(self.get_ran(), ['deploy'])
+        self.assertFalse(os.path.exists('.taskrunner/journal.json'))
+
+    def test_tasks_with_different_args_are_rerun(self):
+        open('FAIL', 'w').close()
+        with self.assertRaises(RuntimeError):
+            self.run_tasks('build', 'package', 'deploy')
+        self.get_ran()
+
+        os.remove('FAIL')
+        self.run_tasks('build', 'package', '--format', 'tar', 'deploy', resume=True)
+        self.assertEqual(self.get_ran(), ['package tar', 'deploy'])
+
+    def test_without_resume_everything_is_run(self):
+        open('FAIL', 'w').close()
+        with self.assertRaises(RuntimeError):
+            self.run_tasks('build', 'deploy')
+        self.get_ran()
+
+        os.remove('FAIL')
+        self.run_tasks('build', 'deploy')
+        self.assertEqual(self.get_ran(), ['build', 'deploy'])
+
+
+class TestMultipleEnvs(RunnerTestCase):
+
+    tasks = '''
+    import time
+    from taskrunner import task
+
+    @task
+    def deploy(config):
+        with open(config.env + '.txt', 'w') as fp:
+            fp.write(config.env)
+        if config.env == 'b':
+            time.sleep(0.2)
+            raise RuntimeError('deploy to b failed')
+        if config.env == 'c':
+            raise RuntimeError('deploy to c failed')
+        print('deployed to', config.env)
+    '''
+
+    def get_output(self):
+        return sys.stdout.getvalue().splitlines()
+
+    def test_tasks_run_in_each_env(self):
+        self.run_tasks('deploy', env='a,d')
+        self.assertTrue(os.path.exists('a.txt'))
+        self.assertTrue(os.path.exists('d.txt'))
+        output = self.get_output()
+        self.assertEqual(
+            output[:4],
+            ['Running in a env', 'deployed to a', 'Running in d env', 'deployed to d'])
+        self.assertEqual(output[4], 'Summary:')
+        self.assertRegex(output[5], r'^a: succeeded in \d+\.\ds$')
+        self.assertRegex(output[6], r'^d: succeeded in \d+\.\ds$')
+
+    def test_envs_not_started_after_failure_are_skipped(self):
+        with self.assertRaises(RuntimeError):
+            self.run_tasks('deploy', env='b,a,d')
+        self.assertFalse(os.path.exists('a.txt'))
+        self.assertFalse(os.path.exists('d.txt'))
+        summary = self.get_output()[-3:]
+        self.assertRegex(
+            summary[0], r'^b: failed after \d+\.\ds \(RuntimeError: deploy to b failed\)$')
+        self.assertEqual(summary[1:], ['a: not run', 'd: not run'])
+
+    def test_first_failure_is_reraised(self):
+        # b fails after c, but it comes first in the list of envs.
+        with self.assertRaisesRegex(RuntimeError, 'deploy to b failed'):
+            self.run_tasks('deploy', env='a,b,c', jobs=3)
+        summary = self.get_output()[-3:]
+        self.assertRegex(summary[0], r'^a: succeeded')
+        self.assertRegex(summary[1], r'^b: failed')
+        self.assertRegex(summary[2], r'^c: failed')
@@ -0,0 +1,138 @@
+import io
+import sys
+import threading
+import time
+import unittest
+
+from taskrunner.resources import resource_pool
+from taskrunner.scheduler import Scheduler, TaskNode
+
+
+class FakeTask:
+
+    def __init__(self, name):
+        self.name = name
+
+
+def make_nodes(*names):
+    return [TaskNode(FakeTask(name), [], i) for i, name in enumerate(names)]
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        stdout = sys.stdout
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+        sys.stdout = self.stdout = io.StringIO()
+
+    def test_serial_order_without_jobs(self):
+        run = []
+        Scheduler().run(make_nodes('a', 'b', 'c'), lambda node: run.append(node.task.name))
+        self.assertEqual(run, ['a', 'b', 'c'])
+
+    def test_dependencies_run_first(self):
+        build, = make_nodes('build')
+        test = TaskNode(FakeTask('test'), [], 1, depends=[build])
+        finished = []
+
+        def run_node(node):
+            if node is build:
+                time.sleep(0.1)
+            finished.append(node.task.name)
+
+        Scheduler(jobs=4).run([build, test], run_node)
+        self.assertEqual(finished, ['build', 'test'])
+
+    def test_no_more_than_jobs_nodes_run_at_once(self):
+        lock = threading.Lock()
+        counts = {'running': 0, 'max': 0}
+
+        def run_node(node):
+            with lock:
+                counts['running'] += 1
+                counts['max'] = max(counts['max'], counts['running'])
+            time.sleep(0.05)
+            with lock:
+                counts['running'] -= 1
+
+        Scheduler(jobs=2).run(make_nodes(*'abcdef'), run_node)
+        self.assertEqual(counts['max'], 2)
+
+    def test_fail_fast(self):
+        started = []
+
+        def run_node(node):
+            started.append(node.task.name)
+            if node.task.name == 'slow':
+                time.sleep(0.2)
+            elif node.task.name == 'fail':
+                raise RuntimeError('failed')
+
+        with self.assertRaises(RuntimeError):
+            Scheduler(jobs=2).run(make_nodes('slow', 'fail', 'after'), run_node)
+        self.assertEqual(sorted(started), ['fail', 'slow'])
+
+    def test_output_is_shown_in_serial_order(self):
+        def run_node(node):
+            if node.index == 0:
+                time.sleep(0.2)
+            print(node.task.name, 'start')
+            print(node.task.name, 'end')
+
+        Scheduler(jobs=3).run(make_nodes('a', 'b', 'c'), run_node)
+        self.assertEqual(
+            self.stdout.getvalue().splitlines(),
+            ['a start', 'a end', 'b start', 'b end', 'c start', 'c end'])
+
+
+class TestSchedulerResources(unittest.TestCase):
+
+    # Resource limits are fixed the first time a resource is seen by the
+    # global pool, so each test uses its own resource names.
+
+    def setUp(self):
+        stdout = sys.stdout
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+        sys.stdout = io.StringIO()
+
+    def test_ready_node_with_available_resources_runs_first(self):
+        db = {'test-order-db': 1}
+        nodes = [
+            TaskNode(FakeTask('a'), [], 0, resources=db),
+            TaskNode(FakeTask('b'), [], 1, resources=db),
+            TaskNode(FakeTask('c'), [], 2),
+        ]
+        lock = threading.Lock()
+        events = []
+
+        def run_node(node):
+            with lock:
+                events.append(node.task.name + ' start')
+            time.sleep(0.1)
+            with lock:
+                events.append(node.task.name + ' end')
+
+        Scheduler(jobs=3).run(nodes, run_node)
+        self.assertEqual(events[:2], ['a start', 'c start'])
+        self.assertLess(events.index('a end'), events.index('b start'))
+
+    def test_get_next_skips_nodes_waiting_for_resources(self):
+        held = resource_pool.acquire({'test-skip-db': 1})
+        self.addCleanup(resource_pool.release, held)
+        blocked = TaskNode(FakeTask('blocked'), [], 0, resources={'test-skip-db': 1})
+        free = TaskNode(FakeTask('free'), [], 1)
+        self.assertEqual(Scheduler().get_next([free, blocked], True), (free, {}))
+        self.assertEqual(Scheduler().get_next([blocked], True), (None, None))
+
+    def test_get_next_falls_back_when_nothing_is_running(self):
+        # Nothing that's running will release the resource, so the node
+        # is returned without it and will wait for it when it runs.
+        held = resource_pool.acquire({'test-fallback-db': 1})
+        self.addCleanup(resource_pool.release, held)
+        node = TaskNode(FakeTask('blocked'), [], 0, resources={'test-fallback-db': 1})
+        self.assertEqual(Scheduler().get_next([node], False), (node, {}))
+
+    def test_get_next_returns_node_over_limit(self):
+        node = TaskNode(
+            FakeTask('greedy'), [], 0, resources={'test-limit-db': 2}, limits={'test-limit-db': 1})
+        self.assertEqual(Scheduler().get_next([node], True), (node, {}))
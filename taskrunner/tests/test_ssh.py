@@ -0,0 +1,119 @@
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from taskrunner.runners.ssh import SSHPool
+
+
+# Stands in for ssh: it logs its args and creates or removes the control
+# "socket" like a master connection would.
+SSH = '''\
+#!/bin/sh
+echo "$*" >> "$SSH_LOG"
+for arg; do
+    case "$arg" in
+        ControlPath=*) control_path="${arg#ControlPath=}" ;;
+        bad.example.com) echo "Connection refused" >&2; exit 255 ;;
+    esac
+done
+case "$*" in
+    *ControlMaster=yes*) touch "$control_path" ;;
+    *"-O exit"*) rm -f "$control_path" ;;
+esac
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class TestSSHPool(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        ssh = os.path.join(self.temp_dir, 'ssh')
+        with open(ssh, 'w') as fp:
+            fp.write(SSH)
+        os.chmod(ssh, 0o755)
+        self.log = os.path.join(self.temp_dir, 'ssh.log')
+        environ = mock.patch.dict(os.environ, {
+            'PATH': os.pathsep.join((self.temp_dir, os.environ['PATH'])),
+            'SSH_LOG': self.log,
+        })
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.pool = SSHPool()
+        self.addCleanup(self.pool.close)
+        stdout = sys.stdout
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+        sys.stdout = io.StringIO()
+
+    def get_calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as fp:
+            return [line.split() for line in fp]
+
+    def test_master_is_started_once_and_reused(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.pool.get_options('example.com')))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results.append(self.pool.get_options('example.com'))
+
+        control_path = self.pool.get_control_path('example.com')
+        self.assertTrue(os.path.exists(control_path))
+        self.assertEqual(results, [['-o', 'ControlPath=' + control_path]] * 5)
+        self.assertEqual(self.get_calls(), [[
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPersist=yes',
+            '-o', 'ControlPath=' + control_path,
+            '-N', '-f', 'example.com',
+        ]])
+
+    def test_each_destination_has_its_own_master(self):
+        options = self.pool.get_options('a.example.com')
+        self.assertNotEqual(self.pool.get_options('b.example.com'), options)
+        self.assertEqual([call[-1] for call in self.get_calls()],
+                         ['a.example.com', 'b.example.com'])
+
+    def test_failed_master_falls_back_to_regular_connections(self):
+        self.assertEqual(self.pool.get_options('bad.example.com'), [])
+        self.assertEqual(self.pool.get_options('bad.example.com'), [])
+        self.assertEqual(len(self.get_calls()), 1)
+        self.assertIn('Connection refused', sys.stdout.getvalue())
+
+    def test_close_stops_masters(self):
+        self.pool.get_options('example.com')
+        control_path = self.pool.get_control_path('example.com')
+        self.pool.close()
+        self.assertEqual(self.get_calls()[-1], [
+            '-o', 'ControlPath=' + control_path, '-O', 'exit', 'example.com'])
+        self.assertFalse(os.path.exists(os.path.dirname(control_path)))
+
+    def test_masters_are_stopped_at_exit(self):
+        code = (
+            'from taskrunner.runners.ssh import ssh_pool\n'
+            'print(ssh_pool.get_control_path("example.com"))\n'
+            'ssh_pool.get_options("example.com")\n'
+        )
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, (ROOT, env.get('PYTHONPATH'))))
+        control_path = subprocess.check_output(
+            [sys.executable, '-c', code], env=env, universal_newlines=True).strip()
+        calls = self.get_calls()
+        self.assertEqual(len(calls), 2)
+        self.assertIn('ControlMaster=yes', calls[0])
+        self.assertEqual(calls[1], [
+            '-o', 'ControlPath=' + control_path, '-O', 'exit', 'example.com'])
+        self.assertFalse(os.path.exists(os.path.dirname(control_path)))
@@ -0,0 +1,174 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from taskrunner import state
+from taskrunner.state import RACY_WINDOW, FileIndex, TaskState
+from taskrunner.tests.test_runner import RunnerTestCase
+
+
+def write(path, data):
+    with open(path, 'w') as fp:
+        fp.write(data)
+
+
+class TestFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        self.index_path = os.path.join(self.temp_dir, 'state', 'files.idx')
+        hash_file = mock.patch('taskrunner.state.hash_file', wraps=state.hash_file)
+        self.hash_file = hash_file.start()
+        self.addCleanup(hash_file.stop)
+
+    def make_file(self, name, data, age=0):
+        path = os.path.join(self.temp_dir, name)
+        write(path, data)
+        if age:
+            mtime = time.time() - age
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def rewrite(self, path, data):
+        # Change a file without changing its size or mtime.
+        st = os.stat(path)
+        write(path, data)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        path = self.make_file('old.txt', 'one', age=60)
+        index = FileIndex(self.index_path)
+        digest = index.get_digests([path])[path]
+        self.assertEqual(self.hash_file.call_count, 1)
+        self.assertEqual(index.get_digests([path]), {path: digest})
+        self.assertEqual(self.hash_file.call_count, 1)
+
+        # The stat info is trusted, so a change that doesn't show up in
+        # it isn't noticed.
+        self.rewrite(path, 'two')
+        self.assertEqual(index.get_digests([path]), {path: digest})
+
+    def test_racy_files_are_hashed_again(self):
+        path = self.make_file('new.txt', 'one')
+        index = FileIndex(self.index_path)
+        digest = index.get_digests([path])[path]
+        self.rewrite(path, 'two')
+        self.assertNotEqual(index.get_digests([path])[path], digest)
+        self.assertEqual(self.hash_file.call_count, 2)
+
+    def test_changed_and_missing_files(self):
+        path = self.make_file('file.txt', 'one', age=60)
+        index = FileIndex(self.index_path)
+        digest = index.get_digests([path])[path]
+        write(path, 'changed')
+        self.assertNotEqual(index.get_digests([path])[path], digest)
+        os.remove(path)
+        self.assertEqual(index.get_digests([path]), {path: None})
+
+    def test_save_and_load(self):
+        os.mkdir(os.path.join(self.temp_dir, 'dätä'))
+        paths = [
+            self.make_file('a.txt', 'a', age=60),
+            self.make_file('ab.txt', 'ab', age=60),
+            self.make_file(os.path.join('dätä', 'файл.txt'), 'файл', age=60),
+            self.make_file('racy.txt', 'racy'),
+        ]
+        index = FileIndex(self.index_path)
+        digests = index.get_digests(paths)
+        index.save()
+
+        entries = FileIndex(self.index_path).load()
+        self.assertEqual(sorted(entries), sorted(paths))
+        for path in paths:
+            st = os.stat(path)
+            size, mtime_ns, ino, digest, trusted = entries[path]
+            self.assertEqual((size, mtime_ns, ino), (st.st_size, st.st_mtime_ns, st.st_ino))
+            self.assertEqual(digest, digests[path])
+            self.assertEqual(trusted, time.time_ns() - mtime_ns > RACY_WINDOW)
+
+        # Only the racy file is hashed again by a new index.
+        self.hash_file.reset_mock()
+        self.assertEqual(FileIndex(self.index_path).get_digests(paths), digests)
+        self.hash_file.assert_called_once_with(paths[-1])
+
+    def test_bad_index_is_ignored(self):
+        os.makedirs(os.path.dirname(self.index_path))
+        write(self.index_path, 'garbage')
+        self.assertEqual(FileIndex(self.index_path).load(), {})
+
+
+class TestTaskState(unittest.TestCase):
+
+    def test_check_and_record(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            task_state = TaskState(os.path.join(temp_dir, 'state'))
+            source = os.path.join(temp_dir, 'source.txt')
+            output = os.path.join(temp_dir, 'output.txt')
+            write(source, 'source')
+            key = task_state.make_key('build', None, {})
+            up_to_date, digest = task_state.check(key, [source], [output])
+            self.assertFalse(up_to_date)
+            write(output, 'output')
+            task_state.record(key, digest, [output])
+            self.assertTrue(task_state.check(key, [source], [output])[0])
+            # Records are kept per invocation.
+            other_key = task_state.make_key('build', None, {'fast': True})
+            self.assertFalse(task_state.check(other_key, [source], [output])[0])
+
+
+class TestUpToDate(RunnerTestCase):
+
+    tasks = '''
+    import os
+    from taskrunner import task
+
+    @task(inputs=['src/*.txt'], outputs=['build/out.txt'])
+    def build(config):
+        with open('ran.txt', 'a') as fp:
+            fp.write('build\\n')
+        os.makedirs('build', exist_ok=True)
+        with open('build/out.txt', 'w') as out:
+            for name in sorted(os.listdir('src')):
+                with open(os.path.join('src', name)) as fp:
+                    out.write(fp.read())
+    '''
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('src')
+        write('src/a.txt', 'a')
+        write('src/b.txt', 'b')
+
+    def run_build(self):
+        self.run_tasks('build')
+        if not os.path.exists('ran.txt'):
+            return []
+        with open('ran.txt') as fp:
+            ran = fp.read().splitlines()
+        os.remove('ran.txt')
+        return ran
+
+    def test_unchanged_task_is_skipped(self):
+        self.assertEqual(self.run_build(), ['build'])
+        self.assertEqual(self.run_build(), [])
+        self.assertIn('Skipping build task: up to date', sys.stdout.getvalue())
+
+    def test_changed_input_causes_rerun(self):
+        self.run_build()
+        write('src/a.txt', 'changed')
+        self.assertEqual(self.run_build(), ['build'])
+        write('src/c.txt', 'new')
+        self.assertEqual(self.run_build(), ['build'])
+        with open('build/out.txt') as fp:
+            self.assertEqual(fp.read(), 'changedbnew')
+
+    def test_deleted_output_causes_rerun(self):
+        self.run_build()
+        os.remove('build/out.txt')
+        self.assertEqual(self.run_build(), ['build'])
+        self.assertTrue(os.path.exists('build/out.txt'))
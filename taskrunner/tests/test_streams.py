@@ -0,0 +1,81 @@
+import errno
+import os
+import signal
+import unittest
+from unittest import mock
+
+from taskrunner.runners.exc import RunError
+from taskrunner.runners.local import LocalRunner
+from taskrunner.runners.streams import KernelTee
+
+
+@unittest.skipUnless(KernelTee.available, 'tee(2) and splice(2) not available')
+class TestKernelTee(unittest.TestCase):
+
+    def setUp(self):
+        self.src_read, self.src_write = os.pipe()
+        self.dest_read, self.dest_write = os.pipe()
+        for fd in (self.src_read, self.src_write, self.dest_read, self.dest_write):
+            self.addCleanup(os.close, fd)
+        self.tee = KernelTee(self.dest_write)
+        self.addCleanup(self.tee.close)
+
+    def test_transfer(self):
+        os.write(self.src_write, b'hello')
+        self.assertEqual(self.tee.transfer(self.src_read), b'hello')
+        self.assertEqual(os.read(self.dest_read, 100), b'hello')
+        self.assertTrue(self.tee.enabled)
+
+    def test_splice_failing_part_way_falls_back_to_copying(self):
+        real_splice = os.splice
+        calls = []
+
+        def splice(fd_in, fd_out, count):
+            calls.append(count)
+            if len(calls) == 1:
+                return real_splice(fd_in, fd_out, 3)
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        os.write(self.src_write, b'hello world')
+        with mock.patch('os.splice', splice):
+            self.assertEqual(self.tee.transfer(self.src_read), b'hello world')
+        self.assertFalse(self.tee.enabled)
+        # Each byte is written exactly once and the source is drained.
+        self.assertEqual(os.read(self.dest_read, 100), b'hello world')
+        os.set_blocking(self.src_read, False)
+        self.assertRaises(BlockingIOError, os.read, self.src_read, 100)
+
+        os.write(self.src_write, b'more')
+        self.assertEqual(self.tee.transfer(self.src_read), b'more')
+        self.assertEqual(os.read(self.dest_read, 100), b'more')
+
+
+class TestStreamingRun(unittest.TestCase):
+
+    def test_lines(self):
+        run = LocalRunner().run('echo one; echo two >&2; printf three', stream=True)
+        self.assertEqual(list(run), [('stdout', 'one'), ('stderr', 'two'), ('stdout', 'three')])
+        self.assertEqual(run.result.stdout, 'one\nthree')
+
+    def test_failure(self):
+        failures = []
+        run = LocalRunner().run('echo out; exit 3', stream=True, on_failure=failures.append)
+        self.assertEqual(list(run), [('stdout', 'out')])
+        self.assertEqual(failures, [run.result])
+        self.assertEqual(run.result.return_code, 3)
+
+        with self.assertRaises(RunError):
+            list(LocalRunner().run('exit 3', stream=True))
+
+    def test_timeout_is_handled_as_a_failure(self):
+        failures = []
+        run = LocalRunner().run(
+            'echo started; sleep 5', stream=True, timeout=0.2, on_failure=failures.append)
+        self.assertEqual(list(run), [('stdout', 'started')])
+        self.assertEqual(failures, [run.result])
+        self.assertIsInstance(run.result, RunError)
+        self.assertEqual(run.result.return_code, -signal.SIGKILL)
+        self.assertEqual(run.result.stdout, 'started\n')
+
+        with self.assertRaises(RunError):
+            list(LocalRunner().run('sleep 5', stream=True, timeout=0.2))
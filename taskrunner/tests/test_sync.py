@@ -0,0 +1,210 @@
+import os
+import random
+import tempfile
+import time
+import unittest
+import zlib
+from unittest import mock
+
+from taskrunner.runners.agent import Agent
+from taskrunner.runners.exc import RunAborted
+from taskrunner.runners.sync import (
+    ANCHOR_SIZE, BLOCK, COPY, DATA, FRAME_SIZE, Syncer, compress_delta, make_delta,
+    parse_signature, strong_checksum)
+
+
+def read(path):
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def get_signature(data, block_size):
+    return parse_signature(b''.join(
+        BLOCK.pack(zlib.adler32(block), strong_checksum(block), block[:ANCHOR_SIZE])
+        for block in (data[i:i + block_size] for i in range(0, len(data), block_size))
+        if len(block) == block_size))
+
+
+def apply_delta(old, delta, block_size):
+    new = bytearray()
+    pos = 0
+    while pos < len(delta):
+        if delta[pos:pos + 1] == b'C':
+            _, start, count = COPY.unpack_from(delta, pos)
+            pos += COPY.size
+            new += old[start * block_size:(start + count) * block_size]
+        else:
+            _, size = DATA.unpack_from(delta, pos)
+            pos += DATA.size
+            new += delta[pos:pos + size]
+            pos += size
+    return bytes(new)
+
+
+class TestMakeDelta(unittest.TestCase):
+
+    block_size = 2048
+
+    def setUp(self):
+        self.random = random.Random(1)
+        self.old = self.random.randbytes(256 * 1024)
+
+    def check(self, new):
+        blocks, anchors = get_signature(self.old, self.block_size)
+        delta = b''.join(make_delta(new, blocks, self.block_size, anchors))
+        self.assertEqual(apply_delta(self.old, delta, self.block_size), new)
+        return len(delta) - len(new)
+
+    def test_unchanged(self):
+        self.assertLess(self.check(self.old), 0)
+        self.assertEqual(self.check(b''), 0)
+
+    def test_small_changes(self):
+        old = self.old
+        for new in (
+                old[:1000] + b'inserted' + old[1000:],
+                old[:5000] + old[5100:],
+                old[:9000] + b'x' * 10 + old[9010:],
+                old[100:]):
+            # Only the blocks around the change are sent as data.
+            self.assertLess(self.check(new), -len(old) + 3 * self.block_size)
+
+    def test_large_changes(self):
+        old = self.old
+        inserted = self.random.randbytes(50000)
+        self.assertLess(self.check(old[:1000] + inserted + old[1000:]),
+                        -len(old) + 2 * self.block_size)
+        self.assertLess(self.check(old[:1000] + old[60000:]), -len(old) + 70000)
+        # Blocks are found in any order.
+        self.assertLess(self.check(old[128 * 1024:] + old[:128 * 1024]), -len(old) + 100)
+
+    def test_new_data(self):
+        new = self.random.randbytes(len(self.old))
+        self.assertGreaterEqual(self.check(new), 0)
+
+    def test_compressed_in_frames(self):
+        data = self.random.randbytes(4 * FRAME_SIZE)
+        frames = list(compress_delta(make_delta(data, {}, self.block_size)))
+        self.assertGreater(len(frames), 2)
+        decompressed = zlib.decompress(b''.join(frames))
+        self.assertEqual(apply_delta(b'', decompressed, self.block_size), data)
+
+
+class TestSyncer(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.source = os.path.join(temp_dir.name, 'source')
+        self.destination = os.path.join(temp_dir.name, 'destination')
+        environ = mock.patch.dict(os.environ, XDG_CACHE_HOME=os.path.join(temp_dir.name, 'cache'))
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.agent = Agent.local().start()
+        self.addCleanup(self.agent.close)
+        self.num_connections = 0
+
+    def get_agent(self):
+        self.num_connections += 1
+        return self.agent
+
+    def sync(self, **kwargs):
+        syncer = Syncer(self.source, self.destination, 'localhost', **kwargs)
+        return syncer.run(self.get_agent)
+
+    def assert_trees_equal(self):
+        for dir_path, _, file_names in os.walk(self.source):
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                remote_path = os.path.join(
+                    self.destination, os.path.relpath(path, self.source))
+                self.assertEqual(read(remote_path), read(path))
+
+    def test_round_trip(self):
+        big = os.urandom(512 * 1024)
+        write(os.path.join(self.source, 'big.bin'), big)
+        write(os.path.join(self.source, 'sub', 'small.txt'), b'small\n')
+        write(os.path.join(self.source, 'empty'), b'')
+
+        summary = self.sync()
+        self.assertEqual(sorted(summary['transferred']), ['big.bin', 'empty', 'sub/small.txt'])
+        self.assert_trees_equal()
+
+        # Nothing changed, so the host isn't contacted.
+        summary = self.sync()
+        self.assertEqual(summary['transferred'], [])
+        self.assertEqual(self.num_connections, 1)
+
+        # Only the part of the file that changed is sent.
+        changed = big[:1000] + b'changed' + big[1000:]
+        write(os.path.join(self.source, 'big.bin'), changed)
+        summary = self.sync()
+        self.assertEqual(summary['transferred'], ['big.bin'])
+        self.assertLess(summary['bytes_sent'], len(changed) // 10)
+        self.assert_trees_equal()
+
+    def test_large_file_is_streamed(self):
+        data = os.urandom(3 * FRAME_SIZE)
+        write(os.path.join(self.source, 'big.bin'), data)
+        with mock.patch.object(self.agent, '_send', wraps=self.agent._send) as send:
+            self.sync()
+        self.assertEqual(read(os.path.join(self.destination, 'big.bin')), data)
+        # The delta was sent in several frames rather than one.
+        chunks = [args for args, _ in send.call_args_list if args[1].get('op') == 'chunk']
+        self.assertGreater(len(chunks), 2)
+
+    def test_failed_patch(self):
+        # The destination's parent is a file, so the patch fails.
+        write(os.path.join(self.source, 'sub', 'file'), os.urandom(3 * FRAME_SIZE))
+        write(self.destination, b'')
+        with self.assertRaises(RunAborted):
+            self.sync()
+        # The agent can still be used.
+        self.assertEqual(self.agent.run('echo ok', hide='all').stdout, 'ok\n')
+
+    def test_interrupted_patch(self):
+        def frames():
+            yield from compress_delta([DATA.pack(b'D', 7), b'partial'])
+            raise ValueError('read failed')
+
+        os.makedirs(self.destination)
+        path = os.path.join(self.destination, 'file')
+        with self.assertRaises(ValueError):
+            self.agent.call('patch', chunks=frames(), path=path, block_size=2048, sha256='')
+        # The patch is abandoned without leaving anything behind. That
+        # happens in the background, so it's waited for.
+        self.assertEqual(self.agent.run('echo ok', hide='all').stdout, 'ok\n')
+        for _ in range(100):
+            if not os.listdir(self.destination):
+                break
+            time.sleep(0.01)
+        self.assertEqual(os.listdir(self.destination), [])
+
+    def test_check_and_delete(self):
+        write(os.path.join(self.source, 'keep'), b'keep')
+        write(os.path.join(self.source, 'remove'), b'remove')
+        self.sync()
+
+        os.remove(os.path.join(self.source, 'remove'))
+        summary = self.sync(delete=True)
+        self.assertEqual(summary['deleted'], ['remove'])
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'remove')))
+
+        # Files that are the same on the host aren't transferred even
+        # when the manifest is ignored.
+        summary = self.sync(check=True)
+        self.assertEqual(summary['transferred'], [])
+        self.assertEqual(summary['unchanged'], ['keep'])
+
+    def test_exclude(self):
+        write(os.path.join(self.source, 'module.py'), b'code')
+        write(os.path.join(self.source, 'module.pyc'), b'bytecode')
+        summary = self.sync(exclude=['*.pyc'])
+        self.assertEqual(summary['transferred'], ['module.py'])
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'module.pyc')))
@@ -0,0 +1,102 @@
+import threading
+import time
+import unittest
+
+from taskrunner.config import Config
+from taskrunner.task import InvocationCache, set_invocation_cache, task
+
+
+class TestInvocationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = InvocationCache()
+        previous = set_invocation_cache(self.cache)
+        self.addCleanup(set_invocation_cache, previous)
+        self.config = Config(debug=False)
+        self.calls = []
+
+    def call_in_threads(self, func, count=4):
+        results = [None] * count
+
+        def target(i):
+            try:
+                results[i] = func()
+            except Exception as exc:
+                results[i] = exc
+
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_callers_run_task_once(self):
+        @task(once=True)
+        def build(config, target):
+            self.calls.append(target)
+            time.sleep(0.2)
+            return target.upper()
+
+        results = self.call_in_threads(lambda: build(self.config, 'lib'))
+        self.assertEqual(results, ['LIB'] * 4)
+        self.assertEqual(self.calls, ['lib'])
+
+        # Later invocations get the cached result.
+        self.assertEqual(build(self.config, 'lib'), 'LIB')
+        self.assertEqual(build(self.config, 'app'), 'APP')
+        self.assertEqual(self.calls, ['lib', 'app'])
+
+    def test_failure_is_raised_to_waiters_then_retried(self):
+        @task(once=True)
+        def build(config):
+            self.calls.append('build')
+            time.sleep(0.2)
+            if len(self.calls) == 1:
+                raise RuntimeError('build failed')
+            return 'built'
+
+        results = self.call_in_threads(lambda: build(self.config))
+        self.assertEqual(self.calls, ['build'])
+        for result in results:
+            self.assertIsInstance(result, RuntimeError)
+        self.assertEqual(len(set(map(id, results))), 1)
+
+        self.assertEqual(build(self.config), 'built')
+        self.assertEqual(self.calls, ['build', 'build'])
+
+    def test_positional_and_keyword_args_have_same_key(self):
+        @task(once=True)
+        def package(config, name, format='whl'):
+            self.calls.append((name, format))
+
+        package(self.config, 'lib')
+        package(self.config, name='lib')
+        package(self.config, 'lib', 'whl')
+        package(self.config, 'lib', format='whl')
+        self.assertEqual(self.calls, [('lib', 'whl')])
+
+        package(self.config, 'lib', format='tar')
+        self.assertEqual(self.calls, [('lib', 'whl'), ('lib', 'tar')])
+
+    def test_recursive_invocation_does_not_deadlock(self):
+        @task(once=True)
+        def build(config):
+            self.calls.append('build')
+            if len(self.calls) == 1:
+                build(config)
+            return len(self.calls)
+
+        self.assertEqual(build(self.config), 2)
+        self.assertEqual(self.calls, ['build', 'build'])
+
+    def test_without_cache_task_is_run_every_time(self):
+        set_invocation_cache(None)
+
+        @task(once=True)
+        def build(config):
+            self.calls.append('build')
+
+        build(self.config)
+        build(self.config)
+        self.assertEqual(self.calls, ['build', 'build'])
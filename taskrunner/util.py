@@ -1,8 +1,9 @@
 import importlib
 import os
 import shutil
+import string
 import sys
-from functools import partial
+from functools import lru_cache, partial
 
 import enum
 
@@ -15,6 +16,13 @@ class Hide(enum.Enum):
     all = 'all'
 
 
+class Capture(enum.Enum):
+
+    full = 'full'
+    head_tail = 'head_tail'
+    none = 'none'
+
+
 class cached_property:
 
     def __init__(self, fget):
@@ -29,6 +37,64 @@ class cached_property:
         return obj.__dict__[self.__name__]
 
 
+class Template:
+
+    """A format string that has been parsed once.
+
+    Templates are created via :func:`compile_template`, which caches
+    them, so rendering the same string repeatedly (e.g., a command run
+    in a loop) doesn't parse it again.
+
+    ``keys`` contains the top level names the template references
+    (e.g., "remote" for ``{remote.host}``). Strings that don't contain
+    any replacement fields are rendered without formatting at all.
+
+    Rendering is equivalent to ``string.format(**kwargs)``, but the
+    mapping is used as is instead of being copied into keyword args.
+
+    """
+
+    __slots__ = ('string', 'literal', 'keys')
+
+    def __init__(self, string_):
+        self.string = string_
+        literals = []
+        keys = set()
+        specs = [string_]
+        while specs:
+            for literal, field_name, format_spec, _ in string.Formatter().parse(specs.pop()):
+                literals.append(literal)
+                if field_name is not None:
+                    keys.add(field_name.partition('.')[0].partition('[')[0])
+                    if format_spec and '{' in format_spec:
+                        specs.append(format_spec)
+        self.keys = frozenset(keys)
+        self.literal = None if keys else ''.join(literals)
+
+    def render(self, kwargs):
+        if self.literal is not None:
+            return self.literal
+        if '' in self.keys or any(key.isdigit() for key in self.keys):
+            # Positional fields need positional args, which aren't ever
+            # passed; let str.format() raise the appropriate error.
+            return self.string.format(**kwargs)
+        return self.string.format_map(kwargs)
+
+    def __repr__(self):
+        return '<{cls} {string!r}>'.format(cls=self.__class__.__name__, string=self.string)
+
+
+@lru_cache(maxsize=1024)
+def compile_template(string_):
+    """Get the :class:`Template` for ``string_`` (cached)."""
+    return Template(string_)
+
+
+def render_template(string_, kwargs):
+    """Render ``string_`` like ``string_.format(**kwargs)``."""
+    return compile_template(string_).render(kwargs)
+
+
 def isatty(stream):
     try:
         return stream.isatty()
@@ -67,7 +133,7 @@ def abs_path(path, format_kwargs={}):
 
     """
     if format_kwargs:
-        path = path.format(**format_kwargs)
+        path = render_template(path, format_kwargs)
     if not os.path.isabs(path):
         if ':' in path:
             path = asset_path(path)
@@ -95,7 +161,7 @@ def asset_path(path, format_kwargs={}):
     path = os.path.join(package_path, *rel_path)
     path = os.path.normpath(os.path.abspath(path))
     if format_kwargs:
-        path = path.format(**format_kwargs)
+        path = render_template(path, format_kwargs)
     return path
 
 
@@ -109,7 +175,8 @@ def args_to_str(args, joiner=' ', format_kwargs={}):
     #
     # After ``args`` has been joined into a single string, its leading and
     # trailing whitespace will be stripped and then ``format_args`` will be
-    # injected into it using ``str.format(**format_kwargs)``.
+    # injected into it using ``str.format(**format_kwargs)``. Format strings
+    # are compiled once and cached (see ``compile_template``).
     if args is None:
         return ''
     if not isinstance(args, str):
@@ -120,7 +187,7 @@ def args_to_str(args, joiner=' ', format_kwargs={}):
             raise TypeError('args must be a str, list, or tuple')
     args = args.strip()
     if format_kwargs:
-        args = args.format(**format_kwargs)
+        args = render_template(args, format_kwargs)
     return args
 
 
@@ -149,7 +216,7 @@ def as_tuple(items, sep=','):
 
 
 def confirm(config, prompt='Really?', color='warning', yes_values=('y', 'yes')):
-    prompt = prompt.format(**config)
+    prompt = render_template(prompt, config)
     prompt = '{prompt} [{yes_value}/N] '.format(prompt=prompt, yes_value=yes_values[0])
     if isinstance(yes_values, str):
         yes_values = (yes_values,)